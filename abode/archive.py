@@ -0,0 +1,446 @@
+"""
+An optional archive of raw gateway payloads which allows rebuilding the database
+from history without downloading it again (e.g. after a schema change or a fix
+to one of the `from_discord` constructors).
+
+Dispatch payloads are written as gzip compressed NDJSON to rotating segment
+files, every sealed segment is recorded in an index with its time range and the
+channels it references. Payloads which build up client state (READY, guild and
+channel events) are additionally written to a separate state stream which starts
+a new file on every READY, so a single segment can be replayed without replaying
+everything before it.
+
+Replay feeds segments through a real `ConnectionState` in a pool of worker
+processes, converts the dispatched objects with the same model constructors the
+live client uses and writes them with the bulk write path.
+"""
+import os
+import json
+import gzip
+import time
+import asyncio
+import itertools
+import collections
+import concurrent.futures
+from discord.state import ConnectionState
+from discord.user import ClientUser
+from discord.channel import _channel_factory
+from .db import get_pool, bulk_insert
+from .db.guilds import Guild
+from .db.channels import Channel
+from .db.emoji import Emoji
+from .db.users import User
+from .db.messages import Message
+
+INDEX_FILE = "index.ndjson"
+EVENTS_PREFIX = "events-"
+STATE_PREFIX = "state-"
+SEGMENT_SUFFIX = ".ndjson.gz"
+
+STATE_EVENTS = {
+    "READY",
+    "GUILD_CREATE",
+    "GUILD_UPDATE",
+    "GUILD_DELETE",
+    "GUILD_EMOJIS_UPDATE",
+    "GUILD_MEMBER_ADD",
+    "GUILD_MEMBER_UPDATE",
+    "GUILD_MEMBER_REMOVE",
+    "GUILD_ROLE_CREATE",
+    "GUILD_ROLE_UPDATE",
+    "GUILD_ROLE_DELETE",
+    "CHANNEL_CREATE",
+    "CHANNEL_UPDATE",
+    "CHANNEL_DELETE",
+}
+
+archive = None
+
+
+class Archive:
+    def __init__(self, path, segment_events=50000, compresslevel=6):
+        self.path = path
+        self.segment_events = segment_events
+        self.compresslevel = compresslevel
+
+        os.makedirs(path, exist_ok=True)
+        self._events = None
+        self._events_entry = None
+        self._state = None
+
+    def _open(self, prefix, ts):
+        name = f"{prefix}{ts:016d}{SEGMENT_SUFFIX}"
+        f = gzip.open(
+            os.path.join(self.path, name), "at", compresslevel=self.compresslevel
+        )
+        return name, f
+
+    def _write_index(self, entry):
+        with open(os.path.join(self.path, INDEX_FILE), "a") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def record(self, payload):
+        """
+        Records a single (decoded) gateway payload, anything which isn't a
+        dispatch is ignored.
+        """
+        if payload.get("op") != 0:
+            return
+
+        ts = int(time.time() * 1000)
+        event = payload.get("t")
+        line = json.dumps({"ts": ts, "t": event, "d": payload.get("d")}) + "\n"
+
+        if self._events is None:
+            name, self._events = self._open(EVENTS_PREFIX, ts)
+            self._events_entry = {
+                "kind": "events",
+                "segment": name,
+                "start": ts,
+                "end": ts,
+                "count": 0,
+                "channels": set(),
+            }
+
+        self._events.write(line)
+        entry = self._events_entry
+        entry["end"] = ts
+        entry["count"] += 1
+
+        data = payload.get("d")
+        if isinstance(data, dict) and "channel_id" in data:
+            entry["channels"].add(int(data["channel_id"]))
+
+        if event in STATE_EVENTS:
+            if event == "READY" or self._state is None:
+                self._close_state()
+                name, self._state = self._open(STATE_PREFIX, ts)
+                self._write_index({"kind": "state", "segment": name, "start": ts})
+            self._state.write(line)
+
+        if entry["count"] >= self.segment_events:
+            self._close_events()
+
+    def _close_events(self):
+        if self._events is None:
+            return
+
+        self._events.close()
+        self._events = None
+
+        entry = self._events_entry
+        entry["channels"] = sorted(entry["channels"])
+        self._write_index(entry)
+
+    def _close_state(self):
+        if self._state is not None:
+            self._state.close()
+            self._state = None
+
+    def close(self):
+        self._close_events()
+        self._close_state()
+
+
+def read_segment(path):
+    """
+    Yields every payload within a segment. Segments which were not closed
+    cleanly are read up to the last complete line.
+    """
+    with gzip.open(path, "rt") as f:
+        try:
+            for line in f:
+                if line.endswith("\n"):
+                    yield json.loads(line)
+        except (EOFError, OSError):
+            return
+
+
+def load_index(path):
+    """
+    Returns a tuple of the (events, state) index entries for an archive, ordered
+    by time. Segments which are missing from the index (because the process died
+    before sealing them) are indexed by scanning them.
+    """
+    events, state = [], []
+    indexed = set()
+
+    index_path = os.path.join(path, INDEX_FILE)
+    if os.path.exists(index_path):
+        with open(index_path, "r") as f:
+            for line in f:
+                entry = json.loads(line)
+                indexed.add(entry["segment"])
+                (events if entry["kind"] == "events" else state).append(entry)
+
+    for name in sorted(os.listdir(path)):
+        if name in indexed or not name.startswith(EVENTS_PREFIX):
+            continue
+
+        entry = {"kind": "events", "segment": name, "count": 0, "channels": set()}
+        for payload in read_segment(os.path.join(path, name)):
+            entry.setdefault("start", payload["ts"])
+            entry["end"] = payload["ts"]
+            entry["count"] += 1
+            data = payload["d"]
+            if isinstance(data, dict) and "channel_id" in data:
+                entry["channels"].add(int(data["channel_id"]))
+
+        if entry["count"]:
+            entry["channels"] = sorted(entry["channels"])
+            events.append(entry)
+
+    events.sort(key=lambda i: i["start"])
+    state.sort(key=lambda i: i["start"])
+    return events, state
+
+
+class ReplayState(ConnectionState):
+    """
+    A `ConnectionState` which is fed archived payloads instead of a websocket and
+    captures dispatched events rather than running handlers.
+    """
+
+    def __init__(self):
+        self.events = []
+        super().__init__(
+            dispatch=self._capture,
+            chunker=None,
+            handlers={},
+            syncer=None,
+            http=None,
+            loop=None,
+            fetch_offline_members=False,
+            max_messages=None,
+        )
+
+    def _capture(self, event, *args):
+        self.events.append((event, args))
+
+    def parse_ready(self, data):
+        # Mirrors `ConnectionState.parse_ready` without the async ready handling
+        self.clear()
+        self.user = user = ClientUser(state=self, data=data["user"])
+        self._users[user.id] = user
+
+        for guild_data in data["guilds"]:
+            guild = self._add_guild_from_data(guild_data)
+            self._capture("guild_available", guild)
+
+        for pm in data.get("private_channels", []):
+            factory, _ = _channel_factory(pm["type"])
+            channel = factory(me=user, data=pm, state=self)
+            self._add_private_channel(channel)
+            self._capture("private_channel_create", channel)
+
+    def feed(self, payload):
+        parser = self.parsers.get(payload["t"])
+        if parser is None:
+            return
+
+        try:
+            parser(payload["d"])
+        except Exception as e:
+            print(f"[replay] failed to parse {payload['t']}: {e}")
+
+
+class ReplayRows:
+    """
+    Collects the model instances for dispatched events, optionally keeping only
+    those which belong to one of `guild_ids` or `channel_ids`.
+    """
+
+    def __init__(self, guild_ids=None, channel_ids=None):
+        self.guild_ids = set(guild_ids or ())
+        self.channel_ids = set(channel_ids or ())
+
+        self.guilds = {}
+        self.channels = {}
+        self.emoji = {}
+        self.users = {}
+        self.messages = {}
+
+    def _matches(self, guild_id, channel_id=None):
+        if self.guild_ids and guild_id not in self.guild_ids:
+            return False
+        if self.channel_ids and channel_id is not None:
+            return channel_id in self.channel_ids
+        return True
+
+    def _add_channel(self, channel):
+        guild = getattr(channel, "guild", None)
+        if self._matches(guild.id if guild else None, channel.id):
+            self.channels[channel.id] = Channel.from_discord(channel)
+
+    def _add_guild(self, guild):
+        if not self._matches(guild.id):
+            return
+
+        self.guilds[guild.id] = Guild.from_attrs(guild, is_currently_joined=True)
+        for channel in guild.channels:
+            self._add_channel(channel)
+        for emoji in guild.emojis:
+            self.emoji[emoji.id] = Emoji.from_discord(emoji)
+        for member in guild.members:
+            self.users[member.id] = User.from_discord(member)
+
+    def collect(self, events):
+        for event, args in events:
+            if event == "message":
+                (message,) = args
+                guild = message.guild
+                if not self._matches(guild.id if guild else None, message.channel.id):
+                    continue
+                self.messages[message.id] = Message.from_discord(message)
+                self.users[message.author.id] = User.from_discord(message.author)
+            elif event in ("guild_available", "guild_join"):
+                self._add_guild(args[0])
+            elif event == "guild_update":
+                self._add_guild(args[1])
+            elif event in ("guild_channel_create", "private_channel_create"):
+                self._add_channel(args[0])
+            elif event == "guild_channel_update":
+                self._add_channel(args[1])
+
+    def as_lists(self):
+        return tuple(
+            list(i.values())
+            for i in (self.guilds, self.channels, self.emoji, self.users, self.messages)
+        )
+
+
+def _replay_segment(
+    path,
+    segment,
+    state_segments,
+    after=None,
+    before=None,
+    guild_ids=None,
+    channel_ids=None,
+):
+    """
+    Runs in a worker process, returning lists of every model instance produced by
+    replaying a single events segment. Payloads outside of `after` / `before`
+    still build up state but produce no rows.
+    """
+    state = ReplayState()
+    for state_segment in state_segments:
+        for payload in read_segment(os.path.join(path, state_segment)):
+            if payload["ts"] >= segment["start"]:
+                break
+            state.feed(payload)
+
+    rows = ReplayRows(guild_ids=guild_ids, channel_ids=channel_ids)
+    for payload in read_segment(os.path.join(path, segment["segment"])):
+        state.events = []
+        state.feed(payload)
+        if (after is not None and payload["ts"] < after) or (
+            before is not None and payload["ts"] > before
+        ):
+            continue
+
+        try:
+            rows.collect(state.events)
+        except Exception as e:
+            print(f"[replay] failed to convert {payload['t']}: {e}")
+
+    return rows.as_lists()
+
+
+def _state_segments_for(segment, state_index):
+    """
+    Returns the state segments required to rebuild client state at the start of
+    an events segment, which is everything since the last READY before it.
+    """
+    result = []
+    for entry in state_index:
+        if entry["start"] >= segment["start"]:
+            break
+        result.append(entry["segment"])
+    return result[-1:]
+
+
+async def _write_rows(rows):
+    guilds, channels, emoji, users, messages = rows
+    async with get_pool().acquire() as conn:
+        await bulk_insert(conn, Guild, guilds, upsert=True)
+        await bulk_insert(conn, Channel, channels, upsert=True)
+        await bulk_insert(conn, Emoji, emoji, upsert=True)
+        await bulk_insert(conn, User, users, upsert=True)
+        await bulk_insert(conn, Message, messages)
+
+
+async def replay_archive(
+    path, workers=None, after=None, before=None, guild_ids=None, channel_ids=None
+):
+    """
+    Rebuilds the database from an archive. Segments are decoded in parallel by
+    `workers` processes and written in order with the bulk write path. `after`
+    and `before` (unix milliseconds), `guild_ids` and `channel_ids` restrict
+    what is replayed.
+    """
+    events_index, state_index = load_index(path)
+
+    segments = [
+        entry
+        for entry in events_index
+        if (after is None or entry["end"] >= after)
+        and (before is None or entry["start"] <= before)
+        and (not channel_ids or set(channel_ids) & set(entry["channels"]))
+    ]
+    print(f"Replaying {len(segments)} of {len(events_index)} archive segments")
+
+    workers = workers or os.cpu_count() or 1
+    loop = asyncio.get_event_loop()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+
+        def submit(segment):
+            return loop.run_in_executor(
+                executor,
+                _replay_segment,
+                path,
+                segment,
+                _state_segments_for(segment, state_index),
+                after,
+                before,
+                guild_ids,
+                channel_ids,
+            )
+
+        # Only a couple of segments per worker are decoded ahead of the writer so
+        #   finished results don't build up in memory. Results are written in
+        #   archive order so newer entity versions win.
+        pending = collections.deque()
+        remaining = iter(segments)
+        for segment in itertools.islice(remaining, workers * 2):
+            pending.append((segment, submit(segment)))
+
+        while pending:
+            segment, future = pending.popleft()
+            rows = await future
+            for next_segment in itertools.islice(remaining, 1):
+                pending.append((next_segment, submit(next_segment)))
+
+            await _write_rows(rows)
+            print(f"  {segment['segment']}: {len(rows[-1])} messages")
+
+
+def init_archive(config):
+    global archive
+
+    opts = config.get("archive", {})
+    if opts.get("path"):
+        archive = Archive(
+            opts["path"],
+            segment_events=opts.get("segment_events", 50000),
+            compresslevel=opts.get("compresslevel", 6),
+        )
+
+
+async def close_archive():
+    if archive is not None:
+        archive.close()
+
+
+def get_archive():
+    return archive
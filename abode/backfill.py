@@ -1,30 +1,264 @@
-from .db.messages import insert_message
+import time
+import asyncio
+import itertools
+from discord import TextChannel, NoMoreItems, Object
+from .db.messages import Message, insert_message_batch, get_last_message_ids
+from .db.users import User
 from .db.channels import upsert_channel
-from discord import TextChannel
+from .db.checkpoints import get_checkpoint, insert_checkpointed_batch
 
+# Discord returns at most this many messages per history request
+HISTORY_PAGE_SIZE = 100
 
-async def backfill_channel(channel):
-    print(f"Backfilling channel {channel.id}")
-    await upsert_channel(channel)
-    idx = 0
-    async for message in channel.history(limit=None, oldest_first=True):
-        idx += 1
-        try:
-            await insert_message(message)
-        except Exception as e:
-            print(f"  [{channel.id}] failed to backfill message {message.id}: {e}")
+scheduler = None
 
-        if idx % 5000 == 0:
-            print(f"  [{channel.id}] {idx} messages")
-    print(f"Done backfilling channel {channel.id}, scanned {idx}")
 
+class RateLimiter:
+    """
+    A simple token bucket which is shared between all backfill readers so the sum
+    of their history requests stays within a global budget. Per-route buckets
+    and 429s are still handled by discord.py itself.
+    """
 
-async def backfill_guild(guild):
-    print(f"Backfilling guild {guild.id}")
-    for channel in guild.channels:
-        if isinstance(channel, TextChannel):
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(1, int(rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+class ChannelProgress:
+    def __init__(self, channel):
+        self.channel = channel
+        self.scanned = 0
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    @property
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def rate(self):
+        return self.scanned / max(self.elapsed, 0.001)
+
+    def __str__(self):
+        return (
+            f"[{self.channel.id}] {self.scanned} messages in {self.elapsed:.0f}s "
+            f"({self.rate:.1f}/s)"
+        )
+
+
+class BackfillScheduler:
+    """
+    Runs a bounded number of channel history readers concurrently. Channels are
+    prioritised by their most recent activity, and every history request is paid
+    for out of a shared `RateLimiter`.
+    """
+
+    def __init__(self, concurrency=4, requests_per_second=5.0, report_interval=30):
+        self.concurrency = concurrency
+        self.report_interval = report_interval
+        self.limiter = RateLimiter(requests_per_second)
+        # Keyed by job rather than channel, a channel can be queued more than once
+        #   (e.g. by a gap fill and a full backfill)
+        self.active = {}
+
+        self._queue = asyncio.PriorityQueue()
+        self._counter = itertools.count()
+        self._tasks = []
+
+    def start(self, loop):
+        self._tasks = [loop.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._tasks.append(loop.create_task(self._reporter()))
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+    def add_channel(self, channel, priority=None, gap=None):
+        """
+        Queues a channel for backfill, returning a future which resolves with the
+        channels `ChannelProgress` once it has been fully scanned. When `gap` is
+        passed as a tuple of (after, before) message ids only that range is
+        fetched and the channels checkpoint is left alone.
+        """
+        if priority is None:
+            priority = getattr(channel, "last_message_id", None) or 0
+
+        future = asyncio.get_event_loop().create_future()
+        self._queue.put_nowait((-priority, next(self._counter), channel, gap, future))
+        return future
+
+    async def _worker(self):
+        while True:
+            _, job, channel, gap, future = await self._queue.get()
+            # Nobody is waiting on a request which was cancelled while queued
+            if future.cancelled():
+                self._queue.task_done()
+                continue
+
+            progress = ChannelProgress(channel)
+            self.active[job] = progress
             try:
-                await upsert_channel(channel)
-                await backfill_channel(channel)
+                if gap is not None:
+                    await self._fill_gap(channel, progress, *gap)
+                else:
+                    await self._backfill_channel(channel, progress)
+                # The caller may have given up on it while it was running
+                if not future.done():
+                    future.set_result(progress)
             except Exception as e:
                 print(f"failed to backfill channel {channel.id}: {e}")
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                progress.finished_at = time.monotonic()
+                del self.active[job]
+                self._queue.task_done()
+
+    async def _reporter(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            if not self.active:
+                continue
+
+            total = sum(i.rate for i in self.active.values())
+            print(
+                f"Backfilling {len(self.active)} channels ({self._queue.qsize()} "
+                f"queued), {total:.1f} messages/s"
+            )
+            for progress in self.active.values():
+                print(f"  {progress}")
+
+    async def _backfill_channel(self, channel, progress):
+        await upsert_channel(channel)
+
+        # Resume after the newest message we have a contiguous history up to
+        after = None
+        checkpoint = await get_checkpoint(channel.id)
+        if checkpoint is not None:
+            after = Object(id=checkpoint)
+            print(f"Backfilling channel {channel.id} after {after.id}")
+        else:
+            print(f"Backfilling channel {channel.id}")
+
+        history = channel.history(limit=None, after=after, oldest_first=True)
+        async for messages, users in self._read_pages(history, progress):
+            await insert_checkpointed_batch(channel.id, messages, users)
+
+        print(f"Done backfilling channel {progress}")
+
+    async def _fill_gap(self, channel, progress, after, before):
+        print(f"Filling gap in channel {channel.id} between {after} and {before}")
+        history = channel.history(
+            limit=None, after=Object(id=after), before=Object(id=before)
+        )
+        async for messages, users in self._read_pages(history, progress):
+            await insert_message_batch(messages, users)
+
+        print(f"Done filling gap in channel {progress}")
+
+    async def _read_pages(self, history, progress):
+        messages = []
+        users = {}
+        while True:
+            # The iterator fetches a new page whenever it has run dry
+            if progress.scanned % HISTORY_PAGE_SIZE == 0:
+                await self.limiter.acquire()
+
+            try:
+                message = await history.next()
+            except NoMoreItems:
+                break
+
+            progress.scanned += 1
+            messages.append(Message.from_discord(message))
+            users[message.author.id] = User.from_discord(message.author)
+
+            if len(messages) >= HISTORY_PAGE_SIZE:
+                yield messages, users.values()
+                messages, users = [], {}
+
+        if messages:
+            yield messages, users.values()
+
+
+def init_backfill(config, loop):
+    global scheduler
+
+    opts = config.get("backfill", {})
+    scheduler = BackfillScheduler(
+        concurrency=opts.get("concurrency", 4),
+        requests_per_second=opts.get("requests_per_second", 5.0),
+        report_interval=opts.get("report_interval", 30),
+    )
+    scheduler.start(loop)
+
+
+def get_scheduler():
+    return scheduler
+
+
+async def backfill_channels(channels):
+    futures = [scheduler.add_channel(channel) for channel in channels]
+    await asyncio.gather(*futures, return_exceptions=True)
+
+
+async def backfill_channel(channel):
+    await backfill_channels([channel])
+
+
+async def fill_gaps(channels):
+    """
+    Compares the newest archived message of each channel with the channels
+    current `last_message_id` and queues fetches for just the missing ranges.
+    Channels which have never been archived are skipped, those require a full
+    backfill.
+    """
+    channels = {
+        channel.id: channel
+        for channel in channels
+        if getattr(channel, "last_message_id", None)
+    }
+    if not channels:
+        return
+
+    last_ids = await get_last_message_ids(channels.keys())
+
+    futures = []
+    for channel_id, last_id in last_ids.items():
+        channel = channels[channel_id]
+        if channel.last_message_id > last_id:
+            futures.append(
+                scheduler.add_channel(
+                    channel, gap=(last_id, channel.last_message_id + 1)
+                )
+            )
+
+    print(f"Filling message gaps in {len(futures)} channels")
+    await asyncio.gather(*futures, return_exceptions=True)
+
+
+async def backfill_guild(guild):
+    print(f"Backfilling guild {guild.id}")
+    await backfill_channels(
+        [channel for channel in guild.channels if isinstance(channel, TextChannel)]
+    )
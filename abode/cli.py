@@ -2,14 +2,47 @@ import os
 import json
 import asyncio
 import argparse
+from datetime import datetime, timezone
 
-from .db import init_db, close_db
+from .db import init_db, close_db, get_pool
+from .db.partitions import partition_messages
+from .db.rollups import rebuild_rollups
+from .ingest import init_ingest, close_ingest
+from .backfill import init_backfill
+from .archive import init_archive, close_archive, replay_archive
 from .client import setup_client
 from .server import setup_server
 
+
+def timestamp_ms(value):
+    """
+    Parses an ISO 8601 date or datetime (UTC unless an offset is given) into unix
+    milliseconds, the unit archive timestamps are recorded in.
+    """
+    try:
+        dt = datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid ISO 8601 datetime: {value!r}")
+
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp() * 1000)
+
+
 parser = argparse.ArgumentParser("abode")
 parser.add_argument("--run-api", action="store_true")
 parser.add_argument("--run-client", action="store_true")
+parser.add_argument("--replay", metavar="ARCHIVE_PATH")
+parser.add_argument("--replay-workers", type=int)
+parser.add_argument("--replay-after", type=timestamp_ms, metavar="DATETIME")
+parser.add_argument("--replay-before", type=timestamp_ms, metavar="DATETIME")
+parser.add_argument("--replay-guild", type=int, action="append", metavar="GUILD_ID")
+parser.add_argument(
+    "--replay-channel", type=int, action="append", metavar="CHANNEL_ID"
+)
+parser.add_argument("--partition-messages", action="store_true")
+parser.add_argument("--partition-batch-size", type=int, default=10000)
+parser.add_argument("--rebuild-rollups", action="store_true")
 
 
 def main():
@@ -18,6 +51,15 @@ def main():
     with open(os.getenv("ABODE_CONFIG_PATH", "config.json"), "r") as f:
         config = json.load(f)
 
+    if args.replay:
+        return replay(config, args)
+
+    if args.partition_messages:
+        return run_partition_messages(config, args)
+
+    if args.rebuild_rollups:
+        return run_rebuild_rollups(config)
+
     start_tasks = []
     cleanup_tasks = []
 
@@ -30,6 +72,12 @@ def main():
     cleanup_tasks.append(close_db())
 
     if args.run_client:
+        init_ingest(config, loop)
+        init_backfill(config, loop)
+        init_archive(config)
+        cleanup_tasks.append(close_archive())
+        cleanup_tasks.insert(0, close_ingest())
+
         client_start, client_logout = setup_client(config, loop)
         start_tasks.append(client_start)
         cleanup_tasks.append(client_logout)
@@ -45,5 +93,52 @@ def main():
         loop.close()
 
 
+def replay(config, args):
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(init_db(config, loop))
+        loop.run_until_complete(
+            replay_archive(
+                args.replay,
+                workers=args.replay_workers,
+                after=args.replay_after,
+                before=args.replay_before,
+                guild_ids=args.replay_guild,
+                channel_ids=args.replay_channel,
+            )
+        )
+        loop.run_until_complete(close_db())
+    finally:
+        loop.close()
+
+
+def run_partition_messages(config, args):
+    async def run():
+        async with get_pool().acquire() as conn:
+            await partition_messages(conn, batch_size=args.partition_batch_size)
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(init_db(config, loop))
+        loop.run_until_complete(run())
+        loop.run_until_complete(close_db())
+    finally:
+        loop.close()
+
+
+def run_rebuild_rollups(config):
+    async def run():
+        async with get_pool().acquire() as conn:
+            await rebuild_rollups(conn)
+
+    loop = asyncio.get_event_loop()
+    try:
+        loop.run_until_complete(init_db(config, loop))
+        loop.run_until_complete(run())
+        loop.run_until_complete(close_db())
+    finally:
+        loop.close()
+
+
 if __name__ == "__main__":
     main()
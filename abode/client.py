@@ -7,8 +7,19 @@ from .events import (
     on_guild_join,
     on_guild_update,
     on_guild_remove,
+    on_guild_channel_create,
+    on_guild_channel_update,
+    on_guild_channel_delete,
+    on_guild_emojis_update,
+    on_member_join,
+    on_user_update,
     on_message,
+    on_raw_message_edit,
+    on_raw_message_delete,
+    on_raw_bulk_message_delete,
+    on_socket_response,
 )
+from .archive import get_archive
 
 
 USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64; rv:72.0) Gecko/20100101 Firefox/72.0"
@@ -24,7 +35,19 @@ def setup_client(config, loop):
     client.on_guild_join = bind(on_guild_join)
     client.on_guild_update = bind(on_guild_update)
     client.on_guild_remove = bind(on_guild_remove)
+    client.on_guild_channel_create = bind(on_guild_channel_create)
+    client.on_guild_channel_update = bind(on_guild_channel_update)
+    client.on_guild_channel_delete = bind(on_guild_channel_delete)
+    client.on_guild_emojis_update = bind(on_guild_emojis_update)
+    client.on_member_join = bind(on_member_join)
+    client.on_user_update = bind(on_user_update)
     client.on_message = bind(on_message)
+    client.on_raw_message_edit = bind(on_raw_message_edit)
+    client.on_raw_message_delete = bind(on_raw_message_delete)
+    client.on_raw_bulk_message_delete = bind(on_raw_bulk_message_delete)
+
+    if get_archive() is not None:
+        client.on_socket_response = bind(on_socket_response)
 
     # TODO: cf cookies, IDENTIFY information
     client.http.user_agent = USER_AGENT
@@ -0,0 +1,106 @@
+"""
+Fakes shared by the tests which exercise database code without a database.
+"""
+import pytest
+
+
+class FakeTransaction:
+    def __init__(self, events):
+        self.events = events
+
+    async def __aenter__(self):
+        self.events.append("begin")
+
+    async def __aexit__(self, *exc):
+        self.events.append("rollback" if exc[0] else "commit")
+
+
+class FakeStatement:
+    def __init__(self, conn, query):
+        self.conn = conn
+        self.query = query
+
+    async def fetch(self, *args):
+        return await self.conn.fetch(self.query, *args)
+
+
+class FakeCursor:
+    def __init__(self, records):
+        self.records = list(records)
+
+    async def fetch(self, count):
+        chunk, self.records = self.records[:count], self.records[count:]
+        return chunk
+
+
+class FakeConnection:
+    """
+    Stands in for an asyncpg connection. Every statement sent to it is recorded
+    in `events` as a `(method, query, args)` tuple, anything which reads rows
+    gets `records` back.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.records = []
+        self.staging_tables = set()
+
+    def queries(self, method=None):
+        return [
+            event[1:]
+            for event in self.events
+            if isinstance(event, tuple) and method in (None, event[0])
+        ]
+
+    def transaction(self):
+        return FakeTransaction(self.events)
+
+    async def prepare_cached(self, query):
+        return FakeStatement(self, query)
+
+    async def execute(self, query, *args):
+        self.events.append(("execute", query, args))
+
+    async def fetch(self, query, *args):
+        self.events.append(("fetch", query, args))
+        return self.records
+
+    async def fetchval(self, query, *args):
+        self.events.append(("fetchval", query, args))
+        return self.records[0][0] if self.records else None
+
+    async def cursor(self, query, *args):
+        self.events.append(("cursor", query, args))
+        return FakeCursor(self.records)
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.events.append(("copy", table, list(records)))
+
+
+class FakeAcquire:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def __aenter__(self):
+        return self.conn
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+class FakePool:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def acquire(self):
+        return FakeAcquire(self.conn)
+
+
+@pytest.fixture
+def conn():
+    return FakeConnection()
+
+
+@pytest.fixture
+def pool(conn):
+    return FakePool(conn)
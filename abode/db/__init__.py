@@ -1,12 +1,35 @@
 import asyncpg
 import functools
-import os
+import collections
+import itertools
 import dataclasses
 import json
 import typing
 from datetime import datetime
-
-pool = None
+from abode.lib import fastjson
+from .migrations import migrate
+from .partitions import ensure_message_partitions, maintain_message_partitions
+
+# Named connection pools, each a list of pools (one per replica) see `init_db`
+pools = {}
+_pool_cycles = {}
+_maintenance_task = None
+
+# Defaults for the named pools, any of these can be overridden under `pools` in
+#   the config. The ingest pool is used by the client for writes and the search
+#   pool by the API.
+POOL_DEFAULTS = {
+    "ingest": {"min_size": 2, "max_size": 10, "prepare_ingest": True},
+    "search": {"min_size": 1, "max_size": 5, "statement_timeout": "60s"},
+}
+
+# Options which are sent to postgres as session settings for a pools connections
+POOL_SESSION_SETTINGS = (
+    "statement_timeout",
+    "work_mem",
+    "lock_timeout",
+    "idle_in_transaction_session_timeout",
+)
 
 
 T = typing.TypeVar("T")
@@ -21,6 +44,27 @@ class FTS:
         self.inner = inner
 
 
+class SnowflakeTime:
+    """
+    A datetime field which is the creation time of a snowflake field, and can be
+    queried through it (see `BaseModel._snowflake_times`).
+    """
+
+    def __init__(self, inner):
+        self.inner = inner
+
+
+class TimeBucket:
+    """
+    A datetime field of a rollup which is truncated to `unit` (see
+    `BaseModel._time_bucket`), so it can only be filtered on whole units.
+    """
+
+    def __init__(self, inner, unit):
+        self.inner = inner
+        self.unit = unit
+
+
 def Snowflake(i):
     return int(i)
 
@@ -31,54 +75,239 @@ def to_json_str(obj):
     return json.dumps(obj)
 
 
-async def init_db(config, loop):
-    global pool
+class EntityCache:
+    """
+    A bounded LRU of entity fingerprints, keyed by model and primary key. Entities
+    whose fingerprint matches the last one we wrote are unchanged and can skip
+    the database entirely.
+    """
+
+    def __init__(self, size=50000):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
 
-    pool = await asyncpg.create_pool(dsn=config.get("postgres_dsn"))
+    def __len__(self):
+        return len(self._entries)
 
-    async with pool.acquire() as connection:
-        sql_dir = os.path.abspath(
-            os.path.join(os.path.dirname(__file__), "..", "schema")
+    def __repr__(self):
+        return (
+            f"<EntityCache size={len(self)}/{self.size} hits={self.hits} "
+            f"misses={self.misses} hit_rate={self.hit_rate:.2%}>"
         )
-        for sql_file in os.listdir(sql_dir):
-            with open(os.path.join(sql_dir, sql_file), "r") as f:
-                await connection.execute(f.read())
+
+    @property
+    def hit_rate(self):
+        return self.hits / max(self.hits + self.misses, 1)
+
+    @staticmethod
+    def _key(instance):
+        return (instance.__class__, getattr(instance, instance._pk))
+
+    @staticmethod
+    def fingerprint(instance):
+        return hash(repr(tuple(getattr(instance, i) for i in instance.codec().names)))
+
+    def is_unchanged(self, instance):
+        key = self._key(instance)
+        fingerprint = self._entries.get(key)
+        if fingerprint is not None and fingerprint == self.fingerprint(instance):
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return True
+
+        self.misses += 1
+        return False
+
+    def remember(self, instance):
+        key = self._key(instance)
+        self._entries[key] = self.fingerprint(instance)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def forget(self, instance):
+        self._entries.pop(self._key(instance), None)
+
+
+entity_cache = EntityCache()
+
+
+class Connection(asyncpg.Connection):
+    """
+    Connection class used by our pools, which keeps prepared statements and the
+    temporary staging tables created on each connection around for its lifetime.
+    """
+
+    __slots__ = ("prepared_statements", "staging_tables")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared_statements = {}
+        self.staging_tables = set()
+
+    async def prepare_cached(self, query):
+        statement = self.prepared_statements.get(query)
+        if statement is None:
+            statement = await self.prepare(query)
+            self.prepared_statements[query] = statement
+        return statement
+
+
+async def set_json_codecs(conn, passthrough=False):
+    """
+    Registers binary JSON and JSONB codecs on a connection, so values are
+    exchanged as python objects encoded with `fastjson`. With `passthrough`
+    values are decoded to `RawJSON` instead, which the API embeds into its
+    responses without ever parsing them.
+    """
+    if passthrough:
+
+        def decode_json(data):
+            return fastjson.RawJSON(data.decode("utf-8"))
+
+    else:
+        decode_json = fastjson.loads
+
+    await conn.set_type_codec(
+        "json",
+        schema="pg_catalog",
+        format="binary",
+        encoder=fastjson.dumpb,
+        decoder=decode_json,
+    )
+
+    # The binary JSONB format is the text format prefixed with a version byte
+    await conn.set_type_codec(
+        "jsonb",
+        schema="pg_catalog",
+        format="binary",
+        encoder=lambda value: b"\x01" + fastjson.dumpb(value),
+        decoder=lambda data: decode_json(data[1:]),
+    )
+
+
+async def init_connection(conn, jsonb_passthrough=False, prepare_ingest=False):
+    """
+    Pool `init` hook which registers our type codecs and, for pools used for
+    writes, prepares the statements used on the ingest path so the first write on
+    a new connection only has to bind arguments.
+    """
+    await set_json_codecs(conn, passthrough=jsonb_passthrough)
+    if not prepare_ingest:
+        return
+
+    from .users import User
+    from .channels import Channel
+    from .guilds import Guild
+    from .emoji import Emoji
+
+    for model in (User, Channel, Guild, Emoji):
+        await conn.prepare_cached(entity_upsert_query_text(model))
+
+
+async def create_named_pool(name, config):
+    opts = {**POOL_DEFAULTS.get(name, {}), **config.get("pools", {}).get(name, {})}
+
+    server_settings = {"application_name": f"abode-{name}"}
+    for setting in POOL_SESSION_SETTINGS:
+        if opts.get(setting) is not None:
+            server_settings[setting] = str(opts[setting])
+
+    # Only the API embeds JSONB into responses as-is, everything else needs the
+    #   decoded values.
+    jsonb_passthrough = name == "search" and opts.get(
+        "jsonb_passthrough", config.get("jsonb_passthrough", False)
+    )
+    init = functools.partial(
+        init_connection,
+        jsonb_passthrough=jsonb_passthrough,
+        prepare_ingest=opts.get("prepare_ingest", False),
+    )
+
+    # Reads can be spread over replicas, writes always go to the primary
+    dsns = opts.get("replica_dsns") or [opts.get("dsn", config.get("postgres_dsn"))]
+    return [
+        await asyncpg.create_pool(
+            dsn=dsn,
+            min_size=opts.get("min_size", 10),
+            max_size=opts.get("max_size", 10),
+            server_settings=server_settings,
+            connection_class=Connection,
+            init=init,
+        )
+        for dsn in dsns
+    ]
+
+
+async def init_db(config, loop):
+    global _maintenance_task
+
+    entity_cache.size = config.get("entity_cache_size", entity_cache.size)
+
+    # The schema has to exist before the pool prepares statements against it
+    connection = await asyncpg.connect(dsn=config.get("postgres_dsn"))
+    try:
+        await migrate(connection)
+        await ensure_message_partitions(connection)
+    finally:
+        await connection.close()
+
+    for name in {**POOL_DEFAULTS, **config.get("pools", {})}:
+        pools[name] = await create_named_pool(name, config)
+        _pool_cycles[name] = itertools.cycle(pools[name])
+
+    _maintenance_task = loop.create_task(maintain_message_partitions(get_pool()))
 
 
 async def close_db():
-    await get_pool().close()
+    if _maintenance_task is not None:
+        _maintenance_task.cancel()
 
+    for name in list(pools):
+        for pool in pools.pop(name):
+            await pool.close()
+        del _pool_cycles[name]
 
-def get_pool():
-    return pool
+
+def get_pool(name="ingest"):
+    """
+    Returns the named pool, or None if the database has not been initialized
+    yet. Pools with multiple replicas are handed out round-robin.
+    """
+    if name not in _pool_cycles:
+        return None
+    return next(_pool_cycles[name])
 
 
 def with_conn(func):
     @functools.wraps(func)
     async def wrapped(*args, **kwargs):
-        if "conn" in kwargs:
-            return await func(kwargs.pop("conn"), *args, **kwargs)
+        conn = kwargs.pop("conn", None)
+        if conn is not None:
+            return await func(conn, *args, **kwargs)
 
-        async with pool.acquire() as connection:
+        async with get_pool().acquire() as connection:
             return await func(connection, *args, **kwargs)
 
     return wrapped
 
 
 def build_insert_query(instance, upsert=False, ignore_existing=False):
-    dataclass = instance.__class__
+    model = instance.__class__
+    return (
+        insert_query_text(model, upsert=upsert, ignore_existing=ignore_existing),
+        model.codec().encode(instance),
+    )
 
-    column_names = []
-    column_values = []
-    updates = []
-    for field in dataclasses.fields(dataclass):
-        column_names.append(field.name)
-        column_values.append(
-            convert_to_type(getattr(instance, field.name), field.type, to_pg=True)
-        )
 
-        if upsert:
-            updates.append(f"{field.name}=excluded.{field.name}")
+@functools.lru_cache(maxsize=None)
+def insert_query_text(dataclass, upsert=False, ignore_existing=False):
+    column_names = list(dataclass.codec().names)
+    updates = []
+    if upsert:
+        updates = [f"{name}=excluded.{name}" for name in column_names]
     values = ", ".join([f"${i}" for i in range(1, len(column_names) + 1)])
 
     upsert_contents = ""
@@ -95,19 +324,206 @@ def build_insert_query(instance, upsert=False, ignore_existing=False):
             ON CONFLICT (id) DO NOTHING
         """
 
-    return (
-        f"""
+    return f"""
         INSERT INTO {table_name(dataclass)} ({', '.join(column_names)})
         VALUES ({values})
         {upsert_contents}
-    """,
-        tuple(column_values),
+    """
+
+
+@functools.lru_cache(maxsize=None)
+def build_upsert_query(model, source, existing):
+    """
+    Builds a single statement which upserts rows produced by `source` into the
+    models table and records every changed field in the changelog. Rows whose
+    contents did not change are not touched at all. `existing` is a FROM clause
+    selecting the current versions of the rows being written, which all parts
+    of the statement see from the same snapshot.
+
+    The statement returns one (entity_id, field) row per changed field. Writers
+    of the same entity are serialised by the row lock `ON CONFLICT` takes, and
+    versions come from a sequence read after that lock is held, so they increase
+    with every change to an entity (without being contiguous).
+    """
+    table = table_name(model)
+    pk = model._pk
+    column_names = model.codec().names
+    updates = ", ".join(f"{name}=excluded.{name}" for name in column_names)
+    current = ", ".join(f"{table}.{name}" for name in column_names)
+    excluded = ", ".join(f"excluded.{name}" for name in column_names)
+
+    return f"""
+        WITH existing AS (
+            SELECT {table}.* FROM {existing}
+        ), upserted AS (
+            INSERT INTO {table} ({', '.join(column_names)})
+            {source}
+            ON CONFLICT ({pk}) DO UPDATE SET {updates}
+            WHERE ({current}) IS DISTINCT FROM ({excluded})
+            RETURNING {table}.*
+        ), changes AS (
+            SELECT '{table}:' || existing.{pk} AS entity_id, old.key AS field, old.value
+            FROM existing
+            JOIN upserted ON upserted.{pk} = existing.{pk}
+            CROSS JOIN LATERAL jsonb_each(to_jsonb(existing)) AS old
+            JOIN LATERAL jsonb_each(to_jsonb(upserted)) AS new ON new.key = old.key
+            WHERE old.value IS DISTINCT FROM new.value
+        )
+        INSERT INTO changelog (entity_id, version, field, value)
+        SELECT
+            changes.entity_id,
+            nextval('changelog_version_seq'),
+            changes.field,
+            changes.value #>> '{{}}'
+        FROM changes
+        RETURNING entity_id, field
+    """
+
+
+async def bulk_insert(conn, model, instances, upsert=False):
+    """
+    Writes a batch of model instances in one go by COPYing them into a temporary
+    staging table and merging that into the real table with a single statement.
+    Rows which already exist are skipped, or updated (and their changes written
+    to the changelog) when `upsert` is set and their contents actually changed.
+    """
+    # Dedupe on the primary key, an upsert cannot touch the same row twice
+    instances = {getattr(i, i._pk): i for i in instances}
+    if upsert:
+        instances = {
+            k: v for k, v in instances.items() if not entity_cache.is_unchanged(v)
+        }
+
+    if not instances:
+        return
+
+    staging, create_staging, query = bulk_query_text(model, upsert=upsert)
+
+    # Converted lazily, COPY streams the records as it goes
+    codec = model.codec()
+    records = (codec.encode(instance) for instance in instances.values())
+
+    async with conn.transaction():
+        # Temp tables live as long as the connection, so this is only done once
+        if staging not in conn.staging_tables:
+            await conn.execute(create_staging)
+            conn.staging_tables.add(staging)
+
+        await conn.copy_records_to_table(
+            staging, records=records, columns=list(codec.names)
+        )
+        await conn.execute(query)
+
+    if upsert:
+        for instance in instances.values():
+            entity_cache.remember(instance)
+
+
+@functools.lru_cache(maxsize=None)
+def bulk_query_text(model, upsert=False):
+    """
+    Returns the name of a models staging table, the statement creating it and the
+    statement merging it into the models table.
+    """
+    table = table_name(model)
+    staging = f"_staging_{table}"
+    columns = ", ".join(model.codec().names)
+
+    create_staging = f"""
+        CREATE TEMP TABLE IF NOT EXISTS {staging}
+        (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+    """
+
+    source = f"SELECT {columns} FROM {staging}"
+    if upsert:
+        assert not model._rollups
+        # Rows are locked in key order, so overlapping batches can't deadlock
+        query = build_upsert_query(
+            model,
+            f"{source} ORDER BY {model._pk}",
+            f"{table} JOIN {staging} ON {staging}.{model._pk} = {table}.{model._pk}",
+        )
+    else:
+        query = f"""
+            INSERT INTO {table} ({columns})
+            {source}
+            ON CONFLICT ({model._pk}) DO NOTHING
+        """
+
+    if model._rollups:
+        # Counted from the rows actually inserted, in the same statement
+        ctes = "".join(
+            f", rollup_{idx} AS ({rollup_query_text(rollup, 'inserted')})"
+            for idx, rollup in enumerate(model._rollups)
+        )
+        query = f"""
+            WITH inserted AS ({query} RETURNING *){ctes}
+            SELECT count(*) FROM inserted
+        """
+
+    return staging, create_staging, query
+
+
+@functools.lru_cache(maxsize=None)
+def rollup_query_text(rollup, source):
+    """
+    Returns a statement adding the counts of the rows in `source` to a rollup,
+    see `abode.db.rollups`.
+    """
+    table = table_name(rollup)
+    groups = ", ".join(str(idx) for idx in range(1, len(rollup._rollup_columns) + 1))
+
+    # Ordered so concurrent writers lock the rollup rows in the same order
+    return f"""
+        INSERT INTO {table} ({", ".join(rollup._rollup_columns)}, message_count)
+        SELECT {", ".join(rollup._rollup_columns.values())}, count(*)
+        FROM {source}
+        GROUP BY {groups}
+        ORDER BY {groups}
+        ON CONFLICT ({", ".join(rollup._rollup_key)}) DO UPDATE
+        SET message_count = {table}.message_count + EXCLUDED.message_count
+    """
+
+
+@functools.lru_cache(maxsize=None)
+def entity_upsert_query_text(model):
+    codec = model.codec()
+
+    # The primary key must be the first field for `existing` below
+    assert codec.names[0] == model._pk
+
+    values = ", ".join(f"${i}" for i in range(1, len(codec.names) + 1))
+    return build_upsert_query(
+        model,
+        f"VALUES ({values})",
+        f"{table_name(model)} WHERE {model._pk} = $1",
     )
 
 
+@with_conn
+async def upsert_entity(conn, instance):
+    """
+    Upserts a single model instance in one round trip, skipping the database
+    entirely when the entity cache says it has not changed since we last wrote
+    it. Returns the names of the fields which changed.
+    """
+    if entity_cache.is_unchanged(instance):
+        return []
+
+    model = instance.__class__
+    statement = await conn.prepare_cached(entity_upsert_query_text(model))
+    changes = await statement.fetch(*model.codec().encode(instance))
+    entity_cache.remember(instance)
+    return [record["field"] for record in changes]
+
+
 def build_select_query(instance, where=None):
-    dataclass = instance.__class__
-    select_fields = ", ".join([field.name for field in dataclasses.fields(dataclass)])
+    return select_query_text(instance.__class__, where)
+
+
+@functools.lru_cache(maxsize=None)
+def select_query_text(dataclass, where=None):
+    select_fields = ", ".join(dataclass.codec().names)
     where = f"WHERE {where}" if where else ""
 
     return f"""
@@ -116,50 +532,106 @@ def build_select_query(instance, where=None):
     """
 
 
-def convert_to_type(value, target_type, to_pg=False, from_pg=False, to_js=False):
+@functools.lru_cache(maxsize=None)
+def compile_converter(target_type, to_pg=False, from_pg=False, to_js=False):
+    """
+    Compiles a function converting a single value to `target_type` for the given
+    direction. This resolves all the typing introspection once, so converting a
+    value is a single call. See `convert_to_type` for the semantics.
+    """
+    optional = False
     if typing.get_origin(target_type) is typing.Union:
         if type(None) in typing.get_args(target_type):
-            if value is None:
-                return None
+            optional = True
             target_type = next(
                 i for i in typing.get_args(target_type) if i is not type(None)
             )
         else:
             assert False
 
-    if (
-        to_js
-        and target_type == Snowflake
-        or (target_type == typing.Optional[Snowflake] and value is not None)
-    ):
-        return str(value)
+    if to_js and target_type == Snowflake:
+        convert = str
+    elif to_js and target_type == datetime:
+        convert = datetime.isoformat
+    elif typing.get_origin(target_type) == list:
+        convert = list
+    elif is_jsonb(target_type):
+        # Encoded and decoded by the JSON codecs registered on every connection
+        return _identity
+    elif target_type == Snowflake:
+        convert = int
+    else:
 
-    if (
-        to_js
-        and target_type == datetime
-        or (target_type == typing.Optional[datetime] and value is not None)
-    ):
-        return value.isoformat()
+        def convert(value):
+            if type(value) == target_type:
+                return value
 
-    if typing.get_origin(target_type) == list:
-        return list(value)
+            try:
+                return target_type(value)
+            except Exception:
+                print(type(value))
+                print(target_type)
+                print(typing.get_origin(target_type))
+                raise
 
-    if type(value) == target_type:
-        return value
+    if optional:
+        return lambda value: None if value is None else convert(value)
+    return convert
 
-    if to_pg and typing.get_origin(target_type) == JSONB:
-        return json.dumps(value)
 
-    if from_pg and typing.get_origin(target_type) == JSONB:
-        return json.loads(value)
+def _identity(value):
+    return value
+
+
+def convert_to_type(value, target_type, to_pg=False, from_pg=False, to_js=False):
+    return compile_converter(target_type, to_pg=to_pg, from_pg=from_pg, to_js=to_js)(
+        value
+    )
+
+
+class ModelCodec:
+    """
+    Precompiled per-field converters for a model, in the order of its fields.
+    Every `BaseModel` subclass gets one (see `BaseModel.codec`) so hot paths can
+    skip `dataclasses.fields` and typing introspection entirely.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.fields = dataclasses.fields(model)
+        self.names = tuple(field.name for field in self.fields)
+        self.to_pg = tuple(
+            compile_converter(field.type, to_pg=True) for field in self.fields
+        )
+        self.from_pg = tuple(
+            compile_converter(field.type, from_pg=True) for field in self.fields
+        )
+        self.to_js = tuple(
+            compile_converter(field.type, to_js=True) for field in self.fields
+        )
+        # Every to_js conversion of a from_pg result is a single step
+        self.pg_to_js = tuple(
+            compile_converter(field.type, from_pg=True, to_js=True)
+            for field in self.fields
+        )
+        self.coerce = tuple(compile_converter(field.type) for field in self.fields)
+
+    def encode(self, instance):
+        return tuple(
+            fn(getattr(instance, name)) for name, fn in zip(self.names, self.to_pg)
+        )
+
+    def decode(self, record):
+        return self.model(*[fn(value) for fn, value in zip(self.from_pg, record)])
+
+    def serialize(self, instance):
+        return {
+            name: fn(getattr(instance, name)) for name, fn in zip(self.names, self.to_js)
+        }
 
-    try:
-        return target_type(value)
-    except Exception:
-        print(type(value))
-        print(target_type)
-        print(typing.get_origin(target_type))
-        raise
+
+def is_jsonb(target_type):
+    return target_type is JSONB or typing.get_origin(target_type) == JSONB
 
 
 def table_name(model):
@@ -170,14 +642,24 @@ class BaseModel:
     _refs = {}
     _fts = set()
     _virtual_fields = {}
+    # Maps datetime fields to the snowflake field they are the creation time of
+    _snowflake_times = {}
+    # Rollup models which are kept up to date as instances are bulk inserted
+    _rollups = ()
+    # For rollups, the (field, unit) rows are bucketed by time on
+    _time_bucket = None
+
+    @classmethod
+    def codec(cls):
+        # Built on first use, the dataclass decorator runs after class creation
+        codec = cls.__dict__.get("_codec")
+        if codec is None:
+            codec = ModelCodec(cls)
+            cls._codec = codec
+        return codec
 
     def serialize(self, **kwargs):
-        return {
-            field.name: convert_to_type(
-                getattr(self, field.name), field.type, to_js=True
-            )
-            for field in dataclasses.fields(self)
-        }
+        return self.codec().serialize(self)
 
     def diff(self, other):
         for field in dataclasses.fields(self):
@@ -190,9 +672,4 @@ class BaseModel:
 
     @classmethod
     def from_record(cls, record):
-        return cls(
-            **{
-                field.name: convert_to_type(record[idx], field.type, from_pg=True)
-                for idx, field in enumerate(dataclasses.fields(cls))
-            }
-        )
+        return cls.codec().decode(record)
@@ -3,14 +3,7 @@ from dataclasses import dataclass
 from typing import Optional, List
 from .guilds import Guild
 from .users import User
-from . import (
-    with_conn,
-    build_insert_query,
-    build_select_query,
-    JSONB,
-    Snowflake,
-    BaseModel,
-)
+from . import with_conn, upsert_entity, bulk_insert, JSONB, Snowflake, BaseModel
 
 
 @dataclass
@@ -33,10 +26,12 @@ class Channel(BaseModel):
     user_limit: Optional[int] = None
 
     # DMs
-    recipients: Optional[JSONB[List[str]]] = None
+    recipients: Optional[JSONB[List[Snowflake]]] = None
     owner_id: Optional[Snowflake] = None
     icon: Optional[str] = None
 
+    deleted: bool = False
+
     _pk = "id"
     _refs = {
         "guild": (Guild, ("guild_id", "id"), False),
@@ -45,8 +40,8 @@ class Channel(BaseModel):
     _fts = set()
 
     @classmethod
-    def from_discord(cls, channel):
-        inst = cls(id=channel.id, type=channel.type.value)
+    def from_discord(cls, channel, deleted=False):
+        inst = cls(id=channel.id, type=channel.type.value, deleted=deleted)
 
         if isinstance(
             channel,
@@ -78,20 +73,16 @@ class Channel(BaseModel):
         return inst
 
 
-@with_conn
-async def upsert_channel(conn, channel):
-    new_channel = Channel.from_discord(channel)
+async def upsert_channel(channel, conn=None):
+    await upsert_entity(Channel.from_discord(channel), conn=conn)
 
-    # TODO: calculate diff
-    existing_channel = await conn.fetchrow(
-        build_select_query(new_channel, "id = $1"), channel.id
-    )
 
-    query, args = build_insert_query(new_channel, upsert=True)
-    await conn.execute(query, *args)
+async def delete_channel(channel, conn=None):
+    await upsert_entity(Channel.from_discord(channel, deleted=True), conn=conn)
 
-    if existing_channel is not None:
-        existing_channel = Channel.from_record(existing_channel)
-        diff = list(new_channel.diff(existing_channel))
-        if diff:
-            print(f"[channel] diff is {diff}")
+
+@with_conn
+async def upsert_channels(conn, channels):
+    await bulk_insert(
+        conn, Channel, [Channel.from_discord(i) for i in channels], upsert=True
+    )
@@ -0,0 +1,58 @@
+"""
+Backfill checkpoints track how far a channels history has been archived by
+walking it oldest first, everything up to the checkpoint is contiguous. An
+interrupted or repeated backfill only has to fetch what comes after it.
+"""
+from . import with_conn, bulk_insert, entity_cache
+from .messages import Message
+from .users import User
+
+
+@with_conn
+async def get_checkpoint(conn, channel_id):
+    """
+    Returns the newest message id the channels history has been archived up to,
+    or None if it has never been backfilled.
+    """
+    return await conn.fetchval(
+        "SELECT newest_id FROM backfill_checkpoints WHERE channel_id = $1",
+        channel_id,
+    )
+
+
+@with_conn
+async def insert_checkpointed_batch(conn, channel_id, messages, users=()):
+    """
+    Writes a page of backfilled messages and advances the channels checkpoint in
+    the same transaction, so the checkpoint never covers messages we lost.
+    """
+    if not messages:
+        return
+
+    users = list(users)
+    try:
+        async with conn.transaction():
+            await bulk_insert(conn, User, users, upsert=True)
+            await bulk_insert(conn, Message, messages)
+            await _advance_checkpoint(
+                conn, channel_id, max(message.id for message in messages)
+            )
+    except Exception:
+        # The users were remembered as written, but the transaction rolled back
+        for user in users:
+            entity_cache.forget(user)
+        raise
+
+
+async def _advance_checkpoint(conn, channel_id, newest_id):
+    await conn.execute(
+        """
+        INSERT INTO backfill_checkpoints (channel_id, newest_id)
+        VALUES ($1, $2)
+        ON CONFLICT (channel_id) DO UPDATE SET
+            newest_id = GREATEST(backfill_checkpoints.newest_id, excluded.newest_id),
+            updated_at = excluded.updated_at
+    """,
+        channel_id,
+        newest_id,
+    )
@@ -1,14 +1,7 @@
 from dataclasses import dataclass
 from typing import Optional
 from datetime import datetime
-from . import (
-    with_conn,
-    build_insert_query,
-    build_select_query,
-    JSONB,
-    Snowflake,
-    BaseModel,
-)
+from . import with_conn, upsert_entity, bulk_insert, JSONB, Snowflake, BaseModel
 from .guilds import Guild
 
 
@@ -29,6 +22,7 @@ class Emoji(BaseModel):
     _table_name = "emoji"
     _refs = {"guild": (Guild, ("guild_id", "id"), True)}
     _virtual_fields = {"image": ("id", "animated"), "image_url": ("id", "animated")}
+    _snowflake_times = {"created_at": "id"}
 
     @staticmethod
     def image(id, animated):
@@ -57,18 +51,26 @@ class Emoji(BaseModel):
         )
 
 
+async def upsert_emoji(emoji, conn=None):
+    await upsert_entity(Emoji.from_discord(emoji), conn=conn)
+
+
 @with_conn
-async def upsert_emoji(conn, emoji):
-    emoji = Emoji.from_discord(emoji)
+async def upsert_emojis(conn, emojis):
+    await bulk_insert(conn, Emoji, [Emoji.from_discord(i) for i in emojis], upsert=True)
 
-    # TODO: calculate diff
-    existing_emoji = await conn.fetchrow(build_select_query(emoji, "id = $1"), emoji.id)
 
-    query, args = build_insert_query(emoji, upsert=True)
-    await conn.execute(query, *args)
+async def update_emojis(before, after, conn=None):
+    """
+    Writes only the emoji which were added or changed in between two lists of a
+    guilds emoji, and marks the ones missing from `after` as deleted.
+    """
+    old_emoji = {i.id: Emoji.from_discord(i) for i in before}
+    for emoji in after:
+        new_emoji = Emoji.from_discord(emoji)
+        if old_emoji.pop(emoji.id, None) != new_emoji:
+            await upsert_entity(new_emoji, conn=conn)
 
-    if existing_emoji is not None:
-        existing_emoji = Emoji.from_record(existing_emoji)
-        diff = list(emoji.diff(existing_emoji))
-        if diff:
-            print(f"[emoji] diff is {diff}")
+    for emoji in old_emoji.values():
+        emoji.deleted = True
+        await upsert_entity(emoji, conn=conn)
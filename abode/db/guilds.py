@@ -1,16 +1,26 @@
-from dataclasses import dataclass, fields
+import time
+import asyncio
+import hashlib
+from dataclasses import dataclass
 from typing import Optional
 from . import (
     with_conn,
-    build_insert_query,
-    build_select_query,
-    convert_to_type,
+    upsert_entity,
+    bulk_insert,
     Snowflake,
     BaseModel,
     JSONB,
 )
 from .users import User
 
+# Minimum number of seconds in between full member syncs of a single guild
+MEMBER_SYNC_INTERVAL = 60 * 10
+
+# Maximum number of guilds which are fully synced at once
+GUILD_SYNC_CONCURRENCY = 4
+
+_member_syncs = {}
+
 
 @dataclass
 class Guild(BaseModel):
@@ -35,41 +45,144 @@ class Guild(BaseModel):
     @classmethod
     def from_attrs(cls, guild, is_currently_joined=None):
         kwargs = {"is_currently_joined": is_currently_joined}
-        for field in fields(cls):
-            if not hasattr(guild, field.name):
+        codec = cls.codec()
+        for name, coerce in zip(codec.names, codec.coerce):
+            if not hasattr(guild, name):
                 continue
 
-            kwargs[field.name] = convert_to_type(getattr(guild, field.name), field.type)
+            kwargs[name] = coerce(getattr(guild, name))
         return cls(**kwargs)
 
 
+def snapshot_hash(guild, is_currently_joined=None):
+    """
+    Computes a compact content hash of a guild covering the guild itself, its
+    channels, its emoji and the set of member ids. If the hash matches the one
+    stored for our last sync there is nothing to write.
+    """
+    from .emoji import Emoji
+    from .channels import Channel
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(
+        repr(Guild.from_attrs(guild, is_currently_joined=is_currently_joined)).encode()
+    )
+    for channel in sorted(guild.channels, key=lambda i: i.id):
+        digest.update(repr(Channel.from_discord(channel)).encode())
+    for emoji in sorted(guild.emojis, key=lambda i: i.id):
+        digest.update(repr(Emoji.from_discord(emoji)).encode())
+    digest.update(repr(sorted(i.id for i in guild.members)).encode())
+    return digest.hexdigest()
+
+
 @with_conn
-async def upsert_guild(conn, guild, is_currently_joined=None):
-    from .emoji import upsert_emoji
-    from .users import upsert_user
-    from .channels import upsert_channel
+async def get_snapshot_hashes(conn, guild_ids):
+    records = await conn.fetch(
+        "SELECT guild_id, hash FROM guild_snapshots WHERE guild_id = ANY($1)",
+        list(guild_ids),
+    )
+    return {record["guild_id"]: record["hash"] for record in records}
 
-    new_guild = Guild.from_attrs(guild, is_currently_joined=is_currently_joined)
 
-    # TODO: calculate diff
-    existing_guild = await conn.fetchrow(
-        build_select_query(new_guild, "id = $1"), new_guild.id
+@with_conn
+async def save_snapshot_hash(conn, guild_id, hash):
+    await conn.execute(
+        """
+        INSERT INTO guild_snapshots (guild_id, hash) VALUES ($1, $2)
+        ON CONFLICT (guild_id) DO UPDATE SET hash = excluded.hash
+    """,
+        guild_id,
+        hash,
     )
 
-    query, args = build_insert_query(new_guild, upsert=True)
-    await conn.execute(query, *args)
 
-    if existing_guild is not None:
-        existing_guild = Guild.from_record(existing_guild)
-        diff = list(new_guild.diff(existing_guild))
-        if diff:
-            print(f"[guilds] diff is {diff}")
+@with_conn
+async def clear_snapshot_hash(conn, guild_id):
+    await conn.execute("DELETE FROM guild_snapshots WHERE guild_id = $1", guild_id)
+
 
-    for channel in guild.channels:
-        await upsert_channel(channel, conn=conn)
+@with_conn
+async def upsert_guild(conn, guild, is_currently_joined=None, force_members=False):
+    """
+    Fully syncs a guild along with all of its channels, emoji and members. Member
+    syncs are throttled, see `sync_guild_members`.
+
+    The guilds snapshot hash is cleared first, only `sync_guilds` stores a new
+    one once everything it covers has been written.
+    """
+    from .emoji import upsert_emojis
+    from .channels import upsert_channels
+
+    await clear_snapshot_hash(guild.id, conn=conn)
+    await upsert_entity(
+        Guild.from_attrs(guild, is_currently_joined=is_currently_joined), conn=conn
+    )
+    await upsert_channels(guild.channels, conn=conn)
+    await upsert_emojis(guild.emojis, conn=conn)
+    await sync_guild_members(guild, force=force_members, conn=conn)
 
-    for emoji in guild.emojis:
-        await upsert_emoji(emoji, conn=conn)
 
-    for member in guild.members:
-        await upsert_user(member, conn=conn)
+async def sync_guilds(guilds, is_currently_joined=None, concurrency=None):
+    """
+    Fully syncs many guilds, running at most `concurrency` syncs at once so we
+    don't starve the pool (and everything else using it). Guilds whose snapshot
+    hash matches the one stored by their last sync are skipped.
+    """
+    semaphore = asyncio.Semaphore(concurrency or GUILD_SYNC_CONCURRENCY)
+    hashes = {guild.id: snapshot_hash(guild, is_currently_joined) for guild in guilds}
+    previous_hashes = await get_snapshot_hashes(hashes.keys())
+
+    async def sync(guild):
+        async with semaphore:
+            try:
+                await upsert_guild(
+                    guild, is_currently_joined=is_currently_joined, force_members=True
+                )
+                await save_snapshot_hash(guild.id, hashes[guild.id])
+            except Exception as e:
+                print(f"failed to sync guild {guild.id}: {e}")
+
+    changed = [
+        guild for guild in guilds if previous_hashes.get(guild.id) != hashes[guild.id]
+    ]
+    print(f"Syncing {len(changed)} of {len(hashes)} guilds")
+    await asyncio.gather(*[sync(guild) for guild in changed])
+
+
+@with_conn
+async def update_guild(conn, before, after, is_currently_joined=None):
+    """
+    Incrementally syncs a guild update by diffing the old and new guild objects
+    and only writing the guild row and emoji which actually changed.
+
+    Channels are not diffed, the copy of the guild discord.py passes as `before`
+    shares its channels with `after`. They (and members) are kept up to date by
+    their own events instead.
+    """
+    from .emoji import update_emojis
+
+    await clear_snapshot_hash(after.id, conn=conn)
+
+    new_guild = Guild.from_attrs(after, is_currently_joined=is_currently_joined)
+    if new_guild != Guild.from_attrs(before, is_currently_joined=is_currently_joined):
+        await upsert_entity(new_guild, conn=conn)
+
+    await update_emojis(before.emojis, after.emojis, conn=conn)
+
+
+@with_conn
+async def sync_guild_members(conn, guild, force=False):
+    """
+    Bulk upserts every member of the guild. As this is expensive for large guilds
+    a sync is skipped if the guild was synced within `MEMBER_SYNC_INTERVAL`
+    seconds, unless `force` is passed.
+    """
+    now = time.monotonic()
+    last_sync = _member_syncs.get(guild.id)
+    if not force and last_sync is not None and now - last_sync < MEMBER_SYNC_INTERVAL:
+        return
+
+    _member_syncs[guild.id] = now
+    await bulk_insert(
+        conn, User, [User.from_discord(i) for i in guild.members], upsert=True
+    )
@@ -1,17 +1,19 @@
-from dataclasses import dataclass, fields
+from dataclasses import dataclass
+from discord.utils import parse_time
 from datetime import datetime
 from typing import Optional
 from . import (
     with_conn,
-    build_insert_query,
-    convert_to_type,
+    bulk_insert,
     JSONB,
     Snowflake,
     BaseModel,
 )
-from .users import User, upsert_user
+from .users import User
 from .guilds import Guild
 from .channels import Channel
+from .rollups import MESSAGE_ROLLUPS
+from abode.lib import fastjson
 
 
 @dataclass
@@ -42,6 +44,8 @@ class Message(BaseModel):
         "channel": (Channel, ["channel_id", "id"], True),
     }
     _fts = {"content"}
+    _snowflake_times = {"created_at": "id"}
+    _rollups = MESSAGE_ROLLUPS
 
     @classmethod
     def from_discord(cls, message, deleted=False):
@@ -66,11 +70,11 @@ class Message(BaseModel):
 
     @classmethod
     def from_attrs(cls, instance, deleted=None):
-        kwargs = {}
-        for field in fields(cls):
-            kwargs[field.name] = convert_to_type(
-                getattr(instance, field.name), field.type
-            )
+        codec = cls.codec()
+        kwargs = {
+            name: coerce(getattr(instance, name))
+            for name, coerce in zip(codec.names, codec.coerce)
+        }
         if deleted:
             kwargs["deleted"] = deleted
         return cls(**kwargs)
@@ -78,19 +82,125 @@ class Message(BaseModel):
 
 @with_conn
 async def insert_message(conn, message):
-    new_message = Message.from_discord(message)
+    # Goes through the bulk path so the message rollups are kept up to date
+    await insert_message_batch(
+        [Message.from_discord(message)], [User.from_discord(message.author)], conn=conn
+    )
 
-    query, args = build_insert_query(new_message, ignore_existing=True)
-    try:
-        await conn.execute(query, *args)
-    except Exception:
-        print(query)
-        print(args)
-        raise
 
-    await upsert_user(message.author, conn=conn)
+@with_conn
+async def insert_message_batch(conn, messages, users=()):
+    """
+    Bulk writes already converted `Message` and `User` instances, skipping any
+    messages which are already archived.
+    """
+    await bulk_insert(conn, User, users, upsert=True)
+    await bulk_insert(conn, Message, messages)
+
+
+@with_conn
+async def get_last_message_ids(conn, channel_ids):
+    """
+    Returns a mapping of channel id to the newest archived message id, channels
+    without any archived messages are omitted.
+    """
+    records = await conn.fetch(
+        """
+        SELECT c.id, (
+            SELECT max(messages.id) FROM messages WHERE messages.channel_id = c.id
+        ) AS last_id
+        FROM unnest($1::bigint[]) AS c(id)
+    """,
+        list(channel_ids),
+    )
+    return {
+        record["id"]: record["last_id"]
+        for record in records
+        if record["last_id"] is not None
+    }
+
+
+@with_conn
+async def update_messages(conn, edits):
+    """
+    Applies a batch of message edits in a single statement. `edits` is a mapping
+    of message id to the (coalesced) partial message data from the gateway. The
+    content being replaced is kept in `message_revisions`, edits which don't
+    change anything are ignored.
+    """
+    if not edits:
+        return
+
+    ids, contents, embeds, edited_ats = [], [], [], []
+    for message_id, data in edits.items():
+        ids.append(message_id)
+        contents.append(data.get("content"))
+        # Bound as text, asyncpg would encode a list of embeds as array dimensions
+        embeds.append(
+            fastjson.dumps(data["embeds"]) if data.get("embeds") is not None else None
+        )
+        edited_ats.append(
+            parse_time(data["edited_timestamp"])
+            if data.get("edited_timestamp")
+            else None
+        )
+
+    await conn.execute(
+        """
+        WITH edits AS (
+            SELECT id, content, embeds::jsonb, edited_at
+            FROM unnest($1::bigint[], $2::text[], $3::text[], $4::timestamp[])
+                AS edits(id, content, embeds, edited_at)
+        ), changed AS (
+            SELECT messages.id, messages.content, messages.embeds, messages.edited_at,
+                coalesce(edits.content, messages.content) AS new_content,
+                coalesce(edits.embeds, messages.embeds) AS new_embeds,
+                coalesce(edits.edited_at, messages.edited_at) AS new_edited_at
+            FROM messages JOIN edits ON edits.id = messages.id
+            WHERE (messages.content, messages.embeds)
+                IS DISTINCT FROM (
+                    coalesce(edits.content, messages.content),
+                    coalesce(edits.embeds, messages.embeds)
+                )
+        ), revisions AS (
+            INSERT INTO message_revisions (message_id, content, embeds, edited_at, replaced_at)
+            SELECT id, content, embeds, edited_at,
+                coalesce(new_edited_at, now() at time zone 'utc')
+            FROM changed
+        )
+        UPDATE messages SET
+            content = changed.new_content,
+            embeds = changed.new_embeds,
+            edited_at = changed.new_edited_at
+        FROM changed
+        WHERE messages.id = changed.id
+    """,
+        ids,
+        contents,
+        embeds,
+        edited_ats,
+    )
 
 
 @with_conn
 async def update_message(conn, message):
-    pass
+    await update_messages(
+        {
+            message.id: {
+                "content": message.content,
+                "embeds": [i.to_dict() for i in message.embeds],
+                "edited_timestamp": message.edited_at.isoformat()
+                if message.edited_at
+                else None,
+            }
+        },
+        conn=conn,
+    )
+
+
+@with_conn
+async def delete_messages(conn, message_ids):
+    await conn.execute(
+        "UPDATE messages SET deleted = true WHERE id = ANY($1) AND NOT deleted",
+        list(message_ids),
+    )
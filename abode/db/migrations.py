@@ -0,0 +1,142 @@
+"""
+Versioned schema migrations. Every file in `abode/schema` named like
+`0001_description.sql` is a migration, applied once in version order and
+recorded (along with a checksum of its contents) in `schema_migrations`. When the
+database is up to date startup costs a single SELECT.
+
+Migrations run within a transaction, unless their first line is the marker
+`-- abode:no-transaction`. Those are run one statement at a time outside of any
+transaction (as `CREATE INDEX CONCURRENTLY` requires), with statements separated
+by a semicolon at the end of a line. A non-transactional migration which fails
+part way is retried from the start, so its statements should be idempotent.
+"""
+import os
+import re
+import hashlib
+import asyncpg
+
+MIGRATIONS_DIR = os.path.abspath(
+    os.path.join(os.path.dirname(__file__), "..", "schema")
+)
+MIGRATION_FILE_RE = re.compile(r"^(\d+)_(\w+)\.sql$")
+NO_TRANSACTION_MARKER = "-- abode:no-transaction"
+STATEMENT_END_RE = re.compile(r";[ \t]*$", re.MULTILINE)
+
+# Arbitrary key for the advisory lock held while applying migrations
+MIGRATION_LOCK_ID = 7239001
+
+
+class MigrationError(Exception):
+    pass
+
+
+class Migration:
+    def __init__(self, version, name, sql):
+        self.version = version
+        self.name = name
+        self.sql = sql
+        self.checksum = hashlib.sha256(sql.encode("utf-8")).hexdigest()
+        self.transactional = not sql.lstrip().startswith(NO_TRANSACTION_MARKER)
+
+    def __repr__(self):
+        return f"<Migration {self.version:04d}_{self.name}>"
+
+    def statements(self):
+        for statement in STATEMENT_END_RE.split(self.sql):
+            # Skip anything which is only comments and whitespace
+            code = "\n".join(
+                line for line in statement.splitlines()
+                if not line.strip().startswith("--")
+            )
+            if code.strip():
+                yield statement.strip()
+
+
+def load_migrations(path=MIGRATIONS_DIR):
+    migrations = {}
+    for file_name in os.listdir(path):
+        match = MIGRATION_FILE_RE.match(file_name)
+        if not match:
+            continue
+
+        version = int(match.group(1))
+        if version in migrations:
+            raise MigrationError(f"duplicate migration version {version}")
+
+        with open(os.path.join(path, file_name), "r") as f:
+            migrations[version] = Migration(version, match.group(2), f.read())
+
+    return [migrations[version] for version in sorted(migrations)]
+
+
+async def get_applied_migrations(conn):
+    """
+    Returns a mapping of applied migration versions to their checksums, or None
+    if the tracking table does not exist yet.
+    """
+    try:
+        records = await conn.fetch("SELECT version, checksum FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        return None
+    return {record["version"]: record["checksum"] for record in records}
+
+
+def pending_migrations(migrations, applied):
+    pending = []
+    for migration in migrations:
+        checksum = applied.get(migration.version)
+        if checksum is None:
+            pending.append(migration)
+        elif checksum != migration.checksum:
+            raise MigrationError(
+                f"{migration!r} was modified after being applied, add a new "
+                "migration instead"
+            )
+    return pending
+
+
+async def apply_migration(conn, migration):
+    print(f"Applying migration {migration.version:04d}_{migration.name}")
+
+    record = """
+        INSERT INTO schema_migrations (version, name, checksum)
+        VALUES ($1, $2, $3)
+    """
+    args = (migration.version, migration.name, migration.checksum)
+
+    if migration.transactional:
+        async with conn.transaction():
+            await conn.execute(migration.sql)
+            await conn.execute(record, *args)
+    else:
+        for statement in migration.statements():
+            await conn.execute(statement)
+        await conn.execute(record, *args)
+
+
+async def migrate(conn, path=MIGRATIONS_DIR):
+    migrations = load_migrations(path)
+
+    applied = await get_applied_migrations(conn)
+    if applied is not None and not pending_migrations(migrations, applied):
+        return
+
+    # Multiple processes may be starting at once, only one of them migrates
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_ID)
+    try:
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version integer PRIMARY KEY,
+                name text NOT NULL,
+                checksum text NOT NULL,
+                applied_at timestamp NOT NULL DEFAULT (now() at time zone 'utc')
+            )
+        """
+        )
+
+        applied = await get_applied_migrations(conn)
+        for migration in pending_migrations(migrations, applied):
+            await apply_migration(conn, migration)
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_ID)
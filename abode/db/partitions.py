@@ -0,0 +1,246 @@
+"""
+Maintenance of the monthly `messages` partitions, and an online conversion of an
+existing unpartitioned `messages` table.
+
+The conversion builds a partitioned copy of the table while a trigger mirrors
+every write to the original into it, copies the existing rows over in id order
+and finally swaps the tables in one short transaction. The original table is
+kept around as `messages_unpartitioned` until it is dropped by hand.
+"""
+import re
+import asyncio
+
+# How many months of partitions are kept ready ahead of time
+PARTITION_MONTHS_AHEAD = 3
+PARTITION_MAINTENANCE_INTERVAL = 60 * 60 * 24
+
+INDEX_DEF_RE = re.compile(r"^CREATE (UNIQUE )?INDEX (\S+) ON (\S+) ")
+
+
+async def is_partitioned(conn, table):
+    return await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = $1::regclass)",
+        table,
+    )
+
+
+async def ensure_message_partitions(conn, months_ahead=PARTITION_MONTHS_AHEAD):
+    """
+    Creates the upcoming monthly partitions of `messages`. Rows for a month
+    without a partition would land in the default partition, which then blocks
+    creating that months partition, so this must run well ahead of time.
+    """
+    created = await conn.fetchval(
+        """
+        SELECT abode_create_snowflake_partitions(
+            'messages',
+            'messages',
+            now() at time zone 'utc',
+            (now() at time zone 'utc') + $1 * interval '1 month'
+        )
+        WHERE EXISTS (
+            SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass
+        )
+    """,
+        months_ahead,
+    )
+    if created:
+        print(f"Created {created} message partitions")
+
+
+async def maintain_message_partitions(pool):
+    while True:
+        await asyncio.sleep(PARTITION_MAINTENANCE_INTERVAL)
+        try:
+            async with pool.acquire() as conn:
+                await ensure_message_partitions(conn)
+        except Exception as e:
+            print(f"failed to create message partitions: {e}")
+
+
+async def _get_columns(conn, table):
+    records = await conn.fetch(
+        """
+        SELECT attname FROM pg_attribute
+        WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+    """,
+        table,
+    )
+    return [record["attname"] for record in records]
+
+
+async def _get_indexes(conn, table):
+    """
+    Returns the (name, definition) of every index on `table` other than its
+    primary key.
+    """
+    records = await conn.fetch(
+        """
+        SELECT i.relname AS name, pg_get_indexdef(i.oid) AS definition
+        FROM pg_index
+        JOIN pg_class i ON i.oid = pg_index.indexrelid
+        WHERE pg_index.indrelid = $1::regclass AND NOT pg_index.indisprimary
+        ORDER BY i.relname
+    """,
+        table,
+    )
+    return [(record["name"], record["definition"]) for record in records]
+
+
+def retarget_index(definition, name, table):
+    """
+    Rewrites an index definition (as returned by `pg_get_indexdef`) to create an
+    identical index with a different name on a different table.
+    """
+    match = INDEX_DEF_RE.match(definition)
+    assert match, definition
+    unique = match.group(1) or ""
+    return (
+        f"CREATE {unique}INDEX IF NOT EXISTS {name} ON {table} "
+        + definition[match.end() :]
+    )
+
+
+async def _create_partitioned_copy(conn, columns):
+    """
+    Creates the partitioned table and the trigger mirroring writes into it. Every
+    step is idempotent, so an interrupted conversion can simply be rerun.
+    """
+    print("Creating messages_partitioned")
+    await conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS messages_partitioned (
+            LIKE messages INCLUDING DEFAULTS INCLUDING CONSTRAINTS,
+            CONSTRAINT messages_partitioned_pkey PRIMARY KEY (id)
+        ) PARTITION BY RANGE (id)
+    """
+    )
+    await conn.execute(
+        "CREATE TABLE IF NOT EXISTS messages_default "
+        "PARTITION OF messages_partitioned DEFAULT"
+    )
+    await conn.execute(
+        """
+        SELECT abode_create_snowflake_partitions(
+            'messages_partitioned',
+            'messages',
+            coalesce(
+                (SELECT created_at FROM messages ORDER BY id LIMIT 1),
+                now() at time zone 'utc'
+            ),
+            (now() at time zone 'utc') + $1 * interval '1 month'
+        )
+    """,
+        PARTITION_MONTHS_AHEAD,
+    )
+
+    # Indexes are built up front, building them on the partitioned table later
+    #   would block the mirrored writes.
+    for name, definition in await _get_indexes(conn, "messages"):
+        print(f"  creating index {name}")
+        await conn.execute(
+            retarget_index(definition, f"{name}_partitioned", "messages_partitioned")
+        )
+
+    column_list = ", ".join(columns)
+    excluded = ", ".join(f"EXCLUDED.{column}" for column in columns)
+    await conn.execute(
+        f"""
+        CREATE OR REPLACE FUNCTION abode_mirror_messages() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                DELETE FROM messages_partitioned WHERE id = OLD.id;
+                RETURN OLD;
+            END IF;
+
+            INSERT INTO messages_partitioned VALUES (NEW.*)
+            ON CONFLICT (id) DO UPDATE SET ({column_list}) = ROW({excluded});
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql
+    """
+    )
+    await conn.execute("DROP TRIGGER IF EXISTS abode_mirror_messages ON messages")
+    await conn.execute(
+        """
+        CREATE TRIGGER abode_mirror_messages
+        AFTER INSERT OR UPDATE OR DELETE ON messages
+        FOR EACH ROW EXECUTE PROCEDURE abode_mirror_messages()
+    """
+    )
+
+
+async def _copy_rows(conn, batch_size):
+    """
+    Copies every row into the partitioned table in id order. Rows which already
+    exist there were written by the mirror trigger and are newer, so they win.
+    """
+    last_id = -1
+    copied = 0
+    while True:
+        last_id, count = await conn.fetchrow(
+            """
+            WITH batch AS (
+                SELECT * FROM messages WHERE id > $1 ORDER BY id LIMIT $2
+            ), inserted AS (
+                INSERT INTO messages_partitioned SELECT * FROM batch
+                ON CONFLICT (id) DO NOTHING
+            )
+            SELECT max(id), count(*) FROM batch
+        """,
+            last_id,
+            batch_size,
+        )
+        if not count:
+            break
+
+        copied += count
+        print(f"  copied {copied} messages (up to {last_id})")
+
+
+async def _swap_tables(conn, index_names):
+    print("Swapping messages and messages_partitioned")
+    async with conn.transaction():
+        # Writers queue up behind this lock, so give up quickly if we can't get it
+        await conn.execute("SET LOCAL lock_timeout = '10s'")
+        await conn.execute("LOCK TABLE messages IN ACCESS EXCLUSIVE MODE")
+        await conn.execute("DROP TRIGGER abode_mirror_messages ON messages")
+        await conn.execute("DROP FUNCTION abode_mirror_messages()")
+
+        await conn.execute("ALTER TABLE messages RENAME TO messages_unpartitioned")
+        await conn.execute(
+            "ALTER TABLE messages_unpartitioned "
+            "RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey"
+        )
+        for name in index_names:
+            await conn.execute(f"ALTER INDEX {name} RENAME TO {name}_unpartitioned")
+
+        await conn.execute("ALTER TABLE messages_partitioned RENAME TO messages")
+        await conn.execute(
+            "ALTER TABLE messages RENAME CONSTRAINT messages_partitioned_pkey TO messages_pkey"
+        )
+        for name in index_names:
+            await conn.execute(f"ALTER INDEX {name}_partitioned RENAME TO {name}")
+
+
+async def partition_messages(conn, batch_size=10000):
+    """
+    Converts an unpartitioned `messages` table into a partitioned one, without
+    blocking writes for longer than the final swap. Safe to rerun if it was
+    interrupted.
+
+    Messages are only ever soft deleted by abode, a row hard deleted while its
+    batch is being copied could be copied back after its deletion is mirrored.
+    """
+    if await is_partitioned(conn, "messages"):
+        print("messages is already partitioned")
+        return
+
+    index_names = [name for name, _ in await _get_indexes(conn, "messages")]
+    await _create_partitioned_copy(conn, await _get_columns(conn, "messages"))
+    await _copy_rows(conn, batch_size)
+    await conn.execute("ANALYZE messages_partitioned")
+    await _swap_tables(conn, index_names)
+
+    print("Done, the old table can be dropped with `DROP TABLE messages_unpartitioned`")
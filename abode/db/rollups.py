@@ -0,0 +1,76 @@
+"""
+Message counts rolled up per (channel, author, day) and per (guild, hour), which
+aggregate queries over messages (see `abode.lib.query`) are answered from instead
+of scanning the messages table.
+
+The rollups are updated in the same statement which bulk inserts messages, from
+the rows that insert actually wrote, so replaying a batch never counts a message
+twice. Counts include messages which were later deleted. Messages written any
+other way are only counted after `rebuild_rollups`.
+"""
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+from . import BaseModel, Snowflake, rollup_query_text, table_name
+from .users import User
+from .guilds import Guild
+from .channels import Channel
+
+
+@dataclass
+class DailyMessageCount(BaseModel):
+    channel_id: Snowflake
+    author_id: Snowflake
+    guild_id: Optional[Snowflake]
+    day: datetime
+    message_count: int
+
+    _table_name = "message_counts_daily"
+    _refs = {
+        "guild": (Guild, ("guild_id", "id"), False),
+        "author": (User, ("author_id", "id"), True),
+        "channel": (Channel, ("channel_id", "id"), True),
+    }
+    _time_bucket = ("day", "day")
+    _rollup_columns = {
+        "channel_id": "channel_id",
+        "author_id": "author_id",
+        "guild_id": "guild_id",
+        "day": "date_trunc('day', created_at)",
+    }
+    _rollup_key = ("channel_id", "author_id", "day")
+
+
+@dataclass
+class HourlyMessageCount(BaseModel):
+    # Direct messages have no guild and are counted under guild 0
+    guild_id: Snowflake
+    hour: datetime
+    message_count: int
+
+    _table_name = "message_counts_hourly"
+    _refs = {
+        "guild": (Guild, ("guild_id", "id"), False),
+    }
+    _time_bucket = ("hour", "hour")
+    _rollup_columns = {
+        "guild_id": "coalesce(guild_id, 0)",
+        "hour": "date_trunc('hour', created_at)",
+    }
+    _rollup_key = ("guild_id", "hour")
+
+
+MESSAGE_ROLLUPS = (DailyMessageCount, HourlyMessageCount)
+
+
+async def rebuild_rollups(conn, rollups=MESSAGE_ROLLUPS):
+    """
+    Recomputes the rollups from the messages table. This runs in one transaction
+    so the counts are never seen half built, message ingestion waits on it (and
+    buffers in the meantime) until it completes.
+    """
+    async with conn.transaction():
+        for rollup in rollups:
+            print(f"Rebuilding {table_name(rollup)}")
+            await conn.execute(f"TRUNCATE {table_name(rollup)}")
+            await conn.execute(rollup_query_text(rollup, "messages"))
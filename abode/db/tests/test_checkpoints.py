@@ -0,0 +1,65 @@
+import asyncio
+import dataclasses
+import pytest
+from abode.db import entity_cache
+from abode.db.checkpoints import get_checkpoint, insert_checkpointed_batch
+from abode.db.messages import Message
+from abode.db.users import User
+from .test_codecs import RECORD
+
+
+def _messages(*ids):
+    message = Message.from_record(RECORD)
+    return [dataclasses.replace(message, id=id) for id in ids]
+
+
+def _user(id):
+    return User(
+        id=id, name="blob", discriminator=1, avatar=None, bot=False, system=False
+    )
+
+
+def test_get_checkpoint(conn):
+    assert asyncio.run(get_checkpoint(1, conn=conn)) is None
+
+    conn.records = [(5,)]
+    assert asyncio.run(get_checkpoint(1, conn=conn)) == 5
+    assert conn.queries()[-1][1] == (1,)
+
+
+def test_insert_checkpointed_batch(conn):
+    users = [_user(910001)]
+    asyncio.run(
+        insert_checkpointed_batch(20, _messages(3, 1, 2), users, conn=conn)
+    )
+
+    # The page and its checkpoint are written in one transaction
+    assert conn.events[0] == "begin" and conn.events[-1] == "commit"
+    tables = [table for table, _ in conn.queries("copy")]
+    assert tables == ["_staging_users", "_staging_messages"]
+
+    query, args = conn.queries("execute")[-1]
+    assert "INSERT INTO backfill_checkpoints" in query
+    assert args == (20, 3)
+
+    # Empty pages don't touch the checkpoint
+    conn.events.clear()
+    asyncio.run(insert_checkpointed_batch(20, [], users, conn=conn))
+    assert conn.events == []
+    entity_cache.forget(users[0])
+
+
+def test_failed_checkpointed_batch_forgets_users(monkeypatch, conn):
+    async def copy_records_to_table(table, records, columns):
+        if table == "_staging_messages":
+            raise ConnectionResetError("connection lost")
+
+    monkeypatch.setattr(conn, "copy_records_to_table", copy_records_to_table)
+
+    user = _user(910002)
+    with pytest.raises(ConnectionResetError):
+        asyncio.run(insert_checkpointed_batch(20, _messages(1), [user], conn=conn))
+
+    # The users write was rolled back, so they have to be written again
+    assert not entity_cache.is_unchanged(user)
+    assert "rollback" in conn.events
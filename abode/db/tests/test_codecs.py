@@ -0,0 +1,108 @@
+from datetime import datetime
+from typing import Optional, List
+import asyncio
+from abode.db import convert_to_type, set_json_codecs, JSONB, Snowflake
+from abode.db.messages import Message
+from abode.db.guilds import Guild
+from abode.db.channels import Channel
+from abode.lib.query import compile_query
+from abode.lib.fastjson import RawJSON
+
+RECORD = (
+    1,
+    2,
+    None,
+    3,
+    None,
+    False,
+    0,
+    "hello",
+    [{"type": "rich"}],
+    False,
+    0,
+    None,
+    None,
+    datetime(2020, 1, 1),
+    None,
+    False,
+)
+
+
+def test_codec_decodes_records():
+    message = Message.from_record(RECORD)
+    assert message.embeds == [{"type": "rich"}]
+    assert message.guild_id is None
+    assert message.codec().encode(message)[8] == [{"type": "rich"}]
+
+
+def test_codec_serializes_for_js():
+    message = Message.from_record(RECORD)
+    assert message.serialize() == {
+        "id": "1",
+        "channel_id": "2",
+        "guild_id": None,
+        "author_id": "3",
+        "webhook_id": None,
+        "tts": False,
+        "type": 0,
+        "content": "hello",
+        "embeds": [{"type": "rich"}],
+        "mention_everyone": False,
+        "flags": 0,
+        "activity": None,
+        "application": None,
+        "created_at": "2020-01-01T00:00:00",
+        "edited_at": None,
+        "deleted": False,
+    }
+
+
+def test_convert_to_type():
+    assert convert_to_type("1", Guild.codec().fields[0].type) == 1
+    assert convert_to_type(None, Optional[JSONB], to_pg=True) is None
+    # JSONB is handled by the codecs registered on each connection
+    assert convert_to_type([1], Optional[JSONB], to_pg=True) == [1]
+    assert convert_to_type([1], JSONB, from_pg=True) == [1]
+    assert convert_to_type(1, Optional[Snowflake], to_js=True) == "1"
+    assert convert_to_type((1, 2), List[int]) == [1, 2]
+
+    # Non-optional booleans coerce missing values, as they always have
+    assert convert_to_type(None, bool) is False
+
+
+class CodecConnection:
+    def __init__(self):
+        self.codecs = {}
+
+    async def set_type_codec(self, name, **kwargs):
+        self.codecs[name] = kwargs
+
+
+def get_codecs(passthrough=False):
+    conn = CodecConnection()
+    asyncio.run(
+        set_json_codecs(conn, passthrough=passthrough)
+    )
+    return conn.codecs
+
+
+def test_jsonb_codec():
+    jsonb = get_codecs()["jsonb"]
+    assert jsonb["encoder"]([1, {"a": None}]) == b'\x01[1,{"a":null}]'
+    assert jsonb["decoder"](b'\x01[1,{"a":null}]') == [1, {"a": None}]
+
+    jsonb = get_codecs(passthrough=True)["jsonb"]
+    assert jsonb["decoder"](b"\x01[1]") == RawJSON("[1]")
+
+
+def test_recipients_search_matches_stored_ids():
+    channel = Channel.from_record(
+        (1, 1, None, None, None, None, None, None, None, None, None, [123], None, None)
+        + (False,)
+    )
+    _, args, _ = compile_query("recipients:123", Channel)
+
+    # Containment on jsonb is type sensitive, `"123"` would never match `[123]`
+    jsonb = get_codecs()["jsonb"]
+    assert jsonb["encoder"](args[0]) == b"\x01[123]"
+    assert jsonb["encoder"](channel.codec().encode(channel)[11]) == b"\x01[123]"
@@ -0,0 +1,33 @@
+from abode.db import EntityCache
+from abode.db.users import User
+
+
+def _user(id, name="blob"):
+    return User(
+        id=id, name=name, discriminator=1, avatar=None, bot=False, system=False
+    )
+
+
+def test_entity_cache_hits_unchanged():
+    cache = EntityCache()
+    assert not cache.is_unchanged(_user(1))
+
+    cache.remember(_user(1))
+    assert cache.is_unchanged(_user(1))
+    assert not cache.is_unchanged(_user(1, name="jake"))
+    assert (cache.hits, cache.misses) == (1, 2)
+
+    cache.forget(_user(1))
+    assert not cache.is_unchanged(_user(1))
+
+
+def test_entity_cache_evicts_least_recently_used():
+    cache = EntityCache(size=2)
+    cache.remember(_user(1))
+    cache.remember(_user(2))
+    assert cache.is_unchanged(_user(1))
+
+    cache.remember(_user(3))
+    assert len(cache) == 2
+    assert cache.is_unchanged(_user(1))
+    assert not cache.is_unchanged(_user(2))
@@ -0,0 +1,199 @@
+import asyncio
+import copy
+from datetime import datetime
+from types import SimpleNamespace
+from abode import db
+from abode.db import guilds, channels, emoji
+from abode.db.guilds import update_guild, snapshot_hash, sync_guilds
+from abode.db.channels import delete_channel
+
+
+def fake_channel(id, name="general", type=0):
+    return SimpleNamespace(id=id, type=SimpleNamespace(value=type), name=name)
+
+
+def fake_emoji(id, name="blob"):
+    return SimpleNamespace(
+        id=id,
+        guild=SimpleNamespace(id=1),
+        user=None,
+        name=name,
+        require_colons=True,
+        managed=False,
+        animated=False,
+        roles=[],
+        created_at=datetime(2020, 1, 1),
+    )
+
+
+def fake_member(id):
+    return SimpleNamespace(id=id)
+
+
+def fake_guild(id=1, name="abode", channels=(), emojis=(), members=()):
+    return SimpleNamespace(
+        id=id,
+        owner_id=2,
+        name=name,
+        region="us-west",
+        icon=None,
+        features=[],
+        banner=None,
+        description=None,
+        splash=None,
+        discovery_splash=None,
+        premium_tier=0,
+        premium_subscription_count=0,
+        channels=list(channels),
+        emojis=list(emojis),
+        members=list(members),
+    )
+
+
+def record_upserts(monkeypatch, *modules):
+    upserted = []
+
+    async def upsert_entity(instance, conn=None):
+        upserted.append(instance)
+
+    for module in modules:
+        monkeypatch.setattr(module, "upsert_entity", upsert_entity)
+    return upserted
+
+
+def test_update_guild_only_writes_the_guild(monkeypatch, conn):
+    upserted = record_upserts(monkeypatch, guilds, emoji)
+
+    after = fake_guild(channels=[fake_channel(10)])
+    before = copy.copy(after)
+    asyncio.run(update_guild(before, after, conn=conn))
+    assert upserted == []
+
+    # Like discord.py, the copy shares its channels with the updated guild
+    before = copy.copy(after)
+    after.name = "home"
+    after.channels[0].name = "renamed"
+    asyncio.run(update_guild(before, after, conn=conn))
+
+    (guild,) = upserted
+    assert (guild.id, guild.name) == (1, "home")
+
+    # The stored snapshot no longer describes the guild
+    assert conn.queries() == [
+        ("DELETE FROM guild_snapshots WHERE guild_id = $1", (1,))
+    ] * 2
+
+
+def test_delete_channel(monkeypatch):
+    upserted = record_upserts(monkeypatch, channels)
+
+    asyncio.run(delete_channel(fake_channel(10), conn=object()))
+    (channel,) = upserted
+    assert (channel.id, channel.name, channel.deleted) == (10, None, True)
+
+
+def full_guild(**kwargs):
+    return fake_guild(
+        **{
+            "channels": [fake_channel(10), fake_channel(11)],
+            "emojis": [fake_emoji(20)],
+            "members": [fake_member(30), fake_member(31)],
+            **kwargs,
+        }
+    )
+
+
+def test_snapshot_hash_is_stable():
+    assert snapshot_hash(full_guild()) == snapshot_hash(full_guild())
+
+    # Only the contents matter, not the order discord gives them to us in
+    reordered = full_guild(
+        channels=[fake_channel(11), fake_channel(10)],
+        members=[fake_member(31), fake_member(30)],
+    )
+    assert snapshot_hash(reordered) == snapshot_hash(full_guild())
+
+
+def test_snapshot_hash_changes():
+    base = snapshot_hash(full_guild())
+    changed = [
+        full_guild(name="home"),
+        full_guild(channels=[fake_channel(10), fake_channel(11, type=2)]),
+        full_guild(channels=[fake_channel(10)]),
+        full_guild(emojis=[fake_emoji(20, name="blobcat")]),
+        full_guild(emojis=[]),
+        full_guild(members=[fake_member(30)]),
+        full_guild(members=[fake_member(30), fake_member(31), fake_member(32)]),
+    ]
+    hashes = [snapshot_hash(guild) for guild in changed]
+    assert base not in hashes
+    assert len(set(hashes)) == len(hashes)
+
+    assert snapshot_hash(full_guild(), True) != snapshot_hash(full_guild(), False)
+
+
+def test_sync_guilds_skips_unchanged(monkeypatch):
+    unchanged, changed, new = full_guild(id=1), full_guild(id=2), full_guild(id=3)
+    stored = {1: snapshot_hash(unchanged, True), 2: "stale"}
+
+    async def get_snapshot_hashes(guild_ids):
+        return {id: stored[id] for id in guild_ids if id in stored}
+
+    synced = []
+
+    async def upsert_guild(guild, is_currently_joined=None, force_members=False):
+        synced.append(guild.id)
+
+    async def save_snapshot_hash(guild_id, hash):
+        stored[guild_id] = hash
+
+    monkeypatch.setattr(guilds, "get_snapshot_hashes", get_snapshot_hashes)
+    monkeypatch.setattr(guilds, "upsert_guild", upsert_guild)
+    monkeypatch.setattr(guilds, "save_snapshot_hash", save_snapshot_hash)
+
+    asyncio.run(sync_guilds([unchanged, changed, new], is_currently_joined=True))
+    assert sorted(synced) == [2, 3]
+    assert stored[2] == snapshot_hash(changed, True)
+
+    # Once synced, nothing is written again until something changes
+    synced.clear()
+    asyncio.run(sync_guilds([unchanged, changed, new], is_currently_joined=True))
+    assert synced == []
+
+
+def test_sync_after_remove_and_rejoin(monkeypatch, pool):
+    monkeypatch.setattr(db, "get_pool", lambda name="ingest": pool)
+    upserted = record_upserts(monkeypatch, guilds)
+    stored = {}
+
+    async def get_snapshot_hashes(guild_ids):
+        return {id: stored[id] for id in guild_ids if id in stored}
+
+    async def save_snapshot_hash(guild_id, hash):
+        stored[guild_id] = hash
+
+    async def clear_snapshot_hash(guild_id, conn=None):
+        stored.pop(guild_id, None)
+
+    async def noop(*args, **kwargs):
+        pass
+
+    monkeypatch.setattr(guilds, "get_snapshot_hashes", get_snapshot_hashes)
+    monkeypatch.setattr(guilds, "save_snapshot_hash", save_snapshot_hash)
+    monkeypatch.setattr(guilds, "clear_snapshot_hash", clear_snapshot_hash)
+    monkeypatch.setattr(guilds, "sync_guild_members", noop)
+    monkeypatch.setattr(channels, "upsert_channels", noop)
+    monkeypatch.setattr(emoji, "upsert_emojis", noop)
+
+    guild = full_guild()
+    asyncio.run(guilds.sync_guilds([guild], is_currently_joined=True))
+    assert [i.is_currently_joined for i in upserted] == [True]
+    assert 1 in stored
+
+    # Removed, then rejoined (e.g. while we were offline) without any changes
+    asyncio.run(guilds.upsert_guild(guild, is_currently_joined=False))
+    assert 1 not in stored
+
+    asyncio.run(guilds.sync_guilds([guild], is_currently_joined=True))
+    assert [i.is_currently_joined for i in upserted] == [True, False, True]
+    assert stored[1] == snapshot_hash(guild, True)
@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+from datetime import datetime
+from abode.lib import fastjson
+from abode.db import entity_cache
+from abode.db.messages import (
+    Message,
+    get_last_message_ids,
+    insert_message,
+    update_messages,
+)
+from abode.db.users import User
+from .test_codecs import RECORD
+
+
+def test_update_messages_binds_embeds_as_text(conn):
+    embeds = [{"type": "rich", "fields": [{"name": "a", "value": "b"}]}]
+    asyncio.run(
+        update_messages(
+            {
+                1: {"content": "a", "edited_timestamp": "2020-01-01T00:00:00+00:00"},
+                2: {"embeds": embeds},
+                3: {"embeds": []},
+            },
+            conn=conn,
+        )
+    )
+
+    ((query, (ids, contents, bound_embeds, edited_ats)),) = conn.queries()
+    assert "$3::text[]" in query
+    assert "embeds::jsonb" in query
+    assert ids == [1, 2, 3]
+    assert contents == ["a", None, None]
+
+    # One JSON document per edit, rather than nested lists asyncpg would treat as
+    #   extra array dimensions
+    assert bound_embeds == [None, fastjson.dumps(embeds), "[]"]
+    assert fastjson.loads(bound_embeds[1]) == embeds
+    assert edited_ats[0].replace(tzinfo=None) == datetime(2020, 1, 1)
+    assert edited_ats[1:] == [None, None]
+
+
+def test_insert_message_updates_rollups(monkeypatch, conn):
+    message = Message.from_record(RECORD)
+    user = User(
+        id=3, name="blob", discriminator=1, avatar=None, bot=False, system=False
+    )
+    monkeypatch.setattr(Message, "from_discord", classmethod(lambda cls, m: message))
+    monkeypatch.setattr(User, "from_discord", classmethod(lambda cls, u: user))
+    monkeypatch.setattr(entity_cache, "is_unchanged", lambda instance: False)
+    monkeypatch.setattr(entity_cache, "remember", lambda instance: None)
+
+    asyncio.run(
+        insert_message(SimpleNamespace(author=None), conn=conn)
+    )
+
+    copied = conn.queries("copy")
+    assert [table for table, _ in copied] == ["_staging_users", "_staging_messages"]
+    assert copied[1][1] == [Message.codec().encode(message)]
+    assert any("INSERT INTO message_counts_daily" in q for q, _ in conn.queries())
+
+
+def test_get_last_message_ids(conn):
+    conn.records = [{"id": 1, "last_id": 50}, {"id": 2, "last_id": None}]
+    last_ids = asyncio.run(get_last_message_ids([1, 2], conn=conn))
+
+    # Channels without any archived messages are left out
+    assert last_ids == {1: 50}
+    ((query, (channel_ids,)),) = conn.queries("fetch")
+    assert channel_ids == [1, 2]
@@ -0,0 +1,56 @@
+import pytest
+from abode.db.migrations import (
+    Migration,
+    MigrationError,
+    load_migrations,
+    pending_migrations,
+)
+
+
+def test_schema_migrations_are_ordered():
+    migrations = load_migrations()
+    versions = [migration.version for migration in migrations]
+    assert versions == sorted(versions)
+    assert versions[0] == 1
+    assert all(migration.transactional for migration in migrations)
+
+
+def test_load_migrations(tmp_path):
+    (tmp_path / "0002_second.sql").write_text("SELECT 2;")
+    (tmp_path / "0001_first.sql").write_text("SELECT 1;")
+    (tmp_path / "notes.txt").write_text("not a migration")
+
+    migrations = load_migrations(tmp_path)
+    assert [(i.version, i.name) for i in migrations] == [(1, "first"), (2, "second")]
+
+    (tmp_path / "0002_duplicate.sql").write_text("SELECT 2;")
+    with pytest.raises(MigrationError):
+        load_migrations(tmp_path)
+
+
+def test_no_transaction_statements():
+    migration = Migration(
+        3,
+        "concurrent_index",
+        "-- abode:no-transaction\n"
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS a ON t (a);\n"
+        "-- a comment; with a semicolon\n"
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS b\n"
+        "    ON t (b);\n",
+    )
+    assert not migration.transactional
+    assert list(migration.statements()) == [
+        "-- abode:no-transaction\nCREATE INDEX CONCURRENTLY IF NOT EXISTS a ON t (a)",
+        "-- a comment; with a semicolon\nCREATE INDEX CONCURRENTLY IF NOT EXISTS b\n    ON t (b)",
+    ]
+
+
+def test_pending_migrations():
+    first = Migration(1, "first", "SELECT 1;")
+    second = Migration(2, "second", "SELECT 2;")
+
+    assert pending_migrations([first, second], {1: first.checksum}) == [second]
+    assert pending_migrations([first, second], {}) == [first, second]
+
+    with pytest.raises(MigrationError):
+        pending_migrations([first, second], {1: "modified"})
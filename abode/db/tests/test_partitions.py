@@ -0,0 +1,16 @@
+from abode.db.partitions import retarget_index
+
+
+def test_retarget_index():
+    assert retarget_index(
+        "CREATE INDEX messages_content_trgm ON public.messages USING gin (content gin_trgm_ops)",
+        "messages_content_trgm_partitioned",
+        "messages_partitioned",
+    ) == (
+        "CREATE INDEX IF NOT EXISTS messages_content_trgm_partitioned ON "
+        "messages_partitioned USING gin (content gin_trgm_ops)"
+    )
+
+    assert retarget_index(
+        "CREATE UNIQUE INDEX a ON public.messages USING btree (channel_id, id)", "b", "c"
+    ) == "CREATE UNIQUE INDEX IF NOT EXISTS b ON c USING btree (channel_id, id)"
@@ -0,0 +1,61 @@
+import asyncio
+import asyncpg
+from abode.db import create_named_pool
+
+
+def create_pools(monkeypatch, name, config):
+    created = []
+
+    async def create_pool(**kwargs):
+        created.append(kwargs)
+        return kwargs["dsn"]
+
+    monkeypatch.setattr(asyncpg, "create_pool", create_pool)
+    result = asyncio.run(
+        create_named_pool(name, config)
+    )
+    return result, created
+
+
+def test_search_pool_settings(monkeypatch):
+    config = {
+        "postgres_dsn": "postgres://primary",
+        "pools": {
+            "search": {
+                "max_size": 3,
+                "work_mem": "64MB",
+                "replica_dsns": ["postgres://a", "postgres://b"],
+            }
+        },
+    }
+    pools, created = create_pools(monkeypatch, "search", config)
+
+    assert pools == ["postgres://a", "postgres://b"]
+    assert created[0]["max_size"] == 3
+    assert created[0]["server_settings"] == {
+        "application_name": "abode-search",
+        "statement_timeout": "60s",
+        "work_mem": "64MB",
+    }
+    assert not created[0]["init"].keywords["prepare_ingest"]
+    assert not created[0]["init"].keywords["jsonb_passthrough"]
+
+
+def test_ingest_pool_defaults(monkeypatch):
+    pools, created = create_pools(
+        monkeypatch, "ingest", {"postgres_dsn": "postgres://primary"}
+    )
+
+    assert pools == ["postgres://primary"]
+    assert created[0]["server_settings"] == {"application_name": "abode-ingest"}
+    assert created[0]["init"].keywords["prepare_ingest"]
+
+
+def test_jsonb_passthrough_is_search_only(monkeypatch):
+    config = {"postgres_dsn": "postgres://primary", "jsonb_passthrough": True}
+
+    _, created = create_pools(monkeypatch, "search", config)
+    assert created[0]["init"].keywords["jsonb_passthrough"]
+
+    _, created = create_pools(monkeypatch, "ingest", config)
+    assert not created[0]["init"].keywords["jsonb_passthrough"]
@@ -0,0 +1,102 @@
+import asyncio
+from abode.db import (
+    build_upsert_query,
+    upsert_entity,
+    bulk_insert,
+    entity_cache,
+    build_insert_query,
+    insert_query_text,
+    entity_upsert_query_text,
+    bulk_query_text,
+    rollup_query_text,
+)
+from abode.db.messages import Message
+from abode.db.users import User
+from abode.db.rollups import HourlyMessageCount
+from .test_codecs import RECORD
+
+
+def test_query_text_is_shared_between_instances():
+    first, args = build_insert_query(Message.from_record(RECORD), ignore_existing=True)
+    second, _ = build_insert_query(Message.from_record(RECORD), ignore_existing=True)
+
+    # Identical text is what lets connections reuse their prepared statements
+    assert first is second
+    assert first == insert_query_text(Message, ignore_existing=True)
+    assert "ON CONFLICT (id) DO NOTHING" in first
+    assert len(args) == len(Message.codec().names)
+
+
+def test_entity_upsert_query_text():
+    query = entity_upsert_query_text(User)
+    assert query is entity_upsert_query_text(User)
+    assert "WHERE id = $1" in query
+
+
+def test_bulk_query_text():
+    staging, create_staging, query = bulk_query_text(User, upsert=True)
+    assert staging == "_staging_users"
+    assert "CREATE TEMP TABLE IF NOT EXISTS _staging_users" in create_staging
+    assert "FROM _staging_users" in query
+
+
+def test_bulk_query_text_updates_rollups():
+    _, _, query = bulk_query_text(Message)
+    assert "RETURNING *" in query
+    assert "INSERT INTO message_counts_daily" in query
+    assert "INSERT INTO message_counts_hourly" in query
+    assert query.count("FROM inserted") == 3
+
+    # Rebuilding recounts from the messages table with the same statement
+    query = rollup_query_text(HourlyMessageCount, "messages")
+    assert "SELECT coalesce(guild_id, 0), date_trunc('hour', created_at)" in query
+    assert "FROM messages" in query
+    assert "ON CONFLICT (guild_id, hour) DO UPDATE" in query
+
+
+def test_build_upsert_query():
+    query = build_upsert_query(User, "VALUES ($1)", "users WHERE id = $1")
+
+    # Unchanged rows are left alone, changed ones diffed field by field
+    assert "WHERE (users.id, users.name" in query
+    assert "IS DISTINCT FROM (excluded.id, excluded.name" in query
+    assert "'users:' || existing.id AS entity_id" in query
+    assert "nextval('changelog_version_seq')" in query
+
+    # A version conflict is an error rather than silently losing changes
+    assert "DO NOTHING" not in query
+
+
+def _user(id, name="blob"):
+    return User(
+        id=id, name=name, discriminator=1, avatar=None, bot=False, system=False
+    )
+
+
+def test_upsert_entity_is_one_statement(monkeypatch, conn):
+    monkeypatch.setattr(entity_cache, "is_unchanged", lambda instance: False)
+    monkeypatch.setattr(entity_cache, "remember", lambda instance: None)
+
+    conn.records = [{"field": "name"}]
+    assert asyncio.run(upsert_entity(_user(1), conn=conn)) == ["name"]
+    ((query, args),) = conn.queries()
+    assert query == entity_upsert_query_text(User)
+    assert args == tuple(User.codec().encode(_user(1)))
+
+
+def test_bulk_upsert_takes_no_advisory_locks(monkeypatch, conn):
+    monkeypatch.setattr(entity_cache, "is_unchanged", lambda instance: False)
+    monkeypatch.setattr(entity_cache, "remember", lambda instance: None)
+
+    # Far more entities than the shared lock table holds with default settings
+    #   (max_locks_per_transaction * max_connections, 6400)
+    users = [_user(id) for id in range(20000)]
+    asyncio.run(bulk_insert(conn, User, users + users[:10], upsert=True))
+
+    (create, _), (copy_table, copied), (query, _) = conn.queries()
+    assert "CREATE TEMP TABLE" in create
+    assert copy_table == "_staging_users" and len(copied) == 20000
+    assert query == bulk_query_text(User, upsert=True)[2]
+    assert "ORDER BY id" in query
+    assert "pg_advisory" not in query
+    assert conn.events[0] == "begin" and conn.events[-1] == "commit"
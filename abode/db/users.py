@@ -1,14 +1,7 @@
 from dataclasses import dataclass
 from typing import Optional
 from datetime import datetime
-from . import (
-    with_conn,
-    build_insert_query,
-    build_select_query,
-    JSONB,
-    Snowflake,
-    BaseModel,
-)
+from . import upsert_entity, Snowflake, BaseModel
 
 
 @dataclass
@@ -34,18 +27,5 @@ class User(BaseModel):
         )
 
 
-@with_conn
-async def upsert_user(conn, user):
-    user = User.from_discord(user)
-
-    # TODO: calculate diff
-    existing_user = await conn.fetchrow(build_select_query(user, "id = $1"), user.id)
-
-    query, args = build_insert_query(user, upsert=True)
-    await conn.execute(query, *args)
-
-    if existing_user is not None:
-        existing_user = User.from_record(existing_user)
-        diff = list(user.diff(existing_user))
-        if diff:
-            print(f"[user] diff is {diff}")
+async def upsert_user(user, conn=None):
+    await upsert_entity(User.from_discord(user), conn=conn)
@@ -1,8 +1,17 @@
-import asyncio
-from abode.db.guilds import upsert_guild
-from abode.db.messages import insert_message
-from abode.db.channels import upsert_channel
-from abode.backfill import backfill_channel, backfill_guild
+from abode.db import entity_cache
+from abode.db.guilds import upsert_guild, update_guild, sync_guilds
+from abode.db.emoji import update_emojis
+from abode.db.users import upsert_user
+from abode.ingest import get_ingest_queue
+from abode.archive import get_archive
+from abode.db.channels import upsert_channel, upsert_channels, delete_channel
+from abode.backfill import (
+    backfill_channel,
+    backfill_channels,
+    backfill_guild,
+    fill_gaps,
+)
+from discord import TextChannel
 
 
 async def backfill(client, message, args):
@@ -30,8 +39,7 @@ async def backfillg(client, message, args):
 
 async def backfilldms(client, message, args):
     await message.add_reaction(client.get_emoji(580596825128697874))
-    for channel in client.private_channels:
-        await backfill_channel(channel)
+    await backfill_channels(client.private_channels)
 
 
 commands = {"backfill": backfill, "backfillg": backfillg, "backfilldms": backfilldms}
@@ -40,11 +48,25 @@ commands = {"backfill": backfill, "backfillg": backfillg, "backfilldms": backfil
 async def on_ready(client):
     print("Connected!")
 
-    await asyncio.wait([upsert_channel(channel) for channel in client.private_channels])
+    await upsert_channels(client.private_channels)
+    await sync_guilds(client.guilds, is_currently_joined=True)
+
+    # Anything sent while we were disconnected never reached on_message. Resumed
+    #   sessions get missed events replayed by the gateway, so only a fresh
+    #   READY needs this.
+    await fill_gaps(_readable_channels(client))
+    print(f"Synced, {entity_cache}")
+
 
-    await asyncio.wait(
-        [upsert_guild(guild, is_currently_joined=True) for guild in client.guilds]
-    )
+def _readable_channels(client):
+    yield from client.private_channels
+    for guild in client.guilds:
+        for channel in guild.channels:
+            if (
+                isinstance(channel, TextChannel)
+                and channel.permissions_for(guild.me).read_message_history
+            ):
+                yield channel
 
 
 async def on_guild_join(client, guild):
@@ -52,15 +74,55 @@ async def on_guild_join(client, guild):
 
 
 async def on_guild_update(client, old, new):
-    await upsert_guild(new, is_currently_joined=True)
+    await update_guild(old, new, is_currently_joined=True)
+
+
+async def on_guild_channel_create(client, channel):
+    await upsert_channel(channel)
+
+
+async def on_guild_channel_update(client, before, after):
+    await upsert_channel(after)
+
+
+async def on_guild_channel_delete(client, channel):
+    await delete_channel(channel)
+
+
+async def on_guild_emojis_update(client, guild, before, after):
+    await update_emojis(before, after)
+
+
+async def on_member_join(client, member):
+    await upsert_user(member)
+
+
+async def on_user_update(client, before, after):
+    await upsert_user(after)
 
 
 async def on_guild_remove(client, guild):
     await upsert_guild(guild, is_currently_joined=False)
 
 
+async def on_raw_message_edit(client, payload):
+    get_ingest_queue().put_edit(payload.message_id, payload.data)
+
+
+async def on_raw_message_delete(client, payload):
+    get_ingest_queue().put_deletes([payload.message_id])
+
+
+async def on_raw_bulk_message_delete(client, payload):
+    get_ingest_queue().put_deletes(payload.message_ids)
+
+
+async def on_socket_response(client, payload):
+    get_archive().record(payload)
+
+
 async def on_message(client, message):
-    await insert_message(message)
+    await get_ingest_queue().put_message(message)
 
     if message.author.id == client.user.id:
         if message.content.startswith(";"):
@@ -0,0 +1,314 @@
+"""
+Write-behind ingestion for gateway data. Instead of paying multiple round trips
+per message, incoming rows are buffered in memory and flushed to postgres in
+bulk whenever the buffer fills up or the flush interval elapses. The buffer is
+bounded, once it is full producers wait for the next flush (backpressure), or
+when a spool is configured the buffer is moved to disk and replayed later.
+
+Edits and deletes are buffered separately and coalesced over a longer window, so
+a message edited many times results in a single update and bulk deletes become a
+single statement.
+
+A batch which keeps failing is written in smaller and smaller parts, so rows
+which can never be written (e.g. a NUL byte in their content) end up on their own
+and are moved to a dead letter log instead of holding up everything behind them.
+"""
+import time
+import asyncio
+import asyncpg
+from datetime import datetime
+from .db import get_pool
+from .db.messages import (
+    Message,
+    insert_message_batch,
+    update_messages,
+    delete_messages,
+)
+from .db.users import User
+from .spool import Spool
+from .lib import fastjson
+
+# Failures which say nothing about the rows being written
+TRANSIENT_ERRORS = (
+    OSError,
+    asyncio.TimeoutError,
+    asyncpg.InterfaceError,
+    asyncpg.PostgresConnectionError,
+)
+
+ingest_queue = None
+
+
+def split_batch(batch):
+    """
+    Splits a batch of (messages, users) in half, keeping users with the messages
+    they authored.
+    """
+    messages, users = batch
+    users = {user.id: user for user in users}
+
+    half = len(messages) // 2
+    parts = []
+    for part in (messages[:half], messages[half:]):
+        authors = [users.pop(i.author_id) for i in part if i.author_id in users]
+        parts.append((part, authors))
+
+    parts[0][1].extend(users.values())
+    return parts
+
+
+class IngestQueue:
+    def __init__(
+        self,
+        batch_size=500,
+        flush_interval=1.0,
+        max_pending=10000,
+        flush_timeout=10.0,
+        edit_window=5.0,
+        spool=None,
+        max_retries=3,
+        dead_letter_path=None,
+    ):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.flush_timeout = flush_timeout
+        self.edit_window = edit_window
+        self.spool = spool
+        self.max_retries = max_retries
+        self.dead_letter_path = dead_letter_path
+
+        self._failures = 0
+        self._messages = {}
+        self._users = {}
+        self._edits = {}
+        self._deletes = set()
+        self._changes_flushed_at = time.monotonic()
+        self._flush_wanted = asyncio.Event()
+        self._has_space = asyncio.Event()
+        self._has_space.set()
+        self._task = None
+
+    def __len__(self):
+        return len(self._messages)
+
+    def start(self, loop):
+        self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        # Waiting on the task lets an interrupted flush put its batch back first
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        try:
+            await self.flush()
+            await self.flush_changes()
+        finally:
+            if self.spool is not None:
+                self.spool.seal()
+
+    async def put_message(self, message):
+        while len(self._messages) >= self.max_pending:
+            # The database is behind, rather than blocking the gateway we can
+            #   move the buffer to disk and let the drainer catch up later.
+            if self.spool is not None:
+                self._spill(self._take())
+                break
+
+            self._has_space.clear()
+            self._flush_wanted.set()
+            await self._has_space.wait()
+
+        self._messages[message.id] = Message.from_discord(message)
+        self._users[message.author.id] = User.from_discord(message.author)
+
+        if len(self._messages) >= self.batch_size:
+            self._flush_wanted.set()
+
+    def put_edit(self, message_id, data):
+        """
+        Buffers a raw message edit, repeated edits to the same message within the
+        edit window are merged and written as a single update.
+        """
+        self._deletes.discard(message_id)
+        self._edits.setdefault(message_id, {}).update(data)
+
+    def put_deletes(self, message_ids):
+        for message_id in message_ids:
+            self._edits.pop(message_id, None)
+            self._deletes.add(message_id)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self._flush_wanted.wait(), timeout=self.flush_interval
+                )
+            except asyncio.TimeoutError:
+                pass
+
+            self._flush_wanted.clear()
+
+            # Anything spooled is older than what is buffered, so it goes first.
+            #   A spool which can't be drained doesn't hold up the live buffer.
+            if self.spool:
+                try:
+                    await self.spool.drain(self._write, transient=TRANSIENT_ERRORS)
+                except Exception as e:
+                    print(f"[ingest] failed to drain spool: {e}")
+
+            try:
+                await self.flush()
+
+                if time.monotonic() - self._changes_flushed_at >= self.edit_window:
+                    await self.flush_changes()
+            except Exception as e:
+                print(f"[ingest] failed to flush {len(self)} messages: {e}")
+            finally:
+                if self.spool is not None:
+                    self.spool.sync()
+
+    def _take(self):
+        batch = (list(self._messages.values()), list(self._users.values()))
+        self._messages = {}
+        self._users = {}
+        return batch
+
+    def _spill(self, batch):
+        print(f"[ingest] spooling {len(batch[0])} messages to disk")
+        self.spool.append(batch)
+
+    async def _write(self, batch):
+        messages, users = batch
+        await asyncio.wait_for(
+            insert_message_batch(messages, users), timeout=self.flush_timeout
+        )
+
+    def _requeue(self, batch):
+        if self.spool is not None:
+            self._spill(batch)
+            return
+
+        # Keep the failed batch around for the next attempt, anything that was
+        #   queued in the meantime is newer and wins.
+        messages, users = batch
+        for user in users:
+            self._users.setdefault(user.id, user)
+        for message in messages:
+            self._messages.setdefault(message.id, message)
+
+    def _dead_letter(self, batch, error):
+        messages, users = batch
+        print(f"[ingest] giving up on messages {[i.id for i in messages]}: {error}")
+        if self.dead_letter_path is None:
+            return
+
+        entry = {
+            "failed_at": datetime.utcnow(),
+            "error": repr(error),
+            "messages": [vars(i) for i in messages],
+            "users": [vars(i) for i in users],
+        }
+        with open(self.dead_letter_path, "a") as f:
+            f.write(fastjson.dumps(entry, default=str) + "\n")
+
+    async def _write_isolating(self, batch):
+        """
+        Writes a batch which failed repeatedly by bisecting it until the rows
+        which can't be written are on their own, those are dead lettered. When
+        the database itself fails part way through, whatever is left unwritten
+        is requeued.
+        """
+        parts = [batch]
+        while parts:
+            part = parts.pop()
+            try:
+                await self._write(part)
+            except (*TRANSIENT_ERRORS, asyncio.CancelledError):
+                for unwritten in [part, *parts]:
+                    self._requeue(unwritten)
+                raise
+            except Exception as e:
+                if len(part[0]) <= 1:
+                    self._dead_letter(part, e)
+                else:
+                    parts.extend(reversed(split_batch(part)))
+
+    async def flush(self):
+        if not self._messages and not self._users:
+            return
+
+        if get_pool() is None:
+            return
+
+        batch = self._take()
+        isolating = self._failures >= self.max_retries
+        try:
+            if isolating:
+                await self._write_isolating(batch)
+            else:
+                await self._write(batch)
+            self._failures = 0
+        except (Exception, asyncio.CancelledError):
+            self._failures += 1
+            if not isolating:
+                self._requeue(batch)
+            raise
+        finally:
+            if len(self._messages) < self.max_pending:
+                self._has_space.set()
+
+    async def flush_changes(self):
+        """
+        Writes buffered edits and deletes. This always runs after the messages
+        they refer to have been flushed.
+        """
+        self._changes_flushed_at = time.monotonic()
+        if (not self._edits and not self._deletes) or get_pool() is None:
+            return
+
+        edits, self._edits = self._edits, {}
+        deletes, self._deletes = self._deletes, set()
+        try:
+            await asyncio.wait_for(update_messages(edits), timeout=self.flush_timeout)
+            await asyncio.wait_for(
+                delete_messages(deletes), timeout=self.flush_timeout
+            )
+        except (Exception, asyncio.CancelledError):
+            # Merge back underneath anything which arrived in the meantime
+            for message_id, data in edits.items():
+                if message_id not in self._deletes:
+                    self._edits[message_id] = {**data, **self._edits.get(message_id, {})}
+            self._deletes |= deletes
+            raise
+
+
+def init_ingest(config, loop):
+    global ingest_queue
+
+    opts = config.get("ingest", {})
+    ingest_queue = IngestQueue(
+        batch_size=opts.get("batch_size", 500),
+        flush_interval=opts.get("flush_interval", 1.0),
+        max_pending=opts.get("max_pending", 10000),
+        flush_timeout=opts.get("flush_timeout", 10.0),
+        edit_window=opts.get("edit_window", 5.0),
+        spool=Spool(opts["spool_path"]) if opts.get("spool_path") else None,
+        max_retries=opts.get("max_retries", 3),
+        dead_letter_path=opts.get("dead_letter_path"),
+    )
+    ingest_queue.start(loop)
+
+
+async def close_ingest():
+    if ingest_queue is not None:
+        await ingest_queue.stop()
+
+
+def get_ingest_queue():
+    return ingest_queue
@@ -0,0 +1,97 @@
+"""
+JSON encoding and decoding using the fastest library available (orjson, then
+ujson, falling back to the standard library), along with `RawJSON` which allows
+embedding already encoded JSON (e.g. JSONB straight from postgres) into a
+document without parsing it first.
+"""
+import re
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+if orjson is not None:
+    loads = orjson.loads
+
+    def dumps(obj, default=None):
+        return orjson.dumps(obj, default=default).decode("utf-8")
+
+    def dumpb(obj):
+        return orjson.dumps(obj)
+
+
+elif ujson is not None:
+    loads = ujson.loads
+
+    def dumps(obj, default=None):
+        return ujson.dumps(obj, default=default, ensure_ascii=False)
+
+    def dumpb(obj):
+        return dumps(obj).encode("utf-8")
+
+
+else:
+    loads = json.loads
+
+    def dumps(obj, default=None):
+        return json.dumps(obj, default=default, ensure_ascii=False)
+
+    def dumpb(obj):
+        return dumps(obj).encode("utf-8")
+
+
+class RawJSON:
+    """
+    A value which is already encoded as JSON, `dumps_raw` embeds it as-is.
+    """
+
+    __slots__ = ("encoded",)
+
+    def __init__(self, encoded):
+        self.encoded = encoded
+
+    def __repr__(self):
+        return f"RawJSON({self.encoded!r})"
+
+    def __eq__(self, other):
+        return isinstance(other, RawJSON) and other.encoded == self.encoded
+
+    def __hash__(self):
+        return hash(self.encoded)
+
+    def decode(self):
+        return loads(self.encoded)
+
+
+# Private use codepoint, never produced by postgres or discord in practice
+_PLACEHOLDER = "\ue000raw:"
+_PLACEHOLDER_RE = re.compile('"' + re.escape(_PLACEHOLDER) + r'(\d+)"')
+
+
+def dumps_raw(obj):
+    """
+    Encodes `obj` like `dumps`, splicing the contents of any `RawJSON` values
+    into the output instead of encoding them as strings.
+    """
+    raw = []
+
+    def default(value):
+        if isinstance(value, RawJSON):
+            raw.append(value.encoded)
+            return f"{_PLACEHOLDER}{len(raw) - 1}"
+        raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+    result = dumps(obj, default=default)
+    if not raw:
+        return result
+
+    # Every placeholder is swapped in a single pass over the output
+    return _PLACEHOLDER_RE.sub(lambda match: raw[int(match.group(1))], result)
@@ -8,12 +8,60 @@ From an AST we can then generate a query based on a given model and query option
 This query is returned in a form that can be easily passed to SQL interfaces
 (query, (args...)).
 """
+import re
+import time
+import json
+import base64
+import binascii
 import dataclasses
 import typing
-from abode.db import table_name, JSONB, FTS, Snowflake
+import collections
+from datetime import date, datetime, timedelta
+from abode.db import (
+    table_name,
+    compile_converter,
+    JSONB,
+    FTS,
+    Snowflake,
+    SnowflakeTime,
+    TimeBucket,
+)
+from abode.lib.snowflake import (
+    datetime_to_snowflake,
+    next_month,
+    DISCORD_EPOCH,
+    TIMESTAMP_SHIFT,
+)
 
 JOINERS = ("AND", "OR")
 
+# Date formats accepted when querying datetime fields, along with a function
+#   returning the end of the period a date in that format covers.
+TIME_PERIOD_FORMATS = (
+    ("%Y", lambda start: start.replace(year=start.year + 1)),
+    ("%Y-%m", next_month),
+    ("%Y-%m-%d", lambda start: start + timedelta(days=1)),
+    ("%Y-%m-%dT%H", lambda start: start + timedelta(hours=1)),
+    ("%Y-%m-%d %H:%M", lambda start: start + timedelta(minutes=1)),
+)
+
+# Relative durations (e.g. `after:7d`) are measured back from the current time
+DURATION_RE = re.compile(r"^(\d+)(min|h|d|w|mo|y)$")
+DURATION_UNITS = {
+    "min": timedelta(minutes=1),
+    "h": timedelta(hours=1),
+    "d": timedelta(days=1),
+    "w": timedelta(weeks=1),
+    "mo": timedelta(days=30),
+    "y": timedelta(days=365),
+}
+
+# Labels which filter on the time an entity was created at, through its id
+TIME_OPERATORS = ("before", "after", "during")
+
+# Bucket sizes for the `histogram` pipeline stage
+HISTOGRAM_UNITS = ("hour", "day", "week", "month", "year")
+
 
 class QueryParser:
     def __init__(self, query_string):
@@ -60,7 +108,7 @@ class QueryParser:
         parts = ""
         while True:
             char = self._peek_char()
-            if char in (" ", ":", "=", '"', "(", ")", "/", None):
+            if char in (" ", ":", "=", '"', "(", ")", "/", "|", None):
                 return parts
             parts += self._next_char()
 
@@ -80,6 +128,8 @@ class QueryParser:
                 if any(i["type"] != "symbol" for i in value):
                     raise Exception("only symbols are allowed in a returns section")
                 return {"type": "return", "value": value}
+            elif char == "|":
+                return {"type": "pipe", "value": self._parse_stage()}
             elif char == " ":
                 continue
             elif char == "/":
@@ -111,6 +161,21 @@ class QueryParser:
 
                 return {"type": "symbol", "value": symbol}
 
+    def _parse_stage(self):
+        parts = []
+        while True:
+            char = self._peek_char()
+            if char is None or char == "|":
+                return parts
+            elif char == " ":
+                self._next_char()
+                continue
+
+            symbol = self._parse_symbol()
+            if not symbol:
+                raise Exception(f"unexpected `{char}` in pipeline stage")
+            parts.append({"type": "symbol", "value": symbol})
+
     def _parse(self):
         parts = []
 
@@ -147,7 +212,7 @@ class QueryParser:
             # Injects 'AND' in between bare non-joiners
             if (
                 (node["type"] != "symbol" or node["value"] not in JOINERS)
-                and node["type"] != "return"
+                and node["type"] not in ("return", "pipe")
                 and previous_node
                 and (
                     previous_node["type"] != "symbol"
@@ -206,6 +271,15 @@ def resolve_model_field(field_name, model, allow_virtual=False):
 
     for field in dataclasses.fields(model):
         if field.name == field_name:
+            if field.name in model._snowflake_times:
+                # Queried through the snowflake so postgres can use the primary key
+                #   index, and prune partitions on the messages table.
+                return (
+                    f"{table_name(model)}.{model._snowflake_times[field.name]}",
+                    SnowflakeTime(field.type),
+                    {},
+                )
+
             if field.name in model._fts:
                 return (
                     f"{table_name(model)}.{field.name}",
@@ -213,10 +287,131 @@ def resolve_model_field(field_name, model, allow_virtual=False):
                     {},
                 )
 
+            if model._time_bucket and field.name == model._time_bucket[0]:
+                return (
+                    f"{table_name(model)}.{field.name}",
+                    TimeBucket(field.type, model._time_bucket[1]),
+                    {},
+                )
+
             return f"{table_name(model)}.{field.name}", field.type, {}
     raise Exception(f"no such field on {model}: `{field_name}``")
 
 
+def _parse_time_period(value):
+    """
+    Parses a date with a precision anywhere from a year to a minute into the
+    half open range of time it covers.
+
+    >>> _parse_time_period("2020-05")
+    (datetime(2020, 5, 1), datetime(2020, 6, 1))
+    """
+    for fmt, period_end in TIME_PERIOD_FORMATS:
+        try:
+            start = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return start, period_end(start)
+    raise Exception(f"invalid date: `{value}`")
+
+
+def _utcnow():
+    return datetime.utcnow()
+
+
+def _parse_time_bounds(value, time_op="during"):
+    """
+    Returns the (start, end) bounds of a half open time range for one of the
+    `TIME_OPERATORS` applied to either a date (see `_parse_time_period`) or a
+    relative duration, either bound may be None.
+
+    >>> _parse_time_bounds("2020-05", "after")
+    (datetime(2020, 6, 1), None)
+    """
+    match = DURATION_RE.match(value)
+    if match:
+        point = _utcnow() - int(match.group(1)) * DURATION_UNITS[match.group(2)]
+        if time_op == "before":
+            return None, point
+        return point, None
+
+    start, end = _parse_time_period(value)
+    if time_op == "before":
+        return None, start
+    elif time_op == "after":
+        return end, None
+    return start, end
+
+
+def _is_time_type(field_type):
+    if isinstance(field_type, (SnowflakeTime, TimeBucket)):
+        return True
+    if typing.get_origin(field_type) is typing.Union:
+        field_type = next(i for i in typing.get_args(field_type) if i != type(None))
+    return field_type == datetime
+
+
+def _compile_time_filter(field, field_type, start, end, varidx):
+    """
+    Compiles a filter matching the half open time range [start, end), either
+    bound may be None. Fields which are the creation time of a snowflake are
+    compiled to a range over the snowflake instead.
+
+    Returns a tuple of the where clause, variables, and the new varidx.
+    """
+    bounds = []
+    if isinstance(field_type, TimeBucket):
+        for bound in (start, end):
+            if bound is not None and not _is_bucket_aligned(bound, field_type.unit):
+                raise Exception(f"time range is finer than a {field_type.unit}")
+
+    if isinstance(field_type, SnowflakeTime):
+        if start is not None:
+            bounds.append((">=", datetime_to_snowflake(start)))
+        if end is not None:
+            bounds.append(("<=", datetime_to_snowflake(end) - 1))
+    else:
+        if start is not None:
+            bounds.append((">=", start))
+        if end is not None:
+            bounds.append(("<", end))
+
+    if len(bounds) == 2 and isinstance(field_type, SnowflakeTime):
+        where = f"{field} BETWEEN ${varidx + 1} AND ${varidx + 2}"
+    else:
+        where = " AND ".join(
+            f"{field} {op} ${varidx + idx}" for idx, (op, _) in enumerate(bounds, 1)
+        )
+        if len(bounds) > 1:
+            where = f"({where})"
+
+    return where, [value for _, value in bounds], varidx + len(bounds)
+
+
+def _is_bucket_aligned(dt, unit):
+    truncated = dt.replace(minute=0, second=0, microsecond=0)
+    if unit == "day":
+        truncated = truncated.replace(hour=0)
+    return dt == truncated
+
+
+def _compile_field_filter(field, field_type, token, varidx):
+    """
+    Compiles a single token against a given field into a filter, returning a
+    tuple of the where clause, variables, and the new varidx.
+    """
+    if _is_time_type(field_type):
+        if DURATION_RE.match(token["value"]):
+            # Depends on the current time, so the result can't be cached
+            token["relative"] = True
+        start, end = _parse_time_bounds(token["value"], token.get("time_op", "during"))
+        return _compile_time_filter(field, field_type, start, end, varidx)
+
+    varidx += 1
+    field, op, arg, var = _compile_field_query_op(field, field_type, token, varidx)
+    return f"{field} {op} {var}", [arg], varidx
+
+
 def _compile_field_query_op(field, field_type, token, varidx):
     """
     Compiles a single token against a given field type into a single query filter.
@@ -249,8 +444,10 @@ def _compile_field_query_op(field, field_type, token, varidx):
         (inner,) = typing.get_args(field_type)
 
         if typing.get_origin(inner) == list:
+            # Bound through the jsonb codec, so the element has to be converted to
+            #   the type stored in the array for containment to match.
             (type_fn,) = typing.get_args(inner)
-            return (field, "@>", type_fn(token["value"]), var)
+            return (field, "@>", [type_fn(token["value"])], var)
 
         assert False
     elif field_type == Snowflake:
@@ -313,7 +510,19 @@ def _compile_token_for_query(token, model, field=None, field_type=None, varidx=0
     """
 
     if token["type"] == "label":
-        field, field_type, field_joins = resolve_model_field(token["name"], model)
+        if token["name"] in TIME_OPERATORS and model._time_bucket:
+            field, field_type, field_joins = resolve_model_field(
+                model._time_bucket[0], model
+            )
+            token["value"]["time_op"] = token["name"]
+        elif token["name"] in TIME_OPERATORS:
+            # Snowflakes encode their creation time, so this is a range over the pk
+            field = f"{table_name(model)}.{model._pk}"
+            field_type = SnowflakeTime(datetime)
+            field_joins = {}
+            token["value"]["time_op"] = token["name"]
+        else:
+            field, field_type, field_joins = resolve_model_field(token["name"], model)
         token["value"]["exact"] = token["exact"]
         where, variables, joins, varidx, returns = _compile_token_for_query(
             token["value"], model, field=field, field_type=field_type, varidx=varidx
@@ -324,18 +533,18 @@ def _compile_token_for_query(token, model, field=None, field_type=None, varidx=0
         if token["value"] in ("AND", "OR", "NOT"):
             return (token["value"], [], {}, varidx, None)
         elif field:
-            varidx += 1
-            field, op, arg, var = _compile_field_query_op(
+            where, variables, varidx = _compile_field_filter(
                 field, field_type, token, varidx
             )
-            return (f"{field} {op} {var}", [arg], {}, varidx, None)
+            return (where, variables, {}, varidx, None)
         else:
             joins = _compile_model_refs_join(model, token["value"])
             return (f"true", [], joins, varidx, None)
     elif token["type"] == "string" and field:
-        varidx += 1
-        field, op, arg, var = _compile_field_query_op(field, field_type, token, varidx)
-        return (f"{field} {op} {var}", [arg], {}, varidx, None)
+        where, variables, varidx = _compile_field_filter(
+            field, field_type, token, varidx
+        )
+        return (where, variables, {}, varidx, None)
     elif token["type"] == "regex" and field:
         varidx += 1
         op = "~"
@@ -354,6 +563,8 @@ def _compile_token_for_query(token, model, field=None, field_type=None, varidx=0
         joins = {}
         for child_token in token["value"]:
             child_token["exact"] = token.get("exact", False)
+            if "time_op" in token:
+                child_token["time_op"] = token["time_op"]
             (
                 where_part,
                 variables_part,
@@ -374,10 +585,232 @@ def _compile_token_for_query(token, model, field=None, field_type=None, varidx=0
         assert False
 
 
-def _compile_selector(model):
-    return ", ".join(
-        f"{table_name(model)}.{field.name}" for field in dataclasses.fields(model)
+def encode_cursor(order_by, order_dir, key, id):
+    """
+    Encodes the position after a row (its sort key and primary key) in an ordered
+    result set as an opaque token, see `_compile_seek`. Keys which JSON has no
+    type for (e.g. a Decimal) are encoded as strings.
+    """
+    if isinstance(key, (datetime, date)):
+        key = key.isoformat()
+    data = json.dumps({"o": order_by, "d": order_dir, "k": key, "i": id}, default=str)
+    return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token):
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        return data["o"], data["d"], data["k"], data["i"]
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise Exception("invalid cursor")
+
+
+class Param:
+    """
+    Stands in for a value which changes between pages of a query (its cursor,
+    limit and offset) within the variables of a compiled query, so compiled
+    queries can be cached without them. See `compile_query`.
+    """
+
+    __slots__ = ("name", "convert")
+
+    def __init__(self, name, convert=None):
+        self.name = name
+        self.convert = convert
+
+    def __repr__(self):
+        return f"Param({self.name!r})"
+
+    def bind(self, params):
+        value = params[self.name]
+        if self.convert is not None and value is not None:
+            value = self.convert(value)
+        return value
+
+
+def _is_nullable(field_type):
+    if isinstance(field_type, (FTS, SnowflakeTime, TimeBucket)):
+        field_type = field_type.inner
+    if typing.get_origin(field_type) is not typing.Union:
+        return False
+    return type(None) in typing.get_args(field_type)
+
+
+def _compile_seek(field, field_type, pk_field, order_dir, key, id, varidx):
+    """
+    Compiles a seek predicate matching every row after the row with the given
+    sort key and primary key, in the order given by `order_dir`. Unlike an OFFSET
+    this lets postgres start reading right at the position of the cursor. `key`
+    and `id` are `Param`s, or `key` is None for a row without a sort key.
+
+    Returns a tuple of the where clause, variables, and the new varidx.
+    """
+    op = ">" if order_dir == "ASC" else "<"
+
+    if field == pk_field:
+        return f"{pk_field} {op} ${varidx + 1}", [id], varidx + 1
+
+    if _is_time_type(field_type) and key is not None:
+        key = Param(key.name, datetime.fromisoformat)
+
+    if not _is_nullable(field_type):
+        return (
+            f"({field}, {pk_field}) {op} (${varidx + 1}, ${varidx + 2})",
+            [key, id],
+            varidx + 2,
+        )
+
+    # NULLs sort after everything else ascending, and before everything descending
+    if key is None:
+        where = f"({field} IS NULL AND {pk_field} {op} ${varidx + 1})"
+        if order_dir == "DESC":
+            where = f"({where[1:-1]} OR {field} IS NOT NULL)"
+        return where, [id], varidx + 1
+
+    where = (
+        f"({field} {op} ${varidx + 1} OR ({field} = ${varidx + 1} AND "
+        f"{pk_field} {op} ${varidx + 2})"
+    )
+    if order_dir == "ASC":
+        where += f" OR {field} IS NULL"
+    return where + ")", [key, id], varidx + 2
+
+
+class Aggregation:
+    """
+    The output columns of a query with a pipeline stage, which selects aggregated
+    values rather than models. Takes the place of the return fields. `rollup` is
+    the rollup model the query was answered from, if any.
+    """
+
+    def __init__(self, fields, converters, rollup=None):
+        self.fields = tuple(fields)
+        self.converters = tuple(converters)
+        self.rollup = rollup
+
+    def __repr__(self):
+        return f"Aggregation{self.fields!r}"
+
+    def __eq__(self, other):
+        return isinstance(other, Aggregation) and other.fields == self.fields
+
+    def __hash__(self):
+        return hash(self.fields)
+
+
+def _compile_group_fields(name, model):
+    """
+    Resolves a field to group by, yielding tuples of the output name, field,
+    field type and joins. A bare reference (e.g. `channel`) groups by the
+    referenced models id and, where it has one, name.
+    """
+    names = [name]
+    if name in model._refs:
+        ref_model = model._refs[name][0]
+        names = [f"{name}.{ref_model._pk}"]
+        if "name" in ref_model.codec().names:
+            names.append(f"{name}.name")
+
+    for name in names:
+        field, field_type, joins = resolve_model_field(name, model)
+        if isinstance(field_type, (SnowflakeTime, TimeBucket)):
+            raise Exception(f"cannot group by `{name}`, use `histogram` instead")
+        if isinstance(field_type, FTS):
+            field_type = field_type.inner
+        yield name, field, field_type, joins
+
+
+def _compile_time_bucket(model, unit):
+    """
+    Returns an expression truncating the creation time of a model to `unit`,
+    from its creation time column where it has one and otherwise its snowflake.
+    """
+    if model._time_bucket:
+        column, bucket_unit = model._time_bucket
+        if HISTOGRAM_UNITS.index(unit) < HISTOGRAM_UNITS.index(bucket_unit):
+            raise Exception(f"cannot bucket {table_name(model)} by {unit}")
+        created_at = f"{table_name(model)}.{column}"
+    elif model._snowflake_times:
+        column = next(iter(model._snowflake_times))
+        created_at = f"{table_name(model)}.{column}"
+    else:
+        created_at = (
+            f"to_timestamp((({table_name(model)}.{model._pk} >> {TIMESTAMP_SHIFT}) "
+            f"+ {DISCORD_EPOCH}) / 1000.0) AT TIME ZONE 'utc'"
+        )
+    return f"date_trunc('{unit}', {created_at})"
+
+
+def _compile_pipeline_stage(stage, model):
+    """
+    Compiles a pipeline stage (the symbols following a `|`) into aggregate SQL:
+
+        | count                    total number of matches
+        | count by <field...>      number of matches per distinct value(s)
+        | top <n> <field...>       the n most common values
+        | histogram <unit>         number of matches per hour/day/week/month/year
+
+    Returns a tuple of the selectors, group by clause, order by clause, the
+    `Aggregation` describing the output, joins, and a limit (or None).
+    """
+    name, args = stage[0] if stage else None, stage[1:]
+
+    # Rows of a rollup are counts themselves
+    count = "count(*)"
+    if model._time_bucket:
+        count = f"coalesce(sum({table_name(model)}.message_count), 0)"
+
+    count = (f"{count} AS count", "count", int)
+    groups = []
+    joins = {}
+    limit = None
+    if name == "count" and not args:
+        columns = [count]
+        order_by = ""
+    elif name == "histogram" and len(args) == 1 and args[0] in HISTOGRAM_UNITS:
+        (unit,) = args
+        converter = compile_converter(datetime, to_js=True)
+        columns = [(f"{_compile_time_bucket(model, unit)} AS _bucket", unit, converter)]
+        columns.append(count)
+        groups = [1]
+        order_by = " ORDER BY _bucket ASC"
+    else:
+        if name == "count" and args[:1] == ["by"] and len(args) > 1:
+            fields = args[1:]
+        elif name == "top" and len(args) > 1 and args[0].isdigit():
+            limit = int(args[0])
+            fields = args[1:]
+        else:
+            raise Exception(f"invalid pipeline stage: `{' '.join(stage)}`")
+
+        columns = []
+        for field_name in fields:
+            for output_name, field, field_type, field_joins in _compile_group_fields(
+                field_name, model
+            ):
+                joins.update(field_joins)
+                converter = compile_converter(
+                    typing.Optional[field_type], from_pg=True, to_js=True
+                )
+                selector = f"{field} AS _group_{len(columns)}"
+                columns.append((selector, output_name, converter))
+
+        groups = list(range(1, len(columns) + 1))
+        columns.append(count)
+        order_by = " ORDER BY count DESC"
+
+    selectors = ", ".join(selector for selector, _, _ in columns)
+    group_by = (" GROUP BY " + ", ".join(map(str, groups))) if groups else ""
+    aggregation = Aggregation(
+        [name for _, name, _ in columns],
+        [converter for _, _, converter in columns],
+        rollup=model if model._time_bucket else None,
     )
+    return selectors, group_by, order_by, aggregation, joins, limit
+
+
+def _compile_selector(model):
+    return ", ".join(f"{table_name(model)}.{name}" for name in model.codec().names)
 
 
 def _compile_query_for_model(
@@ -389,11 +822,40 @@ def _compile_query_for_model(
     order_dir="ASC",
     include_foreign_data=False,
     returns=False,
+    keyset=False,
+    cursor=None,
 ):
+    """
+    Compiles a parsed query against a model. With `keyset` the results are
+    always ordered (by the primary key if nothing else), the sort key and
+    primary key of each row are selected as `_cursor_key` and `_cursor_id` for
+    `encode_cursor`, and a `cursor` of (key, id) `Param`s continues after the row
+    they are bound to.
+
+    Queries with a pipeline stage are answered from the first of the models
+    rollups which they compile against, that is which has every field they
+    filter or group on and whose time buckets fit within their time ranges.
+    """
+    if model._rollups and any(token["type"] == "pipe" for token in tokens):
+        for rollup in model._rollups:
+            try:
+                return _compile_query_for_model(
+                    tokens, rollup, limit=limit, offset=offset, returns=returns
+                )
+            except Exception:
+                continue
+
     return_fields = None
+    stage = None
     parts = []
     varidx = 0
     for token in tokens:
+        if token["type"] == "pipe":
+            if stage is not None:
+                raise Exception("only a single pipeline stage is supported")
+            stage = [i["value"] for i in token["value"]]
+            continue
+
         a, b, c, varidx, _returns = _compile_token_for_query(
             token, model, varidx=varidx
         )
@@ -414,16 +876,47 @@ def _compile_query_for_model(
         variables.extend(variables_part)
         joins.update(joins_part)
 
-    if order_by:
-        field, field_type, order_joins = resolve_model_field(order_by, model)
+    cursor_selectors = ""
+    group_by = ""
+    if stage is not None:
+        if return_fields is not None:
+            raise Exception("returns cannot be combined with a pipeline stage")
+
+        # Aggregated rows are not models, so there is no foreign data or cursor
+        selectors, group_by, order_by, return_fields, stage_joins, stage_limit = (
+            _compile_pipeline_stage(stage, model)
+        )
+        joins.update(stage_joins)
+        include_foreign_data = False
+        if stage_limit is not None:
+            limit = stage_limit
+    elif order_by or keyset:
+        pk_field = f"{table_name(model)}.{model._pk}"
+        field, field_type, order_joins = resolve_model_field(
+            order_by or model._pk, model
+        )
         joins.update(order_joins)
         assert order_dir in ("ASC", "DESC")
+
+        # Ties are broken by the primary key so the order is stable between pages
         order_by = f" ORDER BY {field} {order_dir}"
+        if field != pk_field:
+            order_by += f", {pk_field} {order_dir}"
+
+        if keyset:
+            cursor_selectors = f", {field} AS _cursor_key, {pk_field} AS _cursor_id"
+
+        if cursor is not None:
+            seek, seek_variables, varidx = _compile_seek(
+                field, field_type, pk_field, order_dir, *cursor, varidx
+            )
+            where = ["(" + " ".join(where) + ")", "AND", seek] if where else [seek]
+            variables.extend(seek_variables)
     else:
         order_by = ""
 
     models = {model: None}
-    if return_fields:
+    if return_fields and stage is None:
         for field in return_fields:
             _, _, joins_part = resolve_model_field(field, model, allow_virtual=True)
             if joins is not None:
@@ -444,10 +937,11 @@ def _compile_query_for_model(
                 )
                 models[ref_model] = None
 
-    if len(models) > 1:
-        selectors = ", ".join(_compile_selector(model) for model in models.keys())
-    else:
-        selectors = f"{table_name(model)}.*"
+    if stage is None:
+        if len(models) > 1:
+            selectors = ", ".join(_compile_selector(model) for model in models.keys())
+        else:
+            selectors = f"{table_name(model)}.*"
 
     if joins:
         joins = "".join(
@@ -461,17 +955,24 @@ def _compile_query_for_model(
     else:
         where = ""
 
+    # Bound rather than inlined so the query text (and the prepared statement
+    #   postgres plans for it) is shared between pages.
     suffix = []
-    if limit is not None and limit > 0:
-        suffix.append(f" LIMIT {limit}")
+    if limit is not None:
+        varidx += 1
+        variables.append(limit)
+        suffix.append(f" LIMIT ${varidx}")
 
-        if offset is not None and offset > 0:
-            suffix.append(f" OFFSET {offset}")
+        if offset is not None:
+            varidx += 1
+            variables.append(offset)
+            suffix.append(f" OFFSET ${varidx}")
 
     suffix = "".join(suffix)
 
     query = (
-        f"SELECT {selectors} FROM {table_name(model)}{joins}{where}{order_by}{suffix}"
+        f"SELECT {selectors}{cursor_selectors} FROM {table_name(model)}"
+        f"{joins}{where}{group_by}{order_by}{suffix}"
     )
     variables = tuple(variables)
     models = tuple(models.keys())
@@ -481,15 +982,130 @@ def _compile_query_for_model(
     return query, variables, models
 
 
-def compile_query(query, model, **kwargs):
+class QueryCache:
+    """
+    A bounded LRU of compiled queries, keyed by the query string, model and
+    compile options. Compiled queries are tuples of immutable values (with
+    `Param`s in place of per page values), so they are shared between callers.
+    """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        result = self._entries.get(key)
+        if result is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._entries.move_to_end(key)
+        return result
+
+    def put(self, key, result):
+        self._entries[key] = result
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+query_cache = QueryCache()
+
+
+def _has_relative_times(tokens):
+    for token in tokens:
+        if token.get("relative"):
+            return True
+        value = token.get("value")
+        if isinstance(value, dict) and _has_relative_times([value]):
+            return True
+        if isinstance(value, list) and _has_relative_times(value):
+            return True
+    return False
+
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+def compile_query(
+    query, model, timings=None, limit=None, offset=None, cursor=None, **kwargs
+):
+    """
+    Parses and compiles a query (see `_compile_query_for_model` for options),
+    when `timings` is passed the time spent parsing and compiling is recorded
+    into it.
+
+    The `limit`, `offset` and decoded `cursor` (sort key and primary key) are
+    compiled as placeholders and bound afterwards, so every page of a query is
+    served by the same cache entry.
+    """
+    if timings is None:
+        timings = {}
+
+    params = {"limit": limit, "offset": offset}
+    placeholders = {}
+    if limit is not None and limit > 0:
+        placeholders["limit"] = Param("limit")
+        if offset is not None and offset > 0:
+            placeholders["offset"] = Param("offset")
+    if cursor is not None:
+        params["cursor_key"], params["cursor_id"] = cursor
+        placeholders["cursor"] = (
+            Param("cursor_key") if cursor[0] is not None else None,
+            Param("cursor_id"),
+        )
+
+    start = time.perf_counter()
+    key = (
+        query,
+        model,
+        tuple(sorted(kwargs.items())),
+        tuple(sorted(placeholders)),
+        cursor is not None and cursor[0] is None,
+    )
+    result = query_cache.get(key)
+    if result is not None:
+        timings["parse"] = 0
+        timings["compile"] = elapsed_ms(start)
+        timings["cached"] = True
+        return _bind_params(result, params)
+
     tokens = QueryParser.parsed(query)
-    return _compile_query_for_model(tokens, model, **kwargs)
+    timings["parse"] = elapsed_ms(start)
+
+    start = time.perf_counter()
+    result = _compile_query_for_model(tokens, model, **placeholders, **kwargs)
+    if not _has_relative_times(tokens):
+        query_cache.put(key, result)
+    timings["compile"] = elapsed_ms(start)
+    timings["cached"] = False
+    return _bind_params(result, params)
+
+
+def _bind_params(result, params):
+    sql, variables, *rest = result
+    variables = tuple(i.bind(params) if isinstance(i, Param) else i for i in variables)
+    return (sql, variables, *rest)
 
 
 def decode_query_record(record, models):
     idx = 0
     for model in models:
-        num_fields = len(dataclasses.fields(model))
+        num_fields = len(model.codec().names)
         model_data = record[idx : idx + num_fields]
         idx += num_fields
         yield model.from_record(model_data)
@@ -504,66 +1120,67 @@ def _resolve_return_field(model, field):
 
 
 def _get_field_offset(record_offsets, model, field_name):
-    fields = dataclasses.fields(model)
-    offset = record_offsets[model] + [i.name for i in fields].index(field_name)
-    return offset, next(i for i in fields if i.name == field_name)
+    """
+    Returns the offset of a field within a result record, and the compiled
+    converter from its postgres to its JS representation.
+    """
+    codec = model.codec()
+    idx = codec.names.index(field_name)
+    return record_offsets[model] + idx, codec.pg_to_js[idx]
 
 
-def decode_query_results(models, return_fields, results):
-    # TODO: leaky af
-    from abode.db import convert_to_type
+def _column_decoder(offset, convert):
+    return lambda record: convert(record[offset])
+
+
+def _virtual_column_decoder(fn, offsets):
+    return lambda record: fn(*[convert(record[offset]) for offset, convert in offsets])
+
+
+def compile_result_decoder(models, return_fields):
+    """
+    Returns a function decoding a single result record into a row of JS values
+    for the return fields, along with the names of those fields.
+    """
+    if isinstance(return_fields, Aggregation):
+        converters = return_fields.converters
+
+        def decode_aggregate(record):
+            return [converter(value) for converter, value in zip(converters, record)]
+
+        return decode_aggregate, list(return_fields.fields)
 
     # I guess why not
     if return_fields is None:
-        return_fields = [i.name for i in dataclasses.fields(models[0])]
+        return_fields = list(models[0].codec().names)
 
     record_offsets = {}
     idx = 0
     for model in models:
         record_offsets[model] = idx
-        idx += len(dataclasses.fields(model))
+        idx += len(model.codec().names)
 
-    columns = []
+    decoders = []
     for field in return_fields:
         model, field = _resolve_return_field(models[0], field)
         if field in model._virtual_fields:
-            offsets = {}
-            for field_dep in model._virtual_fields[field]:
-                offset, field_dep = _get_field_offset(record_offsets, model, field_dep)
-                offsets[offset] = field_dep
-            columns.append(("virtual", field, offsets, getattr(model, field)))
+            offsets = [
+                _get_field_offset(record_offsets, model, field_dep)
+                for field_dep in model._virtual_fields[field]
+            ]
+            # TODO: typecast based on fn
+            decoders.append(_virtual_column_decoder(getattr(model, field), offsets))
         else:
-            offset, field = _get_field_offset(record_offsets, model, field)
-            columns.append(("offset", field, offset))
-
-    rows = []
-    for result_row in results:
-        row = []
-
-        for column in columns:
-            if column[0] == "offset":
-                field, offset = column[1:]
-                row.append(
-                    convert_to_type(
-                        convert_to_type(result_row[offset], field.type, from_pg=True),
-                        field.type,
-                        to_js=True,
-                    )
-                )
-            elif column[0] == "virtual":
-                field, offsets, fn = column[1:]
-                args = [
-                    convert_to_type(
-                        convert_to_type(result_row[offset], field.type, from_pg=True),
-                        field.type,
-                        to_js=True,
-                    )
-                    for offset, field in offsets.items()
-                ]
-
-                # TODO: typecast based on fn
-                row.append(fn(*args))
-
-        rows.append(row)
-
-    return rows, return_fields
+            decoders.append(
+                _column_decoder(*_get_field_offset(record_offsets, model, field))
+            )
+
+    def decode(record):
+        return [decoder(record) for decoder in decoders]
+
+    return decode, return_fields
+
+
+def decode_query_results(models, return_fields, results):
+    decode, return_fields = compile_result_decoder(models, return_fields)
+    return [decode(record) for record in results], return_fields
@@ -0,0 +1,39 @@
+"""
+Conversions between discord snowflakes and time. The top 42 bits of a snowflake
+are milliseconds since the discord epoch, which lets time bounded queries be
+compiled into id ranges (and partition pruning on the messages table).
+
+Datetimes are naive UTC, matching how they are stored in postgres.
+"""
+from datetime import datetime, timezone, timedelta
+
+DISCORD_EPOCH = 1420070400000
+TIMESTAMP_SHIFT = 22
+
+_UNIX_EPOCH = datetime(1970, 1, 1)
+
+
+def snowflake_to_datetime(snowflake):
+    ms = (int(snowflake) >> TIMESTAMP_SHIFT) + DISCORD_EPOCH
+    return _UNIX_EPOCH + timedelta(milliseconds=ms)
+
+
+def datetime_to_snowflake(dt, high=False):
+    """
+    Returns the lowest snowflake for the millisecond `dt` falls within, or the
+    highest one when `high` is set.
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+
+    ms = (dt - _UNIX_EPOCH) // timedelta(milliseconds=1) - DISCORD_EPOCH
+    snowflake = max(ms, 0) << TIMESTAMP_SHIFT
+    if high:
+        snowflake += (1 << TIMESTAMP_SHIFT) - 1
+    return snowflake
+
+
+def next_month(dt):
+    if dt.month == 12:
+        return datetime(dt.year + 1, 1, 1)
+    return datetime(dt.year, dt.month + 1, 1)
@@ -0,0 +1,28 @@
+from abode.lib.fastjson import RawJSON, dumps, dumps_raw, loads
+
+
+def test_round_trip():
+    value = {"a": [1, 2, {"b": None}], "c": "☃"}
+    assert loads(dumps(value)) == value
+
+
+def test_dumps_raw_embeds_raw_json():
+    body = {
+        "results": [[1, RawJSON('[{"type": "rich"}]')], [2, RawJSON("null")]],
+        "fields": ["id", "embeds"],
+    }
+    assert loads(dumps_raw(body)) == {
+        "results": [[1, [{"type": "rich"}]], [2, None]],
+        "fields": ["id", "embeds"],
+    }
+
+
+def test_dumps_raw_leaves_strings_alone():
+    assert loads(dumps_raw(["raw:0", RawJSON("{}")])) == ["raw:0", {}]
+
+
+def test_dumps_raw_many_values():
+    rows = [[i, RawJSON(f'{{"n": {i}}}'), f"row {i}"] for i in range(1000)]
+    assert loads(dumps_raw({"results": rows})) == {
+        "results": [[i, {"n": i}, f"row {i}"] for i in range(1000)]
+    }
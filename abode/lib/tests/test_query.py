@@ -1,8 +1,20 @@
-from abode.lib.query import QueryParser, compile_query, _compile_selector
+from datetime import datetime
+from abode.lib import query
+from abode.lib.query import (
+    QueryParser,
+    compile_query,
+    _compile_selector,
+    encode_cursor,
+    decode_cursor,
+    decode_query_results,
+    Aggregation,
+)
+from abode.lib.snowflake import datetime_to_snowflake
 from abode.db.guilds import Guild
 from abode.db.messages import Message
 from abode.db.users import User
 from abode.db.channels import Channel
+from abode.db.rollups import DailyMessageCount
 
 
 def test_parse_basic_queries():
@@ -187,8 +199,8 @@ def test_compile_basic_queries():
     )
 
     assert compile_query("", Guild, limit=100, offset=150, order_by="id") == (
-        "SELECT guilds.* FROM guilds ORDER BY guilds.id ASC LIMIT 100 OFFSET 150",
-        (),
+        "SELECT guilds.* FROM guilds ORDER BY guilds.id ASC LIMIT $1 OFFSET $2",
+        (100, 150),
         (Guild,),
     )
 
@@ -283,3 +295,284 @@ def test_compile_complex_queries():
         (),
     )
 
+
+def test_compile_time_queries():
+    may = datetime_to_snowflake(datetime(2020, 5, 1))
+    june = datetime_to_snowflake(datetime(2020, 6, 1))
+
+    assert compile_query("created_at:2020-05", Message) == (
+        "SELECT messages.* FROM messages WHERE messages.id BETWEEN $1 AND $2",
+        (may, june - 1),
+        (Message,),
+    )
+
+    assert compile_query('content:hi created_at:"2020-05-01 12:30"', Message)[1] == (
+        "hi",
+        datetime_to_snowflake(datetime(2020, 5, 1, 12, 30)),
+        datetime_to_snowflake(datetime(2020, 5, 1, 12, 31)) - 1,
+    )
+
+    assert compile_query("edited_at:2020", Message) == (
+        "SELECT messages.* FROM messages WHERE (messages.edited_at >= $1 AND "
+        "messages.edited_at < $2)",
+        (datetime(2020, 1, 1), datetime(2021, 1, 1)),
+        (Message,),
+    )
+
+    assert compile_query("", Message, order_by="created_at", order_dir="DESC") == (
+        "SELECT messages.* FROM messages ORDER BY messages.id DESC",
+        (),
+        (Message,),
+    )
+
+
+def test_compile_time_operators(monkeypatch):
+    may = datetime_to_snowflake(datetime(2020, 5, 1))
+    june = datetime_to_snowflake(datetime(2020, 6, 1))
+
+    assert compile_query("before:2020-05 after:2019", Guild) == (
+        "SELECT guilds.* FROM guilds WHERE guilds.id <= $1 AND guilds.id >= $2",
+        (may - 1, datetime_to_snowflake(datetime(2020, 1, 1))),
+        (Guild,),
+    )
+
+    assert compile_query("during:(2020-05 OR 2020-06-01)", Message) == (
+        "SELECT messages.* FROM messages WHERE (messages.id BETWEEN $1 AND $2 OR "
+        "messages.id BETWEEN $3 AND $4)",
+        (may, june - 1, june, datetime_to_snowflake(datetime(2020, 6, 2)) - 1),
+        (Message,),
+    )
+
+    monkeypatch.setattr(query, "_utcnow", lambda: datetime(2020, 5, 8))
+    assert compile_query("content:hi after:1w", Message)[1] == ("hi", may)
+    assert compile_query("before:7d", Message)[1] == (may - 1,)
+    assert compile_query("during:12h", Message)[1] == (
+        datetime_to_snowflake(datetime(2020, 5, 7, 12)),
+    )
+
+
+def test_cursor_round_trip():
+    token = encode_cursor("edited_at", "DESC", datetime(2020, 1, 1), 1234)
+    assert decode_cursor(token) == ("edited_at", "DESC", "2020-01-01T00:00:00", 1234)
+
+
+def test_compile_keyset_queries():
+    assert compile_query("", Guild, limit=100, keyset=True, cursor=(None, 5)) == (
+        "SELECT guilds.*, guilds.id AS _cursor_key, guilds.id AS _cursor_id FROM "
+        "guilds WHERE guilds.id > $1 ORDER BY guilds.id ASC LIMIT $2",
+        (5, 100),
+        (Guild,),
+    )
+
+    assert compile_query(
+        "name:a OR name:b",
+        Guild,
+        order_by="name",
+        order_dir="DESC",
+        keyset=True,
+        cursor=("blob", 5),
+    ) == (
+        "SELECT guilds.*, guilds.name AS _cursor_key, guilds.id AS _cursor_id FROM "
+        "guilds WHERE (guilds.name ILIKE $1 OR guilds.name ILIKE $2) AND "
+        "(guilds.name, guilds.id) < ($3, $4) "
+        "ORDER BY guilds.name DESC, guilds.id DESC",
+        ("%a%", "%b%", "blob", 5),
+        (Guild,),
+    )
+
+    assert compile_query(
+        "", Message, order_by="type", keyset=True, cursor=(0, 5)
+    )[0].endswith(
+        "WHERE (messages.type, messages.id) > ($1, $2) "
+        "ORDER BY messages.type ASC, messages.id ASC"
+    )
+
+    assert compile_query(
+        "",
+        Message,
+        order_by="edited_at",
+        order_dir="DESC",
+        keyset=True,
+        cursor=(None, 5),
+    )[:2] == (
+        "SELECT messages.*, messages.edited_at AS _cursor_key, messages.id AS "
+        "_cursor_id FROM messages WHERE (messages.edited_at IS NULL AND messages.id "
+        "< $1 OR messages.edited_at IS NOT NULL) ORDER BY messages.edited_at DESC, "
+        "messages.id DESC",
+        (5,),
+    )
+
+    assert compile_query(
+        "", Message, order_by="edited_at", keyset=True, cursor=("2020-01-01", 5)
+    )[1] == (datetime(2020, 1, 1), 5)
+
+
+def test_query_cache(monkeypatch):
+    monkeypatch.setattr(query, "query_cache", query.QueryCache(size=2))
+    cache = query.query_cache
+
+    first = compile_query("name:cached", Guild, limit=10)
+    assert compile_query("name:cached", Guild, limit=10) == first
+    assert compile_query("name:cached", Guild, limit=20)[1] == ("%cached%", 20)
+    assert cache.stats() == {"size": 1, "hits": 2, "misses": 1}
+
+    # Without a limit the compiled query differs
+    assert compile_query("name:cached", Guild)[0] != first[0]
+    compile_query("name:other", Guild)
+    assert len(cache) == 2
+    compile_query("name:cached", Guild, limit=10)
+    assert cache.stats()["misses"] == 4
+
+    # Relative times depend on when the query runs
+    compile_query("after:1d", Guild)
+    compile_query("after:1d", Guild)
+    compile_query("name:(a OR during:1d)", Guild)
+    compile_query("name:(a OR during:1d)", Guild)
+    assert cache.stats()["misses"] == 8
+
+
+def test_query_cache_pages(monkeypatch):
+    monkeypatch.setattr(query, "query_cache", query.QueryCache())
+    cache = query.query_cache
+    options = {"order_by": "edited_at", "keyset": True, "limit": 50}
+
+    compile_query("content:hi", Message, **options)
+    second = compile_query("content:hi", Message, cursor=("2020-01-01", 5), **options)
+    third = compile_query("content:hi", Message, cursor=("2020-02-01", 9), **options)
+    assert cache.stats() == {"size": 2, "hits": 1, "misses": 2}
+
+    # Every page after the first is the same statement with different values
+    assert second[0] == third[0]
+    assert second[1] == ("hi", datetime(2020, 1, 1), 5, 50)
+    assert third[1] == ("hi", datetime(2020, 2, 1), 9, 50)
+
+    # As are pages by offset
+    second = compile_query("content:hi", Message, limit=50, offset=50)
+    third = compile_query("content:hi", Message, limit=50, offset=100)
+    assert second[0] == third[0]
+    assert third[1] == ("hi", 50, 100)
+    assert cache.stats()["hits"] == 2
+
+
+def test_parse_pipeline_stages():
+    assert QueryParser.parsed("content:hi | count by author.name") == [
+        {
+            "type": "label",
+            "name": "content",
+            "value": {"type": "symbol", "value": "hi"},
+            "exact": False,
+        },
+        {
+            "type": "pipe",
+            "value": [
+                {"type": "symbol", "value": "count"},
+                {"type": "symbol", "value": "by"},
+                {"type": "symbol", "value": "author.name"},
+            ],
+        },
+    ]
+
+
+def test_compile_pipeline_stages(monkeypatch):
+    # See `test_compile_rollup_queries`
+    monkeypatch.setattr(Message, "_rollups", ())
+
+    assert compile_query("content:hi | count", Message, limit=100, returns=True) == (
+        "SELECT count(*) AS count FROM messages WHERE to_tsvector('english', "
+        "messages.content) @@ phraseto_tsquery($1) LIMIT $2",
+        ("hi", 100),
+        (Message,),
+        Aggregation(["count"], []),
+    )
+
+    assert compile_query("| count by author.name", Message, returns=True) == (
+        "SELECT users.name AS _group_0, count(*) AS count FROM messages JOIN users "
+        "ON messages.author_id = users.id GROUP BY 1 ORDER BY count DESC",
+        (),
+        (Message,),
+        Aggregation(["author.name", "count"], []),
+    )
+
+    sql, args, _, fields = compile_query(
+        "| top 10 channel", Message, limit=100, returns=True
+    )
+    assert sql == (
+        "SELECT channels.id AS _group_0, channels.name AS _group_1, count(*) AS "
+        "count FROM messages JOIN channels ON messages.channel_id = channels.id "
+        "GROUP BY 1, 2 ORDER BY count DESC LIMIT $1"
+    )
+    assert args == (10,)
+    assert fields.fields == ("channel.id", "channel.name", "count")
+
+    assert compile_query("| histogram day", Message)[0] == (
+        "SELECT date_trunc('day', messages.created_at) AS _bucket, count(*) AS "
+        "count FROM messages GROUP BY 1 ORDER BY _bucket ASC"
+    )
+    assert compile_query("| histogram month", Guild)[0] == (
+        "SELECT date_trunc('month', to_timestamp(((guilds.id >> 22) + "
+        "1420070400000) / 1000.0) AT TIME ZONE 'utc') AS _bucket, count(*) AS "
+        "count FROM guilds GROUP BY 1 ORDER BY _bucket ASC"
+    )
+
+    for bad in ("| histogram fortnight", "| top x name", "| sum", "| count | count"):
+        try:
+            compile_query(bad, Guild)
+        except Exception:
+            pass
+        else:
+            assert False, bad
+
+
+def test_decode_pipeline_results():
+    _, _, models, fields = compile_query("| top 5 channel", Message, returns=True)
+    assert decode_query_results(models, fields, [(1, "general", 3), (2, None, 1)]) == (
+        [["1", "general", 3], ["2", None, 1]],
+        ["channel.id", "channel.name", "count"],
+    )
+
+    _, _, models, fields = compile_query("| histogram day", Message, returns=True)
+    assert decode_query_results(models, fields, [(datetime(2020, 1, 1), 2)])[0] == [
+        ["2020-01-01T00:00:00", 2]
+    ]
+
+
+def test_compile_rollup_queries():
+    sql, args, models, fields = compile_query(
+        "guild_id:1 | top 5 author", Message, limit=100, returns=True
+    )
+    assert sql == (
+        "SELECT users.id AS _group_0, users.name AS _group_1, coalesce(sum("
+        "message_counts_daily.message_count), 0) AS count FROM message_counts_daily "
+        "JOIN users ON message_counts_daily.author_id = users.id WHERE "
+        "message_counts_daily.guild_id = $1 GROUP BY 1, 2 ORDER BY count DESC LIMIT $2"
+    )
+    assert args == (1, 5)
+    assert models == (DailyMessageCount,)
+    assert fields.rollup is DailyMessageCount
+
+    assert compile_query("after:2020-05 | histogram week", Message) == (
+        "SELECT date_trunc('week', message_counts_daily.day) AS _bucket, coalesce("
+        "sum(message_counts_daily.message_count), 0) AS count FROM "
+        "message_counts_daily WHERE message_counts_daily.day >= $1 GROUP BY 1 "
+        "ORDER BY _bucket ASC",
+        (datetime(2020, 6, 1),),
+        (DailyMessageCount,),
+    )
+
+    # Too fine for the daily counts, but not the hourly ones
+    assert compile_query("during:2020-05-01T12 | histogram hour", Message)[0] == (
+        "SELECT date_trunc('hour', message_counts_hourly.hour) AS _bucket, coalesce("
+        "sum(message_counts_hourly.message_count), 0) AS count FROM "
+        "message_counts_hourly WHERE (message_counts_hourly.hour >= $1 AND "
+        "message_counts_hourly.hour < $2) GROUP BY 1 ORDER BY _bucket ASC"
+    )
+
+    # Anything the rollups can't answer falls back to the messages table
+    for raw in (
+        "content:hi | count",
+        "| count by type",
+        "channel_id:1 | histogram hour",
+        'during:"2020-05-01 12:30" | count',
+        "guild_id:1",
+    ):
+        assert " FROM messages" in compile_query(raw, Message)[0], raw
@@ -0,0 +1,32 @@
+from datetime import datetime, timezone, timedelta
+from abode.lib.snowflake import (
+    snowflake_to_datetime,
+    datetime_to_snowflake,
+    next_month,
+)
+
+
+def test_snowflake_round_trip():
+    # https://discord.com/developers/docs/reference#snowflakes
+    assert snowflake_to_datetime(175928847299117063) == datetime(
+        2016, 4, 30, 11, 18, 25, 796000
+    )
+    assert datetime_to_snowflake(datetime(2016, 4, 30, 11, 18, 25, 796000)) == (
+        175928847299117063 >> 22 << 22
+    )
+    assert datetime_to_snowflake(
+        datetime(2016, 4, 30, 11, 18, 25, 796000), high=True
+    ) == (175928847299117063 | ((1 << 22) - 1))
+
+
+def test_datetime_to_snowflake_bounds():
+    assert datetime_to_snowflake(datetime(2015, 1, 1)) == 0
+    assert datetime_to_snowflake(datetime(2010, 1, 1)) == 0
+
+    aware = datetime(2020, 1, 1, 2, tzinfo=timezone(timedelta(hours=2)))
+    assert datetime_to_snowflake(aware) == datetime_to_snowflake(datetime(2020, 1, 1))
+
+
+def test_next_month():
+    assert next_month(datetime(2020, 1, 31)) == datetime(2020, 2, 1)
+    assert next_month(datetime(2020, 12, 5)) == datetime(2021, 1, 1)
@@ -17,4 +17,9 @@ CREATE TABLE IF NOT EXISTS guilds (
 );
 
 CREATE INDEX IF NOT EXISTS guilds_name_trgm ON guilds USING gin (name gin_trgm_ops);
-CREATE INDEX IF NOT EXISTS guilds_owner_id_idx ON guilds (owner_id);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS guilds_owner_id_idx ON guilds (owner_id);
+
+CREATE TABLE IF NOT EXISTS guild_snapshots (
+    guild_id BIGINT PRIMARY KEY,
+    hash text NOT NULL
+);
\ No newline at end of file
@@ -25,4 +25,17 @@ CREATE INDEX IF NOT EXISTS messages_content_trgm ON messages USING gin (content
 CREATE INDEX IF NOT EXISTS messages_content_fts ON messages USING gin (to_tsvector('english', content)); 
 CREATE INDEX IF NOT EXISTS messages_guild_id_idx ON messages (guild_id);
 CREATE INDEX IF NOT EXISTS messages_channel_id_idx ON messages (channel_id);
-CREATE INDEX IF NOT EXISTS messages_author_id_idx ON messages (author_id);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS messages_channel_id_id_idx ON messages (channel_id, id);
+CREATE INDEX IF NOT EXISTS messages_author_id_idx ON messages (author_id);
+
+-- Previous versions of edited messages, `edited_at` is when the content was
+--   written (NULL for the original) and `replaced_at` when it was edited away.
+CREATE TABLE IF NOT EXISTS message_revisions (
+    message_id BIGINT NOT NULL,
+    content text NOT NULL,
+    embeds jsonb,
+    edited_at timestamp,
+    replaced_at timestamp NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS message_revisions_message_id_idx ON message_revisions (message_id);
@@ -0,0 +1,10 @@
+-- One row per changed field, `value` holds the fields value before the change
+--   and `entity_id` is prefixed with the table name (e.g. `users:1234`).
+CREATE TABLE IF NOT EXISTS changelog (
+    entity_id text,
+    version integer,
+    field text,
+    value text,
+
+    PRIMARY KEY (entity_id, version)
+);
@@ -0,0 +1,6 @@
+CREATE TABLE IF NOT EXISTS backfill_checkpoints (
+    channel_id BIGINT PRIMARY KEY,
+    oldest_id BIGINT NOT NULL,
+    newest_id BIGINT NOT NULL,
+    updated_at timestamp NOT NULL DEFAULT (now() at time zone 'utc')
+);
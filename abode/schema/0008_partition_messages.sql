@@ -0,0 +1,88 @@
+-- Messages are range partitioned by id into monthly partitions, which works
+--   because the top bits of a snowflake are its creation time. New installs are
+--   partitioned here, existing installs (which have messages) are converted
+--   online with `--partition-messages`.
+
+CREATE OR REPLACE FUNCTION abode_timestamp_to_snowflake(ts timestamp) RETURNS bigint AS $$
+    SELECT greatest((extract(epoch FROM ts) * 1000)::bigint - 1420070400000, 0) << 22
+$$ LANGUAGE sql IMMUTABLE;
+
+-- Creates any missing monthly partitions (named `<prefix>_YYYY_MM`) of `parent`
+--   for the months from `since` through `through`, returning how many were made.
+CREATE OR REPLACE FUNCTION abode_create_snowflake_partitions(
+    parent text, prefix text, since timestamp, through timestamp
+) RETURNS integer AS $$
+DECLARE
+    month timestamp := date_trunc('month', since);
+    partition text;
+    created integer := 0;
+BEGIN
+    WHILE month <= through LOOP
+        partition := prefix || '_' || to_char(month, 'YYYY_MM');
+        IF to_regclass(partition) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%s) TO (%s)',
+                partition,
+                parent,
+                abode_timestamp_to_snowflake(month),
+                abode_timestamp_to_snowflake(month + interval '1 month')
+            );
+            created := created + 1;
+        END IF;
+        month := month + interval '1 month';
+    END LOOP;
+    RETURN created;
+END
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass)
+        OR EXISTS (SELECT 1 FROM messages)
+    THEN
+        RETURN;
+    END IF;
+
+    DROP TABLE messages;
+
+    CREATE TABLE messages (
+        id BIGINT NOT NULL,
+        guild_id BIGINT,
+        channel_id BIGINT NOT NULL,
+        author_id BIGINT NOT NULL,
+        webhook_id BIGINT,
+
+        tts boolean NOT NULL,
+        type integer NOT NULL,
+        content text NOT NULL,
+        embeds jsonb,
+        mention_everyone boolean NOT NULL,
+        flags integer NOT NULL,
+        activity jsonb,
+        application jsonb,
+
+        created_at timestamp NOT NULL,
+        edited_at timestamp,
+        deleted boolean NOT NULL,
+
+        CONSTRAINT messages_pkey PRIMARY KEY (id)
+    ) PARTITION BY RANGE (id);
+
+    -- Catches anything outside of the monthly partitions (which shouldn't happen)
+    CREATE TABLE messages_default PARTITION OF messages DEFAULT;
+
+    PERFORM abode_create_snowflake_partitions(
+        'messages',
+        'messages',
+        '2015-01-01',
+        (now() at time zone 'utc') + interval '3 months'
+    );
+
+    CREATE INDEX messages_content_trgm ON messages USING gin (content gin_trgm_ops);
+    CREATE INDEX messages_content_fts ON messages USING gin (to_tsvector('english', content));
+    CREATE INDEX messages_guild_id_idx ON messages (guild_id);
+    CREATE INDEX messages_channel_id_idx ON messages (channel_id);
+    CREATE INDEX messages_channel_id_id_idx ON messages (channel_id, id);
+    CREATE INDEX messages_author_id_idx ON messages (author_id);
+END
+$$;
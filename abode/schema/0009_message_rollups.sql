@@ -0,0 +1,38 @@
+-- Message counts kept up to date by message ingestion (see `abode.db.rollups`),
+--   existing messages are counted here and can be recounted with
+--   `--rebuild-rollups`.
+
+CREATE TABLE IF NOT EXISTS message_counts_daily (
+    channel_id BIGINT NOT NULL,
+    author_id BIGINT NOT NULL,
+    guild_id BIGINT,
+    day timestamp NOT NULL,
+    message_count integer NOT NULL,
+
+    PRIMARY KEY (channel_id, author_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS message_counts_daily_day_idx ON message_counts_daily (day);
+CREATE INDEX IF NOT EXISTS message_counts_daily_author_id_idx ON message_counts_daily (author_id, day);
+CREATE INDEX IF NOT EXISTS message_counts_daily_guild_id_idx ON message_counts_daily (guild_id, day);
+
+-- Direct messages are counted under guild 0
+CREATE TABLE IF NOT EXISTS message_counts_hourly (
+    guild_id BIGINT NOT NULL,
+    hour timestamp NOT NULL,
+    message_count integer NOT NULL,
+
+    PRIMARY KEY (guild_id, hour)
+);
+
+CREATE INDEX IF NOT EXISTS message_counts_hourly_hour_idx ON message_counts_hourly (hour);
+
+INSERT INTO message_counts_daily (channel_id, author_id, guild_id, day, message_count)
+SELECT channel_id, author_id, guild_id, date_trunc('day', created_at), count(*)
+FROM messages
+GROUP BY 1, 2, 3, 4;
+
+INSERT INTO message_counts_hourly (guild_id, hour, message_count)
+SELECT coalesce(guild_id, 0), date_trunc('hour', created_at), count(*)
+FROM messages
+GROUP BY 1, 2;
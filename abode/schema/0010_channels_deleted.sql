@@ -0,0 +1,2 @@
+-- Channels are soft deleted like messages and emoji
+ALTER TABLE channels ADD COLUMN IF NOT EXISTS deleted boolean NOT NULL DEFAULT false;
@@ -0,0 +1,12 @@
+-- Changelog versions are taken from a sequence by the statement writing the
+--   change (see `abode.db.build_upsert_query`), so they only increase per
+--   entity rather than counting up from 1.
+ALTER TABLE changelog ALTER COLUMN version TYPE bigint;
+
+CREATE SEQUENCE IF NOT EXISTS changelog_version_seq AS bigint OWNED BY changelog.version;
+
+SELECT setval(
+    'changelog_version_seq',
+    coalesce((SELECT max(version) FROM changelog), 0) + 1,
+    false
+);
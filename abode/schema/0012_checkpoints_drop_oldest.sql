@@ -0,0 +1,3 @@
+-- Backfills always walk a channel's history oldest first, so a checkpoint only
+--   needs the newest message it reached.
+ALTER TABLE backfill_checkpoints DROP COLUMN IF EXISTS oldest_id;
@@ -1,13 +1,24 @@
 import time
+import functools
 from sanic import Sanic
-from sanic.response import json
-from abode.lib.query import compile_query, decode_query_results
+from sanic import response
+from abode.lib import fastjson
+from abode.lib.query import (
+    query_cache,
+    compile_query,
+    decode_query_results,
+    compile_result_decoder,
+    Aggregation,
+    encode_cursor,
+    decode_cursor,
+    elapsed_ms,
+)
 from abode.db.guilds import Guild
 from abode.db.messages import Message
 from abode.db.emoji import Emoji
 from abode.db.users import User
 from abode.db.channels import Channel
-from abode.db import get_pool
+from abode.db import get_pool, table_name
 from traceback import format_exc
 
 app = Sanic()
@@ -17,6 +28,9 @@ app.static("/script.js", "./frontend/script.js")
 app.static("/templates/", "./frontend/templates")
 
 
+# Rows fetched from the server-side cursor (and written) at a time when streaming
+STREAM_CHUNK_SIZE = 1000
+
 SUPPORTED_MODELS = {
     "guild": Guild,
     "message": Message,
@@ -26,7 +40,16 @@ SUPPORTED_MODELS = {
 }
 
 
+def json(body, **kwargs):
+    # JSONB columns may be passed through from postgres as `RawJSON`
+    return response.json(body, dumps=fastjson.dumps_raw, **kwargs)
+
+
 def setup_server(config):
+    global STREAM_CHUNK_SIZE
+
+    query_cache.size = config.get("query_cache_size", query_cache.size)
+    STREAM_CHUNK_SIZE = config.get("stream_chunk_size", STREAM_CHUNK_SIZE)
     return app.create_server(
         host=config.get("host", "0.0.0.0"),
         port=config.get("port", 9999),
@@ -45,18 +68,36 @@ async def route_search(request, model):
     order_by = request.json.get("order_by")
     order_dir = request.json.get("order_dir", "ASC")
     include_foreign_data = request.json.get("foreign_data", True)
+    explain = request.json.get("explain", False)
+
+    # Time spent in each stage of the search, in milliseconds
+    timings = {}
 
     query = request.json.get("query", "")
     try:
+        # Pages are fetched by seeking past the last row of the previous page
+        #   (see `encode_cursor`), `page` is only kept for older clients.
+        cursor = None
+        if request.json.get("cursor"):
+            cursor_order_by, cursor_order_dir, *cursor = decode_cursor(
+                request.json["cursor"]
+            )
+            cursor = tuple(cursor)
+            if (cursor_order_by, cursor_order_dir) != (order_by, order_dir):
+                raise Exception("cursor does not match the requested order")
+
         sql, args, models, return_fields = compile_query(
             query,
             model,
             limit=limit,
-            offset=(limit * (page - 1)),
+            offset=(limit * (page - 1)) if cursor is None else None,
             order_by=order_by,
             order_dir=order_dir,
             include_foreign_data=include_foreign_data,
             returns=True,
+            keyset=True,
+            cursor=cursor,
+            timings=timings,
         )
     except Exception:
         return json({"error": format_exc()})
@@ -66,19 +107,168 @@ async def route_search(request, model):
         "sql": sql,
         "request": request.json,
         "models": [i.__name__ for i in models],
+        "query_cache": query_cache.stats(),
+        "timings": timings,
     }
 
+    # Aggregates answered from a rollup table rather than scanning the model
+    if isinstance(return_fields, Aggregation) and return_fields.rollup:
+        _debug["rollup"] = table_name(return_fields.rollup)
+
+    if request.json.get("stream"):
+        return response.stream(
+            functools.partial(
+                stream_search,
+                sql,
+                args,
+                models,
+                return_fields,
+                (limit, order_by, order_dir),
+                _debug,
+                explain=explain,
+            ),
+            content_type="application/x-ndjson",
+        )
+
     results = []
     try:
-        async with get_pool().acquire() as conn:
-            start = time.time()
+        start = time.perf_counter()
+        async with get_pool("search").acquire() as conn:
+            timings["acquire"] = elapsed_ms(start)
+
+            start = time.perf_counter()
             results = await conn.fetch(sql, *args)
-            _debug["ms"] = int((time.time() - start) * 1000)
+            timings["execute"] = elapsed_ms(start)
+            _debug["ms"] = int(timings["execute"])
+
+            if explain:
+                # Runs the query a second time, so the timings above are unaffected
+                start = time.perf_counter()
+                _debug["plan"] = await explain_query(conn, sql, args)
+                timings["explain"] = elapsed_ms(start)
     except Exception:
         return json({"error": format_exc(), "_debug": _debug})
 
     try:
+        # Aggregated rows can't be paged with a cursor, only pipeline stages reduce
+        #   the number of groups enough for that not to matter.
+        next_cursor = None
+        if (
+            limit
+            and len(results) == limit
+            and not isinstance(return_fields, Aggregation)
+        ):
+            last = results[-1]
+            next_cursor = encode_cursor(
+                order_by, order_dir, last["_cursor_key"], last["_cursor_id"]
+            )
+
+        start = time.perf_counter()
         results, field_names = decode_query_results(models, return_fields, results)
-        return json({"results": results, "fields": field_names, "_debug": _debug})
+        timings["decode"] = elapsed_ms(start)
+
+        # The rows are the bulk of the response, encoding them separately lets
+        #   us report how long that took in the response itself.
+        start = time.perf_counter()
+        results = fastjson.RawJSON(fastjson.dumps_raw(results))
+        timings["encode"] = elapsed_ms(start)
+
+        return json(
+            {
+                "results": results,
+                "fields": field_names,
+                "cursor": next_cursor,
+                "_debug": _debug,
+            }
+        )
     except Exception:
         return json({"error": format_exc(), "_debug": _debug})
+
+
+async def explain_query(conn, sql, args):
+    return await conn.fetchval(f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}", *args)
+
+
+async def stream_search(
+    sql, args, models, return_fields, order, _debug, response, explain=False
+):
+    """
+    Writes the results of a search as NDJSON: a header line with the fields, one
+    line per row and a final line with the next cursor (or an error). Rows are
+    read from a server-side cursor and written a chunk at a time, so memory use
+    does not depend on the size of the result set. When `explain` is set the
+    query plan is included in the headers `_debug`.
+    """
+    limit, order_by, order_dir = order
+    decode, field_names = compile_result_decoder(models, return_fields)
+
+    # Totals over every chunk, reported on the last line
+    timings = {"acquire": 0, "execute": 0, "decode": 0, "encode": 0}
+
+    count = 0
+    last = None
+    header = False
+    try:
+        start = time.perf_counter()
+        async with get_pool("search").acquire() as conn:
+            timings["acquire"] = elapsed_ms(start)
+
+            # Runs before any rows are read, so the plan can go in the header
+            if explain:
+                start = time.perf_counter()
+                _debug["plan"] = await explain_query(conn, sql, args)
+                timings["explain"] = elapsed_ms(start)
+
+            await response.write(
+                fastjson.dumps_raw({"fields": field_names, "_debug": _debug}) + "\n"
+            )
+            header = True
+
+            async with conn.transaction():
+                cursor = await conn.cursor(sql, *args)
+                while True:
+                    start = time.perf_counter()
+                    records = await cursor.fetch(STREAM_CHUNK_SIZE)
+                    timings["execute"] += elapsed_ms(start)
+                    if not records:
+                        break
+
+                    count += len(records)
+                    last = records[-1]
+
+                    start = time.perf_counter()
+                    rows = [decode(record) for record in records]
+                    timings["decode"] += elapsed_ms(start)
+
+                    start = time.perf_counter()
+                    chunk = "".join(fastjson.dumps_raw(row) + "\n" for row in rows)
+                    timings["encode"] += elapsed_ms(start)
+                    await response.write(chunk)
+    except Exception:
+        error = {"error": format_exc()}
+        if not header:
+            error["_debug"] = _debug
+        await response.write(fastjson.dumps_raw(error) + "\n")
+        return
+
+    next_cursor = None
+    try:
+        if limit and count == limit and not isinstance(return_fields, Aggregation):
+            next_cursor = encode_cursor(
+                order_by, order_dir, last["_cursor_key"], last["_cursor_id"]
+            )
+    except Exception:
+        await response.write(fastjson.dumps_raw({"error": format_exc()}) + "\n")
+        return
+
+    await response.write(
+        fastjson.dumps_raw(
+            {
+                "cursor": next_cursor,
+                "count": count,
+                "ms": int(timings["execute"]),
+                "timings": timings,
+            }
+        )
+        + "\n"
+    )
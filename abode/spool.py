@@ -0,0 +1,150 @@
+"""
+A durable, append-only local spool which the ingestion path writes to whenever
+postgres is too slow or unavailable. Batches are appended as length prefixed
+pickle frames to segment files, the active segment is fsync'd at most once per
+`fsync_interval` and rotated once it grows past `segment_size`. Sealed segments
+are replayed into postgres (and then deleted) once it recovers. A segment which
+keeps failing to replay is set aside with a `.failed` suffix for inspection.
+"""
+import os
+import time
+import struct
+import pickle
+import asyncio
+
+FRAME_HEADER = struct.Struct(">I")
+SEGMENT_PREFIX = "spool-"
+SEGMENT_SUFFIX = ".seg"
+FAILED_SUFFIX = ".failed"
+
+
+class Spool:
+    def __init__(
+        self,
+        path,
+        segment_size=64 * 1024 * 1024,
+        fsync_interval=1.0,
+        max_failures=3,
+    ):
+        self.path = path
+        self.segment_size = segment_size
+        self.fsync_interval = fsync_interval
+        self.max_failures = max_failures
+
+        os.makedirs(path, exist_ok=True)
+        self._file = None
+        self._dirty = False
+        self._last_fsync = 0
+        self._failures = {}
+        self._next_seq = max(self._segment_seqs(failed=True), default=0) + 1
+
+    def __bool__(self):
+        return self._file is not None or any(True for _ in self._segment_seqs())
+
+    def _segment_seqs(self, failed=False):
+        # Segments which were set aside still use up their sequence number
+        for name in os.listdir(self.path):
+            if failed and name.endswith(FAILED_SUFFIX):
+                name = name[: -len(FAILED_SUFFIX)]
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+                yield int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)])
+
+    def _segment_path(self, seq):
+        return os.path.join(self.path, f"{SEGMENT_PREFIX}{seq:012d}{SEGMENT_SUFFIX}")
+
+    def append(self, batch):
+        """
+        Appends a single batch (any picklable object) to the active segment. The
+        write is only guaranteed to be durable after the next `sync`.
+        """
+        if self._file is None:
+            self._file = open(self._segment_path(self._next_seq), "ab")
+            self._next_seq += 1
+
+        data = pickle.dumps(batch, protocol=pickle.HIGHEST_PROTOCOL)
+        self._file.write(FRAME_HEADER.pack(len(data)))
+        self._file.write(data)
+        self._dirty = True
+
+        if self._file.tell() >= self.segment_size:
+            self.seal()
+        elif time.monotonic() - self._last_fsync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._file is None or not self._dirty:
+            return
+
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._dirty = False
+        self._last_fsync = time.monotonic()
+
+    def seal(self):
+        """
+        Syncs and closes the active segment, making it available for draining.
+        """
+        if self._file is None:
+            return
+
+        self.sync()
+        self._file.close()
+        self._file = None
+
+    def sealed_segments(self):
+        active = self._file.name if self._file is not None else None
+        for seq in sorted(self._segment_seqs()):
+            path = self._segment_path(seq)
+            if path != active:
+                yield path
+
+    @staticmethod
+    def read_segment(path):
+        """
+        Yields every batch stored within a segment. A torn frame at the end of a
+        segment (e.g. from a crash mid-write) is ignored.
+        """
+        with open(path, "rb") as f:
+            while True:
+                header = f.read(FRAME_HEADER.size)
+                if len(header) < FRAME_HEADER.size:
+                    return
+
+                (size,) = FRAME_HEADER.unpack(header)
+                data = f.read(size)
+                if len(data) < size:
+                    return
+                yield pickle.loads(data)
+
+    async def drain(self, fn, transient=()):
+        """
+        Seals the active segment and replays every sealed segment in order by
+        calling `fn` with each batch. Segments are deleted once fully replayed,
+        if `fn` raises the remaining segments are left for the next attempt.
+
+        A segment which fails `max_failures` times in a row with anything other
+        than one of the `transient` errors (e.g. a batch which can't be
+        unpickled any more) is set aside, and draining moves on past it.
+        """
+        self.seal()
+        for path in self.sealed_segments():
+            try:
+                for batch in self.read_segment(path):
+                    await fn(batch)
+            except transient:
+                raise
+            except Exception as e:
+                failures = self._failures.get(path, 0) + 1
+                if failures < self.max_failures:
+                    self._failures[path] = failures
+                    raise
+
+                self._failures.pop(path, None)
+                os.rename(path, path + FAILED_SUFFIX)
+                print(f"[spool] set aside {path} after {failures} failures: {e}")
+            else:
+                self._failures.pop(path, None)
+                os.unlink(path)
+
+            # Give the rest of the loop a chance in between segments
+            await asyncio.sleep(0)
@@ -0,0 +1,137 @@
+import os
+import asyncio
+from abode.archive import (
+    Archive,
+    load_index,
+    read_segment,
+    replay_archive,
+    _replay_segment,
+    _state_segments_for,
+)
+
+USER = {"id": "1", "username": "me", "discriminator": "0001", "avatar": None}
+GUILD = {
+    "id": "10",
+    "name": "guild",
+    "owner_id": "1",
+    "region": "us-east",
+    "icon": None,
+    "features": [],
+    "roles": [
+        {"id": "10", "name": "@everyone", "permissions": 0, "position": 0, "color": 0}
+    ],
+    "emojis": [],
+    "members": [
+        {"user": USER, "roles": [], "joined_at": "2020-01-01T00:00:00+00:00"}
+    ],
+    "channels": [
+        {"id": "20", "type": 0, "name": "general", "position": 0, "permission_overwrites": []}
+    ],
+    "premium_tier": 0,
+    "premium_subscription_count": 0,
+    "member_count": 1,
+}
+
+
+def _message(id):
+    return {
+        "id": str(id),
+        "channel_id": "20",
+        "guild_id": "10",
+        "author": USER,
+        "content": "hello",
+        "timestamp": "2020-01-01T00:00:00+00:00",
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": [],
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "type": 0,
+        "pinned": False,
+        "flags": 0,
+    }
+
+
+def _record_archive(path, monkeypatch, messages=4):
+    clock = iter(range(1000, 2000))
+    monkeypatch.setattr("abode.archive.time.time", lambda: next(clock) / 1000)
+
+    archive = Archive(path, segment_events=3)
+    archive.record({"op": 0, "t": "READY", "d": {"user": USER, "guilds": [GUILD]}})
+    archive.record({"op": 11, "d": None})
+    for i in range(messages):
+        archive.record({"op": 0, "t": "MESSAGE_CREATE", "d": _message(100 + i)})
+    archive.close()
+
+
+def test_archive_replay_segments(tmp_path, monkeypatch):
+    _record_archive(str(tmp_path), monkeypatch)
+
+    events, state = load_index(str(tmp_path))
+    assert [i["count"] for i in events] == [3, 2]
+    assert [i["channels"] for i in events] == [[20], [20]]
+    assert len(state) == 1
+
+    guilds, channels, _, _, messages = _replay_segment(
+        str(tmp_path), events[0], _state_segments_for(events[0], state)
+    )
+    assert [i.id for i in guilds] == [10]
+    assert [i.id for i in channels] == [20]
+    assert [i.id for i in messages] == [100, 101]
+
+    # The second segment has no READY of its own, so state is primed from the
+    #   state stream before replaying it.
+    _, _, _, _, messages = _replay_segment(
+        str(tmp_path), events[1], _state_segments_for(events[1], state)
+    )
+    assert [(i.id, i.guild_id) for i in messages] == [(102, 10), (103, 10)]
+
+
+def test_replay_segment_filters(tmp_path, monkeypatch):
+    _record_archive(str(tmp_path), monkeypatch)
+    events, state = load_index(str(tmp_path))
+    segment, state_segments = events[0], _state_segments_for(events[0], state)
+
+    first, second = [
+        i["ts"]
+        for i in read_segment(os.path.join(str(tmp_path), segment["segment"]))
+        if i["t"] == "MESSAGE_CREATE"
+    ]
+
+    _, _, _, _, messages = _replay_segment(
+        str(tmp_path), segment, state_segments, after=second
+    )
+    assert [i.id for i in messages] == [101]
+
+    _, _, _, _, messages = _replay_segment(
+        str(tmp_path), segment, state_segments, before=first
+    )
+    assert [i.id for i in messages] == [100]
+
+    guilds, channels, _, _, messages = _replay_segment(
+        str(tmp_path), segment, state_segments, channel_ids=[21]
+    )
+    assert [i.id for i in guilds] == [10]
+    assert channels == [] and messages == []
+
+    guilds, channels, _, users, messages = _replay_segment(
+        str(tmp_path), segment, state_segments, guild_ids=[11]
+    )
+    assert guilds == [] and channels == [] and users == [] and messages == []
+
+
+def test_replay_archive_writes_each_segment_in_order(tmp_path, monkeypatch):
+    _record_archive(str(tmp_path), monkeypatch, messages=10)
+
+    written = []
+
+    async def write_rows(rows):
+        written.append([i.id for i in rows[-1]])
+
+    monkeypatch.setattr("abode.archive._write_rows", write_rows)
+
+    asyncio.run(replay_archive(str(tmp_path), workers=1))
+
+    assert written == [[100, 101], [102, 103, 104], [105, 106, 107], [108, 109]]
@@ -0,0 +1,288 @@
+import time
+import asyncio
+from types import SimpleNamespace
+from discord import NoMoreItems
+from abode import backfill, db
+from abode.backfill import BackfillScheduler, ChannelProgress, RateLimiter
+
+
+def test_scheduler_runs_duplicate_channels():
+    async def run():
+        scheduler = BackfillScheduler(concurrency=2, report_interval=3600)
+        scheduler.start(asyncio.get_event_loop())
+
+        started = []
+        release = asyncio.Event()
+
+        async def backfill_channel(channel, progress):
+            started.append(channel.id)
+            await release.wait()
+
+        async def fill_gap(channel, progress, after, before):
+            await backfill_channel(channel, progress)
+
+        scheduler._backfill_channel = backfill_channel
+        scheduler._fill_gap = fill_gap
+
+        channel = SimpleNamespace(id=1, last_message_id=10)
+        first = scheduler.add_channel(channel)
+        second = scheduler.add_channel(channel, gap=(5, 11))
+        await asyncio.sleep(0.01)
+
+        # Both jobs for the same channel are tracked at once
+        assert started == [1, 1]
+        assert len(scheduler.active) == 2
+
+        release.set()
+        await asyncio.gather(first, second)
+        assert scheduler.active == {}
+
+        # Neither worker died, so both are still available for new jobs
+        release.clear()
+        third = scheduler.add_channel(SimpleNamespace(id=2, last_message_id=1))
+        fourth = scheduler.add_channel(SimpleNamespace(id=3, last_message_id=1))
+        await asyncio.sleep(0.01)
+        assert len(scheduler.active) == 2
+
+        release.set()
+        await asyncio.gather(third, fourth)
+        scheduler.stop()
+
+    asyncio.run(run())
+
+
+def test_scheduler_prioritises_recent_channels():
+    async def run():
+        scheduler = BackfillScheduler(concurrency=1, report_interval=3600)
+
+        order = []
+
+        async def backfill_channel(channel, progress):
+            order.append(channel.id)
+
+        scheduler._backfill_channel = backfill_channel
+        futures = [
+            scheduler.add_channel(SimpleNamespace(id=channel_id, last_message_id=last))
+            for channel_id, last in ((1, 5), (2, 50), (3, None))
+        ]
+
+        scheduler.start(asyncio.get_event_loop())
+        await asyncio.gather(*futures)
+        scheduler.stop()
+        return order
+
+    assert asyncio.run(run()) == [2, 1, 3]
+
+
+def test_rate_limiter():
+    async def run():
+        limiter = RateLimiter(50, burst=2)
+
+        start = time.monotonic()
+        await limiter.acquire()
+        await limiter.acquire()
+        burst = time.monotonic() - start
+
+        # Once the burst is spent requests are paced at the rate
+        for _ in range(3):
+            await limiter.acquire()
+        paced = time.monotonic() - start
+        return burst, paced
+
+    burst, paced = asyncio.run(run())
+    assert burst < 0.02
+    assert paced >= 0.05
+
+
+def _message(id):
+    return SimpleNamespace(id=id, author=SimpleNamespace(id=id * 10))
+
+
+class FakeHistory:
+    def __init__(self, messages, fail_after=None):
+        self.messages = list(messages)
+        self.fail_after = fail_after
+
+    async def next(self):
+        if self.fail_after is not None:
+            if self.fail_after == 0:
+                raise ConnectionResetError("connection lost")
+            self.fail_after -= 1
+
+        if not self.messages:
+            raise NoMoreItems()
+        return self.messages.pop(0)
+
+
+class FakeChannel:
+    """
+    A channel whose history holds messages with the given ids. Histories it
+    hands out fail after reading `fail_after` messages.
+    """
+
+    def __init__(self, id, message_ids, last_message_id=None):
+        self.id = id
+        self.message_ids = sorted(message_ids)
+        self.last_message_id = last_message_id
+        self.fail_after = None
+        self.requests = []
+
+    def history(self, limit=None, after=None, before=None, oldest_first=None):
+        after = after.id if after is not None else None
+        before = before.id if before is not None else None
+        self.requests.append((after, before))
+
+        ids = [
+            id
+            for id in self.message_ids
+            if (after is None or id > after) and (before is None or id < before)
+        ]
+        return FakeHistory(map(_message, ids), self.fail_after)
+
+
+def use_fake_backfill(monkeypatch):
+    """
+    Replaces the database side of backfills, returning the ids of every message
+    written and the stored checkpoints.
+    """
+    written, checkpoints = [], {}
+
+    async def noop(*args, **kwargs):
+        pass
+
+    async def get_checkpoint(channel_id):
+        return checkpoints.get(channel_id)
+
+    async def insert_checkpointed_batch(channel_id, messages, users):
+        written.extend(message.id for message in messages)
+        checkpoints[channel_id] = max(message.id for message in messages)
+
+    async def insert_message_batch(messages, users):
+        written.extend(message.id for message in messages)
+
+    monkeypatch.setattr(backfill, "HISTORY_PAGE_SIZE", 3)
+    monkeypatch.setattr(backfill.Message, "from_discord", lambda message: message)
+    monkeypatch.setattr(backfill.User, "from_discord", lambda user: user)
+    monkeypatch.setattr(backfill, "upsert_channel", noop)
+    monkeypatch.setattr(backfill, "get_checkpoint", get_checkpoint)
+    monkeypatch.setattr(
+        backfill, "insert_checkpointed_batch", insert_checkpointed_batch
+    )
+    monkeypatch.setattr(backfill, "insert_message_batch", insert_message_batch)
+    return written, checkpoints
+
+
+def test_interrupted_backfill_resumes_from_checkpoint(monkeypatch):
+    written, checkpoints = use_fake_backfill(monkeypatch)
+    scheduler = BackfillScheduler(requests_per_second=1000)
+    channel = FakeChannel(1, range(1, 11))
+
+    async def run():
+        await scheduler._backfill_channel(channel, ChannelProgress(channel))
+
+    # Two full pages are written before the connection drops part way through
+    #   the third, which is lost.
+    channel.fail_after = 7
+    try:
+        asyncio.run(run())
+    except ConnectionResetError:
+        pass
+    else:
+        assert False
+    assert written == [1, 2, 3, 4, 5, 6]
+    assert checkpoints == {1: 6}
+
+    # The next attempt carries on right after the checkpoint
+    channel.fail_after = None
+    asyncio.run(run())
+    assert channel.requests == [(None, None), (6, None)]
+    assert written == list(range(1, 11))
+    assert checkpoints == {1: 10}
+
+
+def run_fill_gaps(monkeypatch, pool, channels):
+    monkeypatch.setattr(db, "get_pool", lambda name="ingest": pool)
+    scheduler = BackfillScheduler(requests_per_second=1000)
+    monkeypatch.setattr(backfill, "scheduler", scheduler)
+
+    async def run():
+        scheduler.start(asyncio.get_event_loop())
+        try:
+            await backfill.fill_gaps(channels)
+        finally:
+            scheduler.stop()
+
+    asyncio.run(run())
+
+
+def test_fill_gaps_fetches_missing_range(monkeypatch, conn, pool):
+    written, checkpoints = use_fake_backfill(monkeypatch)
+    conn.records = [{"id": 1, "last_id": 5}, {"id": 2, "last_id": 9}]
+    behind = FakeChannel(1, range(1, 10), last_message_id=9)
+    current = FakeChannel(2, range(1, 10), last_message_id=9)
+
+    run_fill_gaps(monkeypatch, pool, [behind, current])
+
+    # Only the messages after the newest archived one are fetched, and the
+    #   range is closed just past the channels last message
+    assert behind.requests == [(5, 10)]
+    assert written == [6, 7, 8, 9]
+    assert current.requests == []
+    assert checkpoints == {}
+
+
+def test_fill_gaps_skips_empty_channels(monkeypatch, conn, pool):
+    written, _ = use_fake_backfill(monkeypatch)
+    # Never archived, so it needs a full backfill rather than a gap fill
+    conn.records = [{"id": 1, "last_id": None}]
+    unarchived = FakeChannel(1, range(1, 10), last_message_id=9)
+    empty = FakeChannel(2, [])
+
+    run_fill_gaps(monkeypatch, pool, [unarchived, empty])
+
+    assert unarchived.requests == []
+    assert empty.requests == []
+    assert written == []
+
+    # A channel which has never had a message does not hit the database at all
+    conn.events.clear()
+    run_fill_gaps(monkeypatch, pool, [empty])
+    assert conn.events == []
+
+
+def test_cancelled_requests_do_not_stop_workers(monkeypatch):
+    written, _ = use_fake_backfill(monkeypatch)
+    scheduler = BackfillScheduler(concurrency=1, requests_per_second=1000)
+    queued = FakeChannel(1, range(1, 4))
+    running = FakeChannel(2, range(1, 4))
+    after = FakeChannel(3, range(1, 4))
+
+    async def run():
+        # Cancelled while still queued, before a worker has picked it up
+        future = scheduler.add_channel(queued)
+        future.cancel()
+
+        # Cancelled while a worker is busy reading its history
+        started = asyncio.Event()
+        history = running.history
+
+        def slow_history(**kwargs):
+            started.set()
+            return history(**kwargs)
+
+        running.history = slow_history
+        running_future = scheduler.add_channel(running)
+
+        scheduler.start(asyncio.get_event_loop())
+        try:
+            await asyncio.wait_for(started.wait(), 1)
+            running_future.cancel()
+            return await asyncio.wait_for(scheduler.add_channel(after), 1)
+        finally:
+            scheduler.stop()
+
+    progress = asyncio.run(run())
+    assert progress.channel is after
+    assert queued.requests == []
+    assert running.requests == [(None, None)]
+    assert written == [1, 2, 3, 1, 2, 3]
@@ -0,0 +1,341 @@
+import os
+import asyncio
+from types import SimpleNamespace
+from abode import ingest
+from abode.ingest import IngestQueue, split_batch
+from abode.spool import Spool
+from abode.lib import fastjson
+
+
+def test_ingest_coalesces_edits_and_deletes():
+    queue = IngestQueue()
+    queue.put_edit(1, {"content": "a", "edited_timestamp": "x"})
+    queue.put_edit(1, {"content": "ab"})
+    queue.put_edit(2, {"content": "b"})
+    queue.put_deletes([2, 3])
+
+    assert queue._edits == {1: {"content": "ab", "edited_timestamp": "x"}}
+    assert queue._deletes == {2, 3}
+
+
+class FakeWriter:
+    """
+    Stands in for `insert_message_batch`, recording the ids of every batch it
+    writes. Writes fail while `failing` is set or when they contain a message in
+    `poison`, and wait while `blocked` is set.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.failing = False
+        self.poison = set()
+        self.started = asyncio.Event()
+        self.blocked = None
+
+    async def __call__(self, messages, users):
+        self.started.set()
+        if self.blocked is not None:
+            await self.blocked.wait()
+        if self.failing:
+            raise ConnectionRefusedError("database is down")
+        if self.poison & {message.id for message in messages}:
+            raise ValueError("invalid byte sequence")
+        self.batches.append(sorted(message.id for message in messages))
+
+    @property
+    def written(self):
+        return sorted(id for batch in self.batches for id in batch)
+
+
+def use_writer(monkeypatch):
+    writer = FakeWriter()
+    monkeypatch.setattr(ingest, "insert_message_batch", writer)
+    monkeypatch.setattr(ingest, "get_pool", lambda: object())
+    return writer
+
+
+def _message(id):
+    return SimpleNamespace(id=id, author_id=id * 10, author=SimpleNamespace(id=id * 10))
+
+
+def put(queue, *ids):
+    for id in ids:
+        queue._messages[id] = _message(id)
+        queue._users[id * 10] = SimpleNamespace(id=id * 10)
+
+
+def test_flush_writes_buffered_messages(monkeypatch):
+    async def run():
+        writer = use_writer(monkeypatch)
+        queue = IngestQueue()
+        put(queue, 1, 2)
+
+        await queue.flush()
+        assert writer.batches == [[1, 2]]
+        assert len(queue) == 0
+
+        # Nothing buffered means nothing to write
+        await queue.flush()
+        assert writer.batches == [[1, 2]]
+
+    asyncio.run(run())
+
+
+def test_failed_flush_is_retried(monkeypatch):
+    async def run():
+        writer = use_writer(monkeypatch)
+        queue = IngestQueue()
+        put(queue, 1, 2)
+
+        writer.failing = True
+        try:
+            await queue.flush()
+        except Exception:
+            pass
+        else:
+            assert False
+
+        # The failed batch is kept, anything newer wins over it
+        newer = _message(2)
+        queue._messages[2] = newer
+        put(queue, 3)
+        assert queue._messages[2] is newer
+        assert sorted(queue._messages) == [1, 2, 3]
+
+        writer.failing = False
+        await queue.flush()
+        assert writer.written == [1, 2, 3]
+
+    asyncio.run(run())
+
+
+def test_failed_flush_spills(monkeypatch, tmp_path):
+    async def run():
+        writer = use_writer(monkeypatch)
+        queue = IngestQueue(spool=Spool(str(tmp_path)))
+        put(queue, 1, 2)
+
+        writer.failing = True
+        try:
+            await queue.flush()
+        except Exception:
+            pass
+        assert len(queue) == 0
+        assert queue.spool
+
+        writer.failing = False
+        await queue.spool.drain(queue._write)
+        assert writer.written == [1, 2]
+        assert not queue.spool
+
+    asyncio.run(run())
+
+
+def test_stop_keeps_interrupted_flush(monkeypatch):
+    async def run():
+        writer = use_writer(monkeypatch)
+        queue = IngestQueue(flush_interval=0.01)
+        put(queue, 1, 2)
+
+        # Stop while the run loop is part way through writing the batch
+        writer.blocked = asyncio.Event()
+        queue.start(asyncio.get_event_loop())
+        await writer.started.wait()
+        assert len(queue) == 0
+
+        writer.blocked = None
+        await queue.stop()
+        assert writer.batches == [[1, 2]]
+
+    asyncio.run(run())
+
+
+def use_fake_models(monkeypatch):
+    # Gateway objects are buffered as-is rather than converted
+    monkeypatch.setattr(ingest.Message, "from_discord", lambda message: message)
+    monkeypatch.setattr(ingest.User, "from_discord", lambda user: user)
+
+
+def test_put_message_flushes_full_batches(monkeypatch):
+    async def run():
+        writer = use_writer(monkeypatch)
+        use_fake_models(monkeypatch)
+        queue = IngestQueue(batch_size=3, flush_interval=60)
+        queue.start(asyncio.get_event_loop())
+
+        await queue.put_message(_message(1))
+        await queue.put_message(_message(2))
+        await asyncio.sleep(0.01)
+        assert writer.batches == []
+
+        await queue.put_message(_message(3))
+        await asyncio.sleep(0.01)
+        assert writer.batches == [[1, 2, 3]]
+        await queue.stop()
+
+    asyncio.run(run())
+
+
+def test_put_message_flushes_on_interval(monkeypatch):
+    async def run():
+        writer = use_writer(monkeypatch)
+        use_fake_models(monkeypatch)
+        queue = IngestQueue(batch_size=100, flush_interval=0.01)
+        queue.start(asyncio.get_event_loop())
+
+        await queue.put_message(_message(1))
+        await asyncio.sleep(0.05)
+        assert writer.batches == [[1]]
+        await queue.stop()
+
+    asyncio.run(run())
+
+
+def test_put_message_waits_when_full(monkeypatch):
+    async def run():
+        writer = use_writer(monkeypatch)
+        use_fake_models(monkeypatch)
+        queue = IngestQueue(batch_size=100, flush_interval=60, max_pending=2)
+        queue.start(asyncio.get_event_loop())
+
+        writer.blocked = asyncio.Event()
+        await queue.put_message(_message(1))
+        await queue.put_message(_message(2))
+
+        # The buffer is full, so the producer waits on the flush it triggered
+        producer = asyncio.ensure_future(queue.put_message(_message(3)))
+        await asyncio.sleep(0.01)
+        assert writer.started.is_set()
+        assert not producer.done()
+
+        writer.blocked.set()
+        await asyncio.wait_for(producer, timeout=1)
+        assert writer.batches == [[1, 2]]
+        assert sorted(queue._messages) == [3]
+        await queue.stop()
+
+    asyncio.run(run())
+
+
+def test_run_loop_retries_failed_flush(monkeypatch):
+    async def run():
+        writer = use_writer(monkeypatch)
+        use_fake_models(monkeypatch)
+        queue = IngestQueue(batch_size=100, flush_interval=0.01)
+
+        writer.failing = True
+        queue.start(asyncio.get_event_loop())
+        await queue.put_message(_message(1))
+        await asyncio.sleep(0.05)
+        assert writer.batches == []
+        assert sorted(queue._messages) == [1]
+
+        # The batch was requeued, so the next tick writes it
+        writer.failing = False
+        await asyncio.sleep(0.05)
+        assert writer.batches == [[1]]
+        await queue.stop()
+
+    asyncio.run(run())
+
+
+def test_split_batch_keeps_authors():
+    messages = [_message(i) for i in (1, 2, 3)]
+    users = [SimpleNamespace(id=i) for i in (10, 20, 30, 40)]
+
+    first, second = split_batch((messages, users))
+    assert [i.id for i in first[0]] == [1]
+    assert [i.id for i in second[0]] == [2, 3]
+    assert sorted(i.id for i in second[1]) == [20, 30]
+
+    # Users without a message of their own go with the first half
+    assert sorted(i.id for i in first[1]) == [10, 40]
+
+
+def test_failing_rows_are_dead_lettered(monkeypatch, tmp_path):
+    async def run():
+        writer = use_writer(monkeypatch)
+        dead_letters = tmp_path / "dead.ndjson"
+        queue = IngestQueue(max_retries=2, dead_letter_path=str(dead_letters))
+        put(queue, *range(1, 9))
+        writer.poison = {3, 6}
+
+        for _ in range(2):
+            try:
+                await queue.flush()
+            except ValueError:
+                pass
+            else:
+                assert False
+            assert sorted(queue._messages) == list(range(1, 9))
+
+        # Retries are spent, so the batch is bisected down to the bad rows
+        await queue.flush()
+        assert writer.written == [1, 2, 4, 5, 7, 8]
+        assert len(queue) == 0
+        assert queue._has_space.is_set()
+
+        lines = dead_letters.read_text().splitlines()
+        entries = [fastjson.loads(line) for line in lines]
+        assert sorted(entry["messages"][0]["id"] for entry in entries) == [3, 6]
+        assert [len(entry["messages"]) for entry in entries] == [1, 1]
+        assert all("invalid byte sequence" in entry["error"] for entry in entries)
+
+        # Back to whole batches once a flush succeeds
+        put(queue, 9, 10)
+        await queue.flush()
+        assert writer.batches[-1] == [9, 10]
+
+    asyncio.run(run())
+
+
+def test_isolating_requeues_on_outage(monkeypatch, tmp_path):
+    async def run():
+        writer = use_writer(monkeypatch)
+        dead_letters = tmp_path / "dead.ndjson"
+        queue = IngestQueue(max_retries=0, dead_letter_path=str(dead_letters))
+        put(queue, 1, 2, 3, 4)
+
+        # The database going away says nothing about the rows, so nothing is
+        #   dead lettered and everything is kept for the next attempt.
+        writer.failing = True
+        try:
+            await queue.flush()
+        except ConnectionRefusedError:
+            pass
+        else:
+            assert False
+        assert sorted(queue._messages) == [1, 2, 3, 4]
+        assert sorted(queue._users) == [10, 20, 30, 40]
+        assert not dead_letters.exists()
+
+        writer.failing = False
+        await queue.flush()
+        assert writer.written == [1, 2, 3, 4]
+
+    asyncio.run(run())
+
+
+def test_unreplayable_spool_does_not_block_flush(monkeypatch, tmp_path):
+    async def run():
+        writer = use_writer(monkeypatch)
+        use_fake_models(monkeypatch)
+        spool = Spool(str(tmp_path), max_failures=2)
+        queue = IngestQueue(batch_size=100, flush_interval=0.01, spool=spool)
+
+        # A spooled batch which can't be written any more
+        spool.append(([_message(1)], []))
+        spool.seal()
+        writer.poison = {1}
+
+        queue.start(asyncio.get_event_loop())
+        await queue.put_message(_message(2))
+        await asyncio.sleep(0.05)
+
+        assert writer.written == [2]
+        assert not spool
+        (name,) = os.listdir(str(tmp_path))
+        assert name.endswith(".failed")
+        await queue.stop()
+
+    asyncio.run(run())
@@ -0,0 +1,240 @@
+import asyncio
+from decimal import Decimal
+from datetime import datetime
+from types import SimpleNamespace
+from abode import server
+from abode.lib import fastjson
+from abode.lib.query import compile_query, decode_cursor
+from abode.db.guilds import Guild
+
+GUILD = (1, 2, "abode", "us-west", None, [], None, None, None, None, 0, 0, True)
+
+
+class Record(tuple):
+    """
+    Stands in for an asyncpg Record, which is indexable by position and name.
+    """
+
+    def __new__(cls, values, names):
+        record = super().__new__(cls, values)
+        record.names = names
+        return record
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return super().__getitem__(self.names.index(key))
+        return super().__getitem__(key)
+
+
+def guild_record(id, cursor_key):
+    names = Guild.codec().names + ("_cursor_key", "_cursor_id")
+    return Record((id,) + GUILD[1:] + (cursor_key, id), names)
+
+
+def use_records(monkeypatch, pool, records):
+    pool.conn.records = records
+    monkeypatch.setattr(server, "get_pool", lambda name="ingest": pool)
+    return pool.conn
+
+
+def search(body):
+    # Sanic's route decorator returns the routes along with the handler
+    _, route_search = server.route_search
+
+    request = SimpleNamespace(json=body)
+    result = asyncio.run(
+        route_search(request, "guild")
+    )
+    return fastjson.loads(result.body)
+
+
+def test_search_returns_cursor(monkeypatch, pool):
+    conn = use_records(monkeypatch, pool, [guild_record(1, "a"), guild_record(2, "b")])
+
+    body = search({"query": "", "limit": 2, "order_by": "name", "foreign_data": False})
+    assert [row[0] for row in body["results"]] == ["1", "2"]
+    assert decode_cursor(body["cursor"]) == ("name", "ASC", "b", 2)
+
+    # The next page seeks past the last row
+    search(
+        {
+            "query": "",
+            "limit": 2,
+            "order_by": "name",
+            "foreign_data": False,
+            "cursor": body["cursor"],
+        }
+    )
+    query, args = conn.queries()[-1]
+    assert "(guilds.name, guilds.id) > ($1, $2)" in query
+    assert args == ("b", 2, 2)
+
+    body = search({"query": "", "limit": 2, "cursor": body["cursor"]})
+    assert "cursor does not match" in body["error"]
+
+
+def test_search_cursor_keys(monkeypatch, pool):
+    # Keys JSON has no type for still make a cursor rather than a 500
+    use_records(monkeypatch, pool, [guild_record(1, Decimal("1.5"))])
+    body = search({"query": "", "limit": 1, "order_by": "name", "foreign_data": False})
+    assert decode_cursor(body["cursor"])[2] == "1.5"
+
+    use_records(monkeypatch, pool, [guild_record(1, datetime(2020, 1, 1))])
+    body = search({"query": "", "limit": 1, "order_by": "name", "foreign_data": False})
+    assert decode_cursor(body["cursor"])[2] == "2020-01-01T00:00:00"
+
+    # Fewer rows than the limit is the last page
+    body = search({"query": "", "limit": 2, "order_by": "name", "foreign_data": False})
+    assert body["cursor"] is None
+
+
+def test_stream_search(monkeypatch, pool):
+    use_records(monkeypatch, pool, [guild_record(i, str(i)) for i in range(1, 4)])
+    monkeypatch.setattr(server, "STREAM_CHUNK_SIZE", 2)
+
+    sql, args, models, return_fields = compile_query(
+        "", Guild, limit=3, order_by="name", keyset=True, returns=True
+    )
+    written = []
+    response = SimpleNamespace(write=None)
+
+    async def write(data):
+        written.append(data)
+
+    response.write = write
+    asyncio.run(
+        server.stream_search(
+            sql, args, models, return_fields, (3, "name", "ASC"), {}, response
+        )
+    )
+
+    lines = [fastjson.loads(line) for line in "".join(written).splitlines()]
+    header, rows, footer = lines[0], lines[1:-1], lines[-1]
+    assert header["fields"] == list(Guild.codec().names)
+    assert [row[0] for row in rows] == ["1", "2", "3"]
+    assert footer["count"] == 3
+    assert decode_cursor(footer["cursor"]) == ("name", "ASC", "3", 3)
+
+    # Two chunks of rows were written between the header and footer
+    assert len(written) == 4
+
+
+def test_stream_search_reports_errors(monkeypatch, pool):
+    use_records(monkeypatch, pool, [("not", "a", "guild")])
+    sql, args, models, return_fields = compile_query("", Guild, returns=True)
+
+    written = []
+
+    async def write(data):
+        written.append(data)
+
+    asyncio.run(
+        server.stream_search(
+            sql,
+            args,
+            models,
+            return_fields,
+            (None, None, "ASC"),
+            {},
+            SimpleNamespace(write=write),
+        )
+    )
+    assert "error" in fastjson.loads(written[-1])
+
+
+PLAN = [{"Plan": {"Node Type": "Seq Scan"}, "Execution Time": 1.5}]
+
+
+def use_plan(conn):
+    async def fetchval(query, *args):
+        conn.events.append(("fetchval", query, args))
+        return PLAN
+
+    conn.fetchval = fetchval
+
+
+def stream(sql, args, models, return_fields, order, **kwargs):
+    written = []
+
+    async def write(data):
+        written.append(data)
+
+    asyncio.run(
+        server.stream_search(
+            sql,
+            args,
+            models,
+            return_fields,
+            order,
+            {},
+            SimpleNamespace(write=write),
+            **kwargs,
+        )
+    )
+    return [fastjson.loads(line) for line in "".join(written).splitlines()]
+
+
+def test_search_explain(monkeypatch, pool):
+    conn = use_records(monkeypatch, pool, [guild_record(1, "a")])
+    use_plan(conn)
+
+    body = search({"query": "", "limit": 2, "foreign_data": False, "explain": True})
+    assert body["_debug"]["plan"] == PLAN
+    for stage in ("acquire", "execute", "explain", "decode", "encode"):
+        assert body["_debug"]["timings"][stage] >= 0
+
+    ((query, args),) = conn.queries("fetchval")
+    assert query.startswith("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) SELECT")
+    assert args == conn.queries("fetch")[0][1]
+
+    # Without `explain` the query only runs once
+    conn.events.clear()
+    body = search({"query": "", "limit": 2, "foreign_data": False})
+    assert "plan" not in body["_debug"]
+    assert "explain" not in body["_debug"]["timings"]
+    assert conn.queries("fetchval") == []
+
+
+def test_stream_search_explain(monkeypatch, pool):
+    conn = use_records(monkeypatch, pool, [guild_record(1, "a")])
+    use_plan(conn)
+    sql, args, models, return_fields = compile_query(
+        "", Guild, limit=2, keyset=True, returns=True
+    )
+
+    header, row, footer = stream(
+        sql, args, models, return_fields, (2, None, "ASC"), explain=True
+    )
+    # The plan is ready before any rows are read, so it goes out in the header
+    assert header["_debug"]["plan"] == PLAN
+    assert row[0] == "1"
+    for stage in ("acquire", "execute", "explain", "decode", "encode"):
+        assert footer["timings"][stage] >= 0
+
+    ((query, _),) = conn.queries("fetchval")
+    assert query == f"EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {sql}"
+
+    # Without `explain` the header carries no plan
+    conn.events.clear()
+    header, _, footer = stream(sql, args, models, return_fields, (2, None, "ASC"))
+    assert "plan" not in header["_debug"]
+    assert "explain" not in footer["timings"]
+    assert conn.queries("fetchval") == []
+
+
+def test_search_passes_explain_to_stream(monkeypatch, pool):
+    use_records(monkeypatch, pool, [])
+    streamed = []
+    monkeypatch.setattr(
+        server.response, "stream", lambda fn, **kwargs: streamed.append(fn)
+    )
+
+    _, route_search = server.route_search
+    asyncio.run(
+        route_search(
+            SimpleNamespace(json={"query": "", "stream": True, "explain": True}),
+            "guild",
+        )
+    )
+    (fn,) = streamed
+    assert fn.keywords == {"explain": True}
@@ -0,0 +1,110 @@
+import os
+import asyncio
+from abode.spool import Spool, FAILED_SUFFIX
+
+
+def test_spool_roundtrip_and_drain(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=64)
+    assert not spool
+
+    for i in range(10):
+        spool.append(("batch", i))
+    assert spool
+    assert len(list(spool.sealed_segments())) > 1
+
+    drained = []
+
+    async def replay(batch):
+        drained.append(batch)
+
+    asyncio.run(spool.drain(replay))
+    assert drained == [("batch", i) for i in range(10)]
+    assert not spool
+
+
+def test_spool_ignores_torn_frames(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append("a")
+    spool.append("b")
+    spool.seal()
+
+    (path,) = spool.sealed_segments()
+    with open(path, "r+b") as f:
+        f.truncate(f.seek(0, 2) - 1)
+
+    assert list(Spool.read_segment(path)) == ["a"]
+
+
+def test_spool_failed_drain_keeps_segment(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append("a")
+
+    async def replay(batch):
+        raise Exception("database is down")
+
+    try:
+        asyncio.run(spool.drain(replay))
+    except Exception:
+        pass
+
+    reopened = Spool(str(tmp_path))
+    assert reopened
+    (path,) = reopened.sealed_segments()
+    assert list(Spool.read_segment(path)) == ["a"]
+
+
+def test_spool_sets_aside_failing_segments(tmp_path):
+    spool = Spool(str(tmp_path), max_failures=2)
+    spool.append("bad")
+    spool.seal()
+    spool.append("good")
+    spool.seal()
+    bad, good = spool.sealed_segments()
+
+    drained = []
+
+    async def replay(batch):
+        if batch == "bad":
+            raise AttributeError("Message has no attribute 'deleted'")
+        drained.append(batch)
+
+    # Failures below the limit leave everything in place for the next attempt
+    try:
+        asyncio.run(spool.drain(replay))
+    except AttributeError:
+        pass
+    else:
+        assert False
+    assert list(spool.sealed_segments()) == [bad, good]
+    assert drained == []
+
+    asyncio.run(spool.drain(replay))
+    assert drained == ["good"]
+    assert not spool
+    assert os.listdir(str(tmp_path)) == [os.path.basename(bad) + FAILED_SUFFIX]
+
+    # New segments don't reuse the set aside segments name
+    reopened = Spool(str(tmp_path))
+    reopened.append("next")
+    reopened.seal()
+    (path,) = reopened.sealed_segments()
+    assert path > bad
+
+
+def test_spool_keeps_segments_on_transient_errors(tmp_path):
+    spool = Spool(str(tmp_path), max_failures=1)
+    spool.append("a")
+
+    async def replay(batch):
+        raise ConnectionRefusedError("database is down")
+
+    for _ in range(3):
+        try:
+            asyncio.run(spool.drain(replay, transient=(OSError,)))
+        except ConnectionRefusedError:
+            pass
+        else:
+            assert False
+
+    (path,) = spool.sealed_segments()
+    assert list(Spool.read_segment(path)) == ["a"]
@@ -0,0 +1,129 @@
+"""
+Microbenchmark for decoding search results. Compares `decode_query_results`
+using the precompiled model codecs against the previous implementation, which
+introspected field types for every cell.
+
+    python -m benchmarks.bench_decode [rows]
+"""
+import sys
+import json
+import time
+import typing
+import dataclasses
+from datetime import datetime
+from abode.db import Snowflake, is_jsonb
+from abode.db.messages import Message
+from abode.lib.query import decode_query_results
+
+
+def legacy_convert_to_type(value, target_type, to_pg=False, from_pg=False, to_js=False):
+    if typing.get_origin(target_type) is typing.Union:
+        if type(None) in typing.get_args(target_type):
+            if value is None:
+                return None
+            target_type = next(
+                i for i in typing.get_args(target_type) if i is not type(None)
+            )
+        else:
+            assert False
+
+    if (
+        to_js
+        and target_type == Snowflake
+        or (target_type == typing.Optional[Snowflake] and value is not None)
+    ):
+        return str(value)
+
+    if (
+        to_js
+        and target_type == datetime
+        or (target_type == typing.Optional[datetime] and value is not None)
+    ):
+        return value.isoformat()
+
+    if typing.get_origin(target_type) == list:
+        return list(value)
+
+    if type(value) == target_type:
+        return value
+
+    if to_pg and is_jsonb(target_type):
+        return json.dumps(value)
+
+    if from_pg and is_jsonb(target_type):
+        return json.loads(value)
+
+    if is_jsonb(target_type):
+        return value
+
+    return target_type(value)
+
+
+def legacy_decode_query_results(model, results):
+    fields = dataclasses.fields(model)
+    rows = []
+    for result_row in results:
+        rows.append(
+            [
+                legacy_convert_to_type(
+                    legacy_convert_to_type(result_row[idx], field.type, from_pg=True),
+                    field.type,
+                    to_js=True,
+                )
+                for idx, field in enumerate(fields)
+            ]
+        )
+    return rows
+
+
+def make_results(n, embeds):
+    return [
+        (
+            i,
+            1,
+            2,
+            3,
+            None,
+            False,
+            0,
+            f"message number {i}",
+            embeds,
+            False,
+            0,
+            None,
+            None,
+            datetime(2020, 1, 1),
+            None,
+            False,
+        )
+        for i in range(n)
+    ]
+
+
+def bench(name, fn, n):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>8}: {elapsed * 1000:8.1f}ms total, {elapsed / n * 1e6:6.2f}us/row")
+    return elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    # JSONB used to arrive as text, it is now decoded by the connection codecs
+    legacy_results = make_results(n, "[]")
+    results = make_results(n, [])
+
+    legacy_rows = legacy_decode_query_results(Message, legacy_results)
+    rows, _ = decode_query_results((Message,), None, results)
+    assert rows == legacy_rows
+
+    legacy = bench(
+        "legacy", lambda: legacy_decode_query_results(Message, legacy_results), n
+    )
+    codecs = bench("codecs", lambda: decode_query_results((Message,), None, results), n)
+    print(f" speedup: {legacy / codecs:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
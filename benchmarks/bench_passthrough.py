@@ -0,0 +1,43 @@
+"""
+Microbenchmark for encoding search results which contain JSONB. Compares
+decoding the JSONB and encoding it again with `dumps` against passing it
+through as `RawJSON` and splicing it in with `dumps_raw`.
+
+    python -m benchmarks.bench_passthrough [rows]
+"""
+import sys
+import time
+from abode.lib.fastjson import RawJSON, dumps, dumps_raw, loads
+
+EMBEDS = '[{"type": "rich", "title": "title", "fields": [{"name": "a", "value": "b"}]}]'
+
+
+def bench(name, fn, n):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{name:>11}: {elapsed * 1000:8.1f}ms total, {elapsed / n * 1e6:6.2f}us/row")
+    return elapsed
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    encoded = [[str(i), f"message number {i}", EMBEDS, "null"] for i in range(n)]
+
+    def decode():
+        rows = [row[:2] + [loads(row[2]), loads(row[3])] for row in encoded]
+        return dumps({"results": rows})
+
+    def passthrough():
+        rows = [row[:2] + [RawJSON(row[2]), RawJSON(row[3])] for row in encoded]
+        return dumps_raw({"results": rows})
+
+    assert loads(decode()) == loads(passthrough())
+
+    decoded = bench("decode", decode, n)
+    raw = bench("passthrough", passthrough, n)
+    print(f"    speedup: {decoded / raw:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -31,6 +31,37 @@ function renderError(error) {
     $("#error").show().text(error);
 }
 
+function findSeqScans(plan, scans) {
+    if (plan["Node Type"] == "Seq Scan") {
+        scans.push(plan["Relation Name"]);
+    }
+    for (const child of plan["Plans"] || []) {
+        findSeqScans(child, scans);
+    }
+    return scans;
+}
+
+function renderPlan(debug) {
+    if (!debug || !debug.plan) {
+        $("#plan").hide();
+        return;
+    }
+
+    const plan = debug.plan[0];
+    const scans = findSeqScans(plan["Plan"], []);
+    const lines = [
+        `timings (ms): ${JSON.stringify(debug.timings)}`,
+        `planning: ${plan["Planning Time"]}ms, execution: ${plan["Execution Time"]}ms`,
+    ];
+    if (debug.rollup) {
+        lines.push(`answered from rollup: ${debug.rollup}`);
+    }
+    if (scans.length) {
+        lines.push(`sequential scans: ${scans.join(", ")}`);
+    }
+    $("#plan").show().text(lines.join("\n"));
+}
+
 function handleSearchChange(event) {
     var currentModel = $("#model option:selected").text();
     var query = {
@@ -38,6 +69,7 @@ function handleSearchChange(event) {
         "limit": 1000,
         "order_by": "id",
         "order_dir": "DESC",
+        "explain": $("#explain").is(":checked"),
     };
 
     fetch(`/search/${currentModel}`, {
@@ -47,6 +79,7 @@ function handleSearchChange(event) {
         return response.json();
     }).then((data) => {
         console.log("[Debug]", data);
+        renderPlan(data._debug);
         if (data.results && !data.error) {
             renderResult(data.results, data.fields);
         } else if (data.error) {